@@ -0,0 +1,431 @@
+import argparse
+import json
+import os
+import struct
+import zlib
+import numpy as np
+from tqdm import tqdm
+from fileio import FeatureWriter, iter_store_rows, replace_atomically, store_lock
+from ingest import remove_derived_indexes
+from config import (
+    ARCHIVE_PATH,
+    ARCHIVE_CODEC,
+    ARCHIVE_LEVEL,
+    ARCHIVE_CHUNK_ROWS,
+    ARCHIVE_VECTOR_DTYPE,
+)
+
+# zstd and lz4 are optional, archives fall back to zlib without them
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# The file starts and ends with the magic, the index and its length are at the end
+MAGIC = b"FEATARC1"
+FOOTER = struct.Struct("<Q8s")
+
+# Columns holding one vector per track, stored in ARCHIVE_VECTOR_DTYPE
+VECTOR_COLUMNS = ["discogs_embeddings", "msd_embeddings", "genre_activations"]
+
+
+def get_available_codec(codec=ARCHIVE_CODEC):
+    """
+    Return the requested codec if its package is installed, otherwise the
+    next available one of zstd, lz4 and zlib
+
+    Args:
+        codec (str): Preferred codec, "zstd", "lz4" or "zlib"
+
+    Returns:
+        str: Codec to use
+    """
+
+    available = {"zstd": zstandard is not None, "lz4": lz4 is not None, "zlib": True}
+    if codec not in available:
+        raise ValueError("Invalid codec name.")
+    if available[codec]:
+        return codec
+    return next(name for name, installed in available.items() if installed)
+
+
+def compress(data, codec, level=ARCHIVE_LEVEL):
+    """
+    Compress bytes with a codec
+
+    Args:
+        data (bytes): Data to compress
+        codec (str): "zstd", "lz4" or "zlib"
+        level (int): Compression level
+
+    Returns:
+        bytes: Compressed data
+    """
+
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == "lz4":
+        return lz4.frame.compress(data, compression_level=level)
+    return zlib.compress(data, level)
+
+
+def decompress(data, codec):
+    """
+    Decompress bytes written by `compress`
+
+    Args:
+        data (bytes): Compressed data
+        codec (str): "zstd", "lz4" or "zlib"
+
+    Returns:
+        bytes: Decompressed data
+    """
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Install zstandard to read this archive.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "lz4":
+        if lz4 is None:
+            raise ImportError("Install lz4 to read this archive.")
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def shuffle_bytes(array):
+    """
+    Group the n-th bytes of all values together. The sign and exponent bytes
+    of neighbouring floats are similar, so shuffled chunks compress better.
+
+    Args:
+        array (np array): Array of fixed size values
+
+    Returns:
+        bytes: Shuffled bytes
+    """
+
+    array = np.ascontiguousarray(array)
+    return array.view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, dtype, shape):
+    """
+    Restore an array from bytes written by `shuffle_bytes`
+
+    Args:
+        data (bytes): Shuffled bytes
+        dtype (np.dtype): Type of the values
+        shape (tuple): Shape of the array
+
+    Returns:
+        np array : The array
+    """
+
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+
+def encode_column(values, column):
+    """
+    Serialise the values of one column of a chunk
+
+    Args:
+        values (list): Values of the rows of the chunk
+        column (dict): Column metadata with its kind and type
+
+    Returns:
+        bytes: Uncompressed data
+    """
+
+    if column["kind"] == "string":
+        return json.dumps(values).encode()
+    return shuffle_bytes(np.asarray(values, dtype=column["dtype"]))
+
+
+def decode_column(data, column, n_rows):
+    """
+    Restore the values of one column of a chunk
+
+    Args:
+        data (bytes): Uncompressed data
+        column (dict): Column metadata with its kind and type
+        n_rows (int): Number of rows of the chunk
+
+    Returns:
+        np array or list : Values of the rows
+    """
+
+    if column["kind"] == "string":
+        return json.loads(data)
+    return unshuffle_bytes(data, column["dtype"], (n_rows, *column["shape"]))
+
+
+def get_columns(features):
+    """
+    Describe the archive columns of the features of one track. Every entry
+    of `all_features` becomes its own column, so filters read only theirs.
+
+    Args:
+        features (dict): Features of a track, as returned by `extract_track`
+
+    Returns:
+        dict: Metadata of each column
+    """
+
+    columns = {"file_paths": {"kind": "string"}}
+    for name in VECTOR_COLUMNS:
+        columns[name] = {
+            "kind": "vector",
+            "dtype": ARCHIVE_VECTOR_DTYPE,
+            "shape": list(np.shape(features[name])),
+        }
+    for name, value in features["all_features"].items():
+        if isinstance(value, str):
+            columns[name] = {"kind": "string"}
+        else:
+            # Remember plain floats, the other descriptors are numpy scalars
+            columns[name] = {
+                "kind": "number",
+                "dtype": "float32",
+                "shape": [],
+                "python": isinstance(value, float),
+            }
+    return columns
+
+
+def get_column_values(rows, name):
+    """
+    Collect the values of a column from buffered rows
+
+    Args:
+        rows (list): (path, features) of the rows of a chunk
+        name (str): Column name
+
+    Returns:
+        list: Value of every row
+    """
+
+    if name == "file_paths":
+        return [path for path, _ in rows]
+    if name in VECTOR_COLUMNS:
+        return [features[name] for _, features in rows]
+    return [features["all_features"][name] for _, features in rows]
+
+
+def export_archive(
+    archive_path=ARCHIVE_PATH,
+    directory=None,
+    codec=ARCHIVE_CODEC,
+    chunk_rows=ARCHIVE_CHUNK_ROWS,
+):
+    """
+    Write the committed rows of a feature store to a compressed archive,
+    streaming them in chunks of rows so memory does not grow with the store
+
+    Args:
+        archive_path (str): Path of the archive to write
+        directory (str): Directory of the feature store, None for the paths in config
+        codec (str): Preferred codec, "zstd", "lz4" or "zlib"
+        chunk_rows (int): Number of rows per chunk
+
+    Returns:
+        int: Number of archived tracks
+    """
+
+    codec = get_available_codec(codec)
+    index = {"rows": 0, "chunk_rows": chunk_rows, "codec": codec, "columns": {}}
+
+    def write_chunk(f, rows):
+        if not index["columns"]:
+            index["columns"] = get_columns(rows[0][1])
+            for column in index["columns"].values():
+                column["chunks"] = []
+        for name, column in index["columns"].items():
+            data = compress(encode_column(get_column_values(rows, name), column), codec)
+            column["chunks"].append([f.tell(), len(data)])
+            f.write(data)
+        index["rows"] += len(rows)
+
+    def write(f):
+        f.write(MAGIC)
+        rows = []
+        for row in tqdm(iter_store_rows(directory), desc="Archiving"):
+            rows.append(row)
+            if len(rows) == chunk_rows:
+                write_chunk(f, rows)
+                rows = []
+        if rows:
+            write_chunk(f, rows)
+        data = json.dumps(index).encode()
+        f.write(data)
+        f.write(FOOTER.pack(len(data), MAGIC))
+
+    replace_atomically(archive_path, write)
+    return index["rows"]
+
+
+class ArchiveReader:
+    def __init__(self, archive_path=ARCHIVE_PATH):
+        """
+        Random access to the chunks of a feature archive. Only the chunks of
+        the requested columns and rows are read and decompressed.
+
+        Args:
+            archive_path (str): Path of the archive
+        """
+        self.file = open(archive_path, "rb")
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        index_length, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != MAGIC:
+            self.file.close()
+            raise ValueError(f"{archive_path} is not a feature archive.")
+        self.file.seek(-FOOTER.size - index_length, os.SEEK_END)
+        self.index = json.loads(self.file.read(index_length))
+        self.columns = self.index["columns"]
+        self.codec = self.index["codec"]
+        self.chunk_rows = self.index["chunk_rows"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.index["rows"]
+
+    def close(self):
+        """
+        Close the archive.
+
+        Returns:
+            None
+        """
+        self.file.close()
+
+    def read_chunk(self, name, chunk):
+        """
+        Read and decompress one chunk of a column.
+
+        Args:
+            name (str): Column name
+            chunk (int): Chunk number
+
+        Returns:
+            np array or list : Values of the rows of the chunk
+        """
+        column = self.columns[name]
+        offset, length = column["chunks"][chunk]
+        self.file.seek(offset)
+        data = decompress(self.file.read(length), self.codec)
+        n_rows = min(self.chunk_rows, len(self) - chunk * self.chunk_rows)
+        return decode_column(data, column, n_rows)
+
+    def read(self, names, start=0, stop=None):
+        """
+        Read a range of rows of some columns.
+
+        Args:
+            names (list): Column names
+            start (int): First row
+            stop (int): Row after the last one, None for the end
+
+        Returns:
+            dict: Values of each column, arrays for numeric columns and lists
+                for string columns
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        first, last = start // self.chunk_rows, -(-stop // self.chunk_rows)
+        result = {}
+        for name in names:
+            if name not in self.columns:
+                raise KeyError(f"No column {name} in the archive.")
+            chunks = [self.read_chunk(name, chunk) for chunk in range(first, last)]
+            offset = first * self.chunk_rows
+            if self.columns[name]["kind"] == "string":
+                values = [value for chunk in chunks for value in chunk]
+            elif chunks:
+                values = np.concatenate(chunks)
+            else:
+                values = np.zeros((0, *self.columns[name]["shape"]))
+            result[name] = values[start - offset : stop - offset]
+        return result
+
+    def iter_rows(self):
+        """
+        Iterate over the tracks chunk by chunk, restoring the feature layout
+        of the pickled store.
+
+        Yields:
+            str: Path of the audio file
+            dict: Features of the track, as returned by `extract_track`
+        """
+        descriptors = [name for name in self.columns if name != "file_paths"]
+        descriptors = [name for name in descriptors if name not in VECTOR_COLUMNS]
+        for start in range(0, len(self), self.chunk_rows):
+            chunk = self.read(list(self.columns), start, start + self.chunk_rows)
+            for i, path in enumerate(chunk["file_paths"]):
+                features = {
+                    name: chunk[name][i].astype(np.float32) for name in VECTOR_COLUMNS
+                }
+                all_features = {}
+                for name in descriptors:
+                    value = chunk[name][i]
+                    if self.columns[name]["kind"] == "number":
+                        value = float(value) if self.columns[name]["python"] else value
+                    all_features[name] = value
+                features["all_features"] = all_features
+                yield path, features
+
+
+def import_archive(archive_path=ARCHIVE_PATH, directory=None):
+    """
+    Restore a feature store in the pickled layout from an archive. Vectors
+    archived as float16 come back as float32 with float16 precision.
+
+    Args:
+        archive_path (str): Path of the archive
+        directory (str): Directory of the feature store, None for the paths in config
+
+    Returns:
+        int: Number of restored tracks
+    """
+
+    with ArchiveReader(archive_path) as reader, FeatureWriter(directory) as writer:
+        for path, features in tqdm(reader.iter_rows(), total=len(reader)):
+            writer.write(path, features)
+    if directory is None:
+        # The indexes belong to the store in config, whose rows were replaced
+        with store_lock():
+            remove_derived_indexes()
+    return len(reader)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compressed feature store archives.")
+    parser.add_argument("command", choices=["export", "import", "info"])
+    parser.add_argument("--path", default=ARCHIVE_PATH, help="Archive path")
+    parser.add_argument("--store", default=None, help="Feature store directory")
+    parser.add_argument("--codec", default=ARCHIVE_CODEC, help="zstd, lz4 or zlib")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        rows = export_archive(args.path, args.store, args.codec)
+        print(f"Archived {rows} tracks to {args.path}.")
+    elif args.command == "import":
+        rows = import_archive(args.path, args.store)
+        print(f"Restored {rows} tracks from {args.path}.")
+    else:
+        with ArchiveReader(args.path) as reader:
+            sizes = {
+                name: sum(length for _, length in column["chunks"])
+                for name, column in reader.columns.items()
+            }
+            print(f"{len(reader)} tracks, {reader.codec} chunks of {reader.chunk_rows}")
+            for name, size in sizes.items():
+                print(f"{name}: {size / 2**20:.2f} MB")
@@ -0,0 +1,300 @@
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import time
+import numpy as np
+from fileio import load_json, replace_atomically
+from config import (
+    TF_PROFILE_PATH,
+    TF_INTRA_OP_THREADS,
+    TF_INTER_OP_THREADS,
+    TF_BATCH_SIZE,
+    EXTRACTION_WORKERS,
+    AUTOTUNE_SECONDS,
+    AUTOTUNE_TRACKS,
+    AUTOTUNE_BATCH_SIZES,
+    AUTOTUNE_INTER_OP_THREADS,
+)
+
+# Settings used when no profile has been written
+DEFAULT_PROFILE = {
+    "intra_op_threads": TF_INTRA_OP_THREADS,
+    "inter_op_threads": TF_INTER_OP_THREADS,
+    "batch_size": TF_BATCH_SIZE,
+    "workers": EXTRACTION_WORKERS,
+}
+
+# Profile applied to the current process, read by `features.py`
+active_profile = None
+
+
+def load_profile(profile_path=TF_PROFILE_PATH):
+    """
+    Load the inference settings written by the autotuner
+
+    Args:
+        profile_path (str): Path to the JSON profile
+
+    Returns:
+        dict: Threads, batch size and worker count, the defaults if there is
+            no profile
+    """
+
+    profile = dict(DEFAULT_PROFILE)
+    if os.path.exists(profile_path):
+        saved = load_json(profile_path)
+        profile.update({key: saved[key] for key in DEFAULT_PROFILE if key in saved})
+    return profile
+
+
+def apply_profile(profile):
+    """
+    Configure the TensorFlow thread pools of the current process. Must run
+    before the first model is loaded, as TensorFlow reads the thread counts
+    from the environment when it creates its pools.
+
+    Args:
+        profile (dict): Inference settings
+
+    Returns:
+        None
+    """
+
+    global active_profile
+    active_profile = profile
+    if profile["intra_op_threads"] > 0:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(profile["intra_op_threads"])
+        os.environ["OMP_NUM_THREADS"] = str(profile["intra_op_threads"])
+    if profile["inter_op_threads"] > 0:
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(profile["inter_op_threads"])
+
+
+def get_profile():
+    """
+    Return the inference settings of the current process
+
+    Returns:
+        dict: The applied profile, or the saved one
+    """
+
+    return active_profile if active_profile is not None else load_profile()
+
+
+def get_candidates(
+    n_cores, inter_op_threads=AUTOTUNE_INTER_OP_THREADS, batch_size=TF_BATCH_SIZE
+):
+    """
+    List the thread settings to benchmark, starting with the defaults as a
+    baseline. Workers times intra-op threads always uses all the cores that
+    a power of two can: fewer leaves cores idle, and more oversubscribes
+    them so workers only slow each other down.
+
+    Args:
+        n_cores (int): Number of CPU cores
+        inter_op_threads (list): Inter-op thread counts to try
+        batch_size (int): Batch size of the candidates
+
+    Returns:
+        list: Candidate profiles, the default profile first
+    """
+
+    counts = [2**i for i in range(n_cores.bit_length()) if 2**i <= n_cores]
+    candidates = [dict(DEFAULT_PROFILE)]
+    for workers, intra, inter in itertools.product(counts, counts, inter_op_threads):
+        if workers * intra == counts[-1]:
+            candidate = {
+                "intra_op_threads": intra,
+                "inter_op_threads": inter,
+                "batch_size": batch_size,
+                "workers": workers,
+            }
+            if candidate not in candidates:
+                candidates.append(candidate)
+    return candidates
+
+
+def create_synthetic_audio(seconds, seed, sample_rate=16000):
+    """
+    Create a mix of tones, pulses and noise that keeps the models busy like
+    music would
+
+    Args:
+        seconds (float): Length of the audio
+        seed (int): Seed of the random generator
+        sample_rate (int): Sample rate of the audio
+
+    Returns:
+        np array : float32 mono audio
+    """
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = 0.05 * rng.standard_normal(len(t))
+    for frequency in rng.uniform(55, 2000, size=6):
+        audio += 0.1 * np.sin(2 * np.pi * frequency * t)
+    audio *= 0.5 + 0.5 * (np.sin(2 * np.pi * 2 * t) > 0)
+    return audio.astype(np.float32)
+
+
+def benchmark_worker(profile, n_tracks, seconds, barrier, results):
+    """
+    Run the models on synthetic tracks with some settings, in a new process
+
+    Args:
+        profile (dict): Inference settings
+        n_tracks (int): Number of timed tracks
+        seconds (float): Length of each track
+        barrier (multiprocessing.Barrier): Starts the workers together
+        results (multiprocessing.Queue): Receives the seconds taken, or None
+            if the settings failed
+
+    Returns:
+        None
+    """
+
+    apply_profile(profile)
+    try:
+        from features import (
+            get_embeddings,
+            get_genre_distribution,
+            get_embeddings_features,
+        )
+
+        def run(audio):
+            discogs_embeddings, msd_embeddings = get_embeddings(audio)
+            get_genre_distribution(discogs_embeddings)
+            get_embeddings_features(discogs_embeddings, msd_embeddings)
+
+        audio = create_synthetic_audio(seconds, seed=os.getpid())
+        # The first run allocates the TensorFlow sessions, so it is not timed
+        run(audio)
+        barrier.wait()
+        start = time.perf_counter()
+        for _ in range(n_tracks):
+            run(audio)
+        results.put(time.perf_counter() - start)
+    except Exception:
+        barrier.abort()
+        results.put(None)
+
+
+def benchmark(profile, n_tracks=AUTOTUNE_TRACKS, seconds=AUTOTUNE_SECONDS):
+    """
+    Measure the model throughput of some settings with all their workers
+    running at once
+
+    Args:
+        profile (dict): Inference settings
+        n_tracks (int): Number of timed tracks per worker
+        seconds (float): Length of each track
+
+    Returns:
+        float: Tracks per second, 0 if the settings failed
+    """
+
+    context = mp.get_context("spawn")
+    barrier = context.Barrier(profile["workers"])
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=benchmark_worker,
+            args=(profile, n_tracks, seconds, barrier, results),
+        )
+        for _ in range(profile["workers"])
+    ]
+    for process in processes:
+        process.start()
+
+    elapsed = []
+    while len(elapsed) < len(processes):
+        try:
+            elapsed.append(results.get(timeout=1))
+        except queue.Empty:
+            # A worker killed by the settings never reports back
+            if any(process.exitcode not in (None, 0) for process in processes):
+                elapsed.append(None)
+                break
+    for process in processes:
+        process.kill()
+        process.join()
+
+    if None in elapsed:
+        return 0.0
+    return profile["workers"] * n_tracks / max(elapsed)
+
+
+def autotune(
+    n_cores=None,
+    n_tracks=AUTOTUNE_TRACKS,
+    seconds=AUTOTUNE_SECONDS,
+    profile_path=TF_PROFILE_PATH,
+):
+    """
+    Benchmark the thread, batch size and worker settings on this machine and
+    save the fastest to the profile loaded by the extraction workers. The
+    thread settings are tuned first at the default batch size, then the
+    batch sizes with the fastest thread settings, as every run reloads all
+    the models.
+
+    Args:
+        n_cores (int): Number of CPU cores to use, all of them by default
+        n_tracks (int): Number of timed tracks per worker
+        seconds (float): Length of each synthetic track
+        profile_path (str): Path to the JSON profile
+
+    Returns:
+        dict: The fastest profile
+    """
+
+    n_cores = n_cores or os.cpu_count()
+    throughputs = []
+
+    def run(profile):
+        throughput = benchmark(profile, n_tracks, seconds)
+        print(
+            f"workers={profile['workers']} intra={profile['intra_op_threads']} "
+            f"inter={profile['inter_op_threads']} batch={profile['batch_size']}: "
+            f"{throughput:.2f} tracks/s"
+        )
+        throughputs.append((throughput, profile))
+
+    candidates = get_candidates(n_cores)
+    for profile in candidates:
+        run(profile)
+    best_throughput, best = max(throughputs, key=lambda result: result[0])
+    for batch_size in AUTOTUNE_BATCH_SIZES:
+        if batch_size != best["batch_size"]:
+            run(best | {"batch_size": batch_size})
+
+    best_throughput, best = max(throughputs, key=lambda result: result[0])
+    if best_throughput == 0:
+        raise RuntimeError("Every setting failed, the profile was not written.")
+    baseline_throughput = throughputs[0][0]
+
+    report = best | {
+        "tracks_per_second": best_throughput,
+        "default_tracks_per_second": baseline_throughput,
+        "cores": n_cores,
+        "machine": platform.node(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    data = json.dumps(report, indent=2).encode()
+    replace_atomically(profile_path, lambda f: f.write(data))
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the fastest TensorFlow settings on this machine."
+    )
+    parser.add_argument("--cores", type=int, default=None, help="CPU cores to use")
+    parser.add_argument("--tracks", type=int, default=AUTOTUNE_TRACKS)
+    parser.add_argument("--seconds", type=float, default=AUTOTUNE_SECONDS)
+    args = parser.parse_args()
+
+    best = autotune(args.cores, args.tracks, args.seconds)
+    print(f"Saved {best} to {TF_PROFILE_PATH}.")
@@ -0,0 +1,262 @@
+import os
+import numpy as np
+from store import (
+    get_store_path,
+    export_array,
+    load_array,
+    is_stale,
+    get_shared_genre_activations,
+)
+from fileio import get_genre_names
+from config import GENRE_DISCOGS_PATH, GENRE_BITMAP_BINS
+
+
+def get_bins(values, n_bins):
+    """
+    Bin activations in [0, 1] into equal width bins. The binning is monotonic,
+    so every value in a bin above the bin of a threshold is above the threshold.
+
+    Args:
+        values (np array or float): Activation values
+        n_bins (int): Number of bins
+
+    Returns:
+        np array or int : Bin of each value
+    """
+
+    bins = np.floor(np.asarray(values, dtype=np.float64) * n_bins)
+    return np.clip(bins, 0, n_bins - 1).astype(np.int64)
+
+
+def build_genre_bitmaps(activations, n_bins=GENRE_BITMAP_BINS, offset=0):
+    """
+    Build one packed bitmap of tracks per genre and activation bin
+
+    Args:
+        activations (np array): Genre activations of shape (N, G)
+        n_bins (int): Number of activation bins
+        offset (int): Number of empty bits before the first track
+
+    Returns:
+        np array : uint8 bitmaps of shape (G, n_bins, ceil((offset + N) / 8))
+    """
+
+    n_tracks, n_genres = activations.shape
+    padding = np.zeros((offset, n_bins), dtype=bool)
+    bitmaps = np.zeros(
+        (n_genres, n_bins, (offset + n_tracks + 7) // 8), dtype=np.uint8
+    )
+    for genre in range(n_genres):
+        bins = get_bins(activations[:, genre], n_bins)
+        one_hot = bins[:, np.newaxis] == np.arange(n_bins)[np.newaxis, :]
+        bitmaps[genre] = np.packbits(np.concatenate([padding, one_hot]), axis=0).T
+    return bitmaps
+
+
+def save_genre_bitmaps(bitmaps, n_rows):
+    """
+    Store the bitmaps with the number of tracks they hold, which the packed
+    bytes only give to the nearest multiple of 8
+
+    Args:
+        bitmaps (np array): Packed bitmaps from `build_genre_bitmaps`
+        n_rows (int): Number of tracks in the bitmaps
+
+    Returns:
+        None
+    """
+
+    export_array("genre_bitmaps", bitmaps)
+    export_array("genre_bitmap_rows", np.array([n_rows], dtype=np.int64))
+
+
+def load_stored_genre_bitmaps():
+    """
+    Load the stored bitmaps and the number of tracks they hold
+
+    Returns:
+        np array : Packed bitmaps, or None if they are missing
+        int : Number of tracks, or None if the bitmaps are missing
+    """
+
+    names = ["genre_bitmaps", "genre_bitmap_rows"]
+    if not all(os.path.exists(get_store_path(name)) for name in names):
+        return None, None
+    return load_array("genre_bitmaps"), int(load_array("genre_bitmap_rows")[0])
+
+
+def append_genre_bitmaps(activations, n_rows):
+    """
+    Add new tracks to the stored bitmaps without recomputing the bitmaps of
+    the existing tracks
+
+    Args:
+        activations (np array): Genre activations of the new tracks
+        n_rows (int): Number of tracks in the bitmaps before the append
+
+    Returns:
+        bool: True if the tracks were added, False if the bitmaps are missing
+            or out of date and need a rebuild
+    """
+
+    bitmaps, stored_rows = load_stored_genre_bitmaps()
+    if bitmaps is None or stored_rows != n_rows:
+        return False
+    n_genres, n_bins, _ = bitmaps.shape
+    if activations.shape[1] != n_genres:
+        return False
+
+    # Align the new bits with the last partially filled byte
+    offset = n_rows % 8
+    new_bitmaps = build_genre_bitmaps(activations, n_bins, offset)
+    if offset:
+        last_byte = bitmaps[:, :, -1:] | new_bitmaps[:, :, :1]
+        bitmaps = np.concatenate(
+            [bitmaps[:, :, :-1], last_byte, new_bitmaps[:, :, 1:]], axis=2
+        )
+    else:
+        bitmaps = np.concatenate([bitmaps, new_bitmaps], axis=2)
+    save_genre_bitmaps(bitmaps, n_rows + len(activations))
+    return True
+
+
+def remove_genre_bitmap_rows(keep):
+    """
+    Rebuild the stored bitmaps from the stored genre activations after tracks
+    were removed from them
+
+    Args:
+        keep (np array): Boolean mask of the tracks that were kept
+
+    Returns:
+        bool: True if the bitmaps were rebuilt, False if the bitmaps or the
+            activations are missing or out of date
+    """
+
+    bitmaps, stored_rows = load_stored_genre_bitmaps()
+    if bitmaps is None or not os.path.exists(get_store_path("genre_activations")):
+        return False
+    activations = load_array("genre_activations")
+    if stored_rows != len(keep) or len(activations) != keep.sum():
+        return False
+    bitmaps = build_genre_bitmaps(activations, bitmaps.shape[1])
+    save_genre_bitmaps(bitmaps, len(activations))
+    return True
+
+
+class GenreBitmapIndex:
+    def __init__(self, bitmaps, activations, genre_names):
+        """
+        Bitmap index answering genre activation range queries with OR/AND of
+        packed bitmaps, checking only the boundary bins against the activations.
+
+        Args:
+            bitmaps (np array): Packed bitmaps from `build_genre_bitmaps`
+            activations (np array): Genre activations of shape (N, G)
+            genre_names (list): Genre name of each activation column
+        """
+        self.bitmaps = bitmaps
+        self.activations = activations
+        self.columns = {name: i for i, name in enumerate(genre_names)}
+        self.n_bins = bitmaps.shape[1]
+        self.n_tracks = len(activations)
+
+    def _union(self, columns, bins):
+        """
+        OR the bitmaps of the given genre columns and bins.
+
+        Args:
+            columns (list): Genre columns
+            bins (slice or int): Bins to combine
+
+        Returns:
+            np array : Boolean mask over the tracks
+        """
+        bitmaps = self.bitmaps[columns][:, bins].reshape(-1, self.bitmaps.shape[2])
+        packed = np.bitwise_or.reduce(bitmaps, axis=0, initial=0)
+        return np.unpackbits(packed, count=self.n_tracks).astype(bool)
+
+    def _threshold(self, threshold):
+        """
+        Cast a threshold to the type NumPy compares it with the activations
+        in, float32 for Python floats. The threshold must be binned in that
+        type too, or activations equal to the cast threshold could fall in
+        the bin below its bin.
+
+        Args:
+            threshold (float): Activation threshold
+
+        Returns:
+            np.generic : Threshold in the type of the comparison
+        """
+        return np.result_type(self.activations.dtype, threshold).type(threshold)
+
+    def _boundary(self, columns, threshold, compare):
+        """
+        Exact check of the tracks in the bin containing a threshold.
+
+        Args:
+            columns (list): Genre columns
+            threshold (np.generic): Threshold in the type of the comparison
+            compare (np.ufunc): Comparison between activations and the threshold
+
+        Returns:
+            np array : Boolean mask over the tracks
+        """
+        mask = np.zeros(self.n_tracks, dtype=bool)
+        threshold_bin = get_bins(threshold, self.n_bins)
+        for column in columns:
+            rows = np.flatnonzero(self._union([column], [threshold_bin]))
+            values = np.asarray(self.activations[rows, column])
+            mask[rows[compare(values, threshold)]] = True
+        return mask
+
+    def query(self, genres, low, high):
+        """
+        Find the tracks with at least one activation of the given genres
+        greater than or equal to low and at least one lower than or equal to high.
+
+        Args:
+            genres (list): Genre names
+            low (float): Lower activation threshold
+            high (float): Upper activation threshold
+
+        Returns:
+            np array : Boolean mask over the tracks
+        """
+        columns = [self.columns[genre] for genre in genres]
+        low, high = self._threshold(low), self._threshold(high)
+        low_bin = get_bins(low, self.n_bins)
+        high_bin = get_bins(high, self.n_bins)
+
+        above_low = self._union(columns, slice(low_bin + 1, None)) | self._boundary(
+            columns, low, np.greater_equal
+        )
+        below_high = self._union(columns, slice(None, high_bin)) | self._boundary(
+            columns, high, np.less_equal
+        )
+        return above_low & below_high
+
+
+def load_genre_bitmap_index():
+    """
+    Load the genre bitmap index from the shared store, building it if needed
+
+    Returns:
+        GenreBitmapIndex : The index
+    """
+
+    activations = get_shared_genre_activations()
+    bitmaps, n_rows = load_stored_genre_bitmaps()
+    if (
+        bitmaps is None
+        or n_rows != len(activations)
+        or is_stale("genre_bitmaps", [GENRE_DISCOGS_PATH])
+    ):
+        save_genre_bitmaps(build_genre_bitmaps(activations), len(activations))
+        bitmaps = load_array("genre_bitmaps")
+    return GenreBitmapIndex(bitmaps, activations, get_genre_names())
+
+
+if __name__ == "__main__":
+    load_genre_bitmap_index()
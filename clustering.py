@@ -0,0 +1,415 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from fileio import get_genre_names
+from quantization import normalize_rows
+from store import (
+    get_store_path,
+    export_array,
+    load_array,
+    append_array,
+    remove_array_rows,
+    is_stale,
+    get_embeddings_path,
+    get_shared_embeddings,
+    get_shared_genre_activations,
+)
+from config import (
+    GENRE_DISCOGS_PATH,
+    CLUSTER_SOURCES,
+    CLUSTER_COUNT,
+    CLUSTER_BATCH_SIZE,
+    CLUSTER_EPOCHS,
+    CLUSTER_CHUNK_SIZE,
+)
+
+
+def get_cluster_names(source):
+    """
+    Return the names of the clustering arrays in the shared store
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+
+    Returns:
+        str : Name of the float32 centroids
+        str : Name of the int64 number of points seen by each centroid
+        str : Name of the int32 cluster of every track
+        str : Name of the float64 sum of the genre activations of each cluster
+    """
+
+    return (
+        f"{source}_centroids",
+        f"{source}_cluster_counts",
+        f"{source}_clusters",
+        f"{source}_cluster_genres",
+    )
+
+
+def get_source_paths(source):
+    """
+    Return the paths of the feature files a clustering is built from. The
+    cluster labels come from the genre activations of every source.
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+
+    Returns:
+        list: Paths to the pickled features
+    """
+
+    if source == "genres":
+        return [GENRE_DISCOGS_PATH]
+    return [get_embeddings_path(source), GENRE_DISCOGS_PATH]
+
+
+def get_cluster_vectors(source):
+    """
+    Return the features of a clustering from the shared store
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+
+    Returns:
+        np.memmap: Read-only features of shape (N, D)
+    """
+
+    if source == "genres":
+        return get_shared_genre_activations()
+    return get_shared_embeddings(source)
+
+
+def sum_by_cluster(vectors, assignments):
+    """
+    Count and sum the vectors assigned to each cluster with one sort
+
+    Args:
+        vectors (np array): Array of shape (N, D)
+        assignments (np array): Cluster of every vector
+
+    Returns:
+        np array : Clusters with at least one vector
+        np array : Number of vectors in each of these clusters
+        np array : Sum of the vectors in each of these clusters
+    """
+
+    order = np.argsort(assignments, kind="stable")
+    clusters, starts, counts = np.unique(
+        assignments[order], return_index=True, return_counts=True
+    )
+    return clusters, counts, np.add.reduceat(vectors[order], starts, axis=0)
+
+
+def get_closest_centroids(vectors, centroids):
+    """
+    Assign normalised vectors to the centroid with the highest cosine
+    similarity. Centroids are means of unit vectors and shrink as their
+    clusters spread, so comparing directions keeps a broad cluster from
+    attracting every vector.
+
+    Args:
+        vectors (np array): Normalised vectors of shape (N, D)
+        centroids (np array): Centroids of shape (K, D)
+
+    Returns:
+        np array : int32 closest centroid of every vector
+    """
+
+    return np.argmax(vectors @ normalize_rows(centroids).T, axis=1).astype(np.int32)
+
+
+def minibatch_update(centroids, counts, batch):
+    """
+    Move the centroids towards the mean of a batch of vectors. Each centroid
+    has a learning rate of one over the number of vectors it has seen, so it
+    stays the running mean of its vectors. Updates are made in place.
+
+    Args:
+        centroids (np array): float32 centroids of shape (K, D)
+        counts (np array): Number of vectors seen by each centroid
+        batch (np array): Normalised vectors of shape (B, D)
+
+    Returns:
+        None
+    """
+
+    assignments = get_closest_centroids(batch, centroids)
+    clusters, batch_counts, sums = sum_by_cluster(batch, assignments)
+    counts[clusters] += batch_counts
+    centroids[clusters] += (
+        sums - batch_counts[:, np.newaxis] * centroids[clusters]
+    ) / counts[clusters, np.newaxis]
+
+
+def assign_rows(vectors, centroids, start=0, chunk_size=CLUSTER_CHUNK_SIZE):
+    """
+    Assign rows to their closest centroid, reading the features in chunks
+
+    Args:
+        vectors (np array): Features of shape (N, D)
+        centroids (np array): Centroids of shape (K, D)
+        start (int): First row to assign
+        chunk_size (int): Number of rows read at once
+
+    Returns:
+        np array : int32 cluster of every row from start
+    """
+
+    assignments = np.zeros(len(vectors) - start, dtype=np.int32)
+    for chunk_start in range(start, len(vectors), chunk_size):
+        chunk = normalize_rows(vectors[chunk_start : chunk_start + chunk_size])
+        assignments[chunk_start - start : chunk_start - start + len(chunk)] = (
+            get_closest_centroids(chunk, centroids)
+        )
+    return assignments
+
+
+def sum_genres(assignments, n_clusters, start=0, chunk_size=CLUSTER_CHUNK_SIZE):
+    """
+    Sum the genre activations of the tracks of each cluster, reading them in
+    chunks, to describe the clusters
+
+    Args:
+        assignments (np array): Cluster of every track from start
+        n_clusters (int): Number of clusters
+        start (int): Row of the first track
+        chunk_size (int): Number of rows read at once
+
+    Returns:
+        np array : float64 sums of shape (n_clusters, number of genres)
+    """
+
+    activations = get_shared_genre_activations()
+    sums = np.zeros((n_clusters, activations.shape[1]), dtype=np.float64)
+    for chunk_start in range(0, len(assignments), chunk_size):
+        chunk_end = chunk_start + chunk_size
+        clusters, _, chunk_sums = sum_by_cluster(
+            np.asarray(activations[start + chunk_start : start + chunk_end]),
+            assignments[chunk_start:chunk_end],
+        )
+        sums[clusters] += chunk_sums
+    return sums
+
+
+def build_clusters(
+    source,
+    n_clusters=CLUSTER_COUNT,
+    batch_size=CLUSTER_BATCH_SIZE,
+    epochs=CLUSTER_EPOCHS,
+    chunk_size=CLUSTER_CHUNK_SIZE,
+    seed=0,
+):
+    """
+    Cluster the tracks with mini-batch k-means, streaming the features from
+    the shared store in chunks so memory stays O(chunk_size x D), and save the
+    centroids and the cluster of every track to the shared store
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+        n_clusters (int): Number of clusters
+        batch_size (int): Number of tracks per centroid update
+        epochs (int): Number of passes over the tracks
+        chunk_size (int): Number of tracks read at once
+        seed (int): Seed of the initialisation and the batch order
+
+    Returns:
+        None
+    """
+
+    vectors = get_cluster_vectors(source)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+
+    # Start from random tracks, read in file order from the memory map
+    rows = np.sort(rng.choice(len(vectors), n_clusters, replace=False))
+    centroids = normalize_rows(vectors[rows])
+    counts = np.zeros(n_clusters, dtype=np.int64)
+
+    chunk_starts = np.arange(0, len(vectors), chunk_size)
+    for _ in tqdm(range(epochs), desc=f"Clustering {source}"):
+        # Shuffle the chunks and the tracks within them, so batches are not
+        # biased by the order of the collection
+        for chunk_start in rng.permutation(chunk_starts):
+            chunk = normalize_rows(vectors[chunk_start : chunk_start + chunk_size])
+            chunk = chunk[rng.permutation(len(chunk))]
+            for batch_start in range(0, len(chunk), batch_size):
+                minibatch_update(
+                    centroids, counts, chunk[batch_start : batch_start + batch_size]
+                )
+
+    assignments = assign_rows(vectors, centroids, chunk_size=chunk_size)
+    genre_sums = sum_genres(assignments, n_clusters, chunk_size=chunk_size)
+    for name, array in zip(
+        get_cluster_names(source), [centroids, counts, assignments, genre_sums]
+    ):
+        export_array(name, array)
+
+
+def load_stored_clusters(source, n_rows):
+    """
+    Load the stored clustering if it holds the expected number of tracks
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+        n_rows (int): Expected number of tracks
+
+    Returns:
+        tuple: Centroids, counts, assignments and genre sums, or None
+    """
+
+    names = get_cluster_names(source)
+    if not all(os.path.exists(get_store_path(name)) for name in names):
+        return None
+    arrays = tuple(load_array(name) for name in names)
+    if len(arrays[2]) != n_rows:
+        return None
+    return arrays
+
+
+def append_to_clusters(source, n_rows, batch_size=CLUSTER_BATCH_SIZE):
+    """
+    Warm start the clustering with tracks appended to the shared store: the
+    stored centroids take mini-batch steps towards the new tracks, which are
+    then assigned to their closest centroid. Existing tracks keep their
+    cluster until the next full build.
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+        n_rows (int): Number of tracks in the clustering before the append
+        batch_size (int): Number of tracks per centroid update
+
+    Returns:
+        bool: True if the tracks were added, False if the clustering is
+            missing or out of date and needs a rebuild
+    """
+
+    stored = load_stored_clusters(source, n_rows)
+    if stored is None:
+        return False
+    vectors = get_cluster_vectors(source)
+    if len(vectors) <= n_rows:
+        return False
+
+    centroids_name, counts_name, assignments_name, genres_name = get_cluster_names(
+        source
+    )
+    centroids, counts, _, genre_sums = (np.array(array) for array in stored)
+    new_vectors = normalize_rows(vectors[n_rows:])
+    for batch_start in range(0, len(new_vectors), batch_size):
+        minibatch_update(
+            centroids, counts, new_vectors[batch_start : batch_start + batch_size]
+        )
+
+    assignments = assign_rows(vectors, centroids, start=n_rows)
+    genre_sums += sum_genres(assignments, len(centroids), start=n_rows)
+    export_array(centroids_name, centroids)
+    export_array(counts_name, counts)
+    export_array(genres_name, genre_sums)
+    return append_array(assignments_name, assignments, n_rows)
+
+
+def remove_from_clusters(source, keep):
+    """
+    Drop removed tracks from the clustering. The centroids are kept, and the
+    genre sums are recomputed from the remaining tracks.
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+        keep (np array): Boolean mask of the tracks that were kept
+
+    Returns:
+        bool: True if the tracks were removed, False if the clustering is
+            missing or out of date and needs a rebuild
+    """
+
+    stored = load_stored_clusters(source, len(keep))
+    if stored is None or len(get_shared_genre_activations()) != keep.sum():
+        return False
+
+    _, _, assignments_name, genres_name = get_cluster_names(source)
+    remove_array_rows(assignments_name, keep)
+    assignments = load_array(assignments_name)
+    export_array(genres_name, sum_genres(assignments, len(stored[0])))
+    return True
+
+
+class ClusterIndex:
+    def __init__(self, assignments, genre_sums, genre_names):
+        """
+        Tracks of each cluster, grouped once so a cluster playlist is a slice.
+
+        Args:
+            assignments (np array): Cluster of every track
+            genre_sums (np array): Sum of the genre activations of each cluster
+            genre_names (list): Genre name of each activation column
+        """
+        self.order = np.argsort(assignments, kind="stable")
+        self.sizes = np.bincount(assignments, minlength=len(genre_sums))
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.genre_means = genre_sums / np.maximum(self.sizes, 1)[:, np.newaxis]
+        self.genre_names = genre_names
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_clusters(self):
+        """
+        Return the clusters with at least one track, largest first.
+
+        Returns:
+            list: Cluster ids
+        """
+        clusters = np.argsort(-self.sizes, kind="stable")
+        return [int(cluster) for cluster in clusters if self.sizes[cluster]]
+
+    def get_label(self, cluster, n_genres=2):
+        """
+        Describe a cluster by its most active genres and its size.
+
+        Args:
+            cluster (int): Cluster id
+            n_genres (int): Number of genres in the label
+
+        Returns:
+            str: Label of the cluster
+        """
+        top = np.argsort(-self.genre_means[cluster])[:n_genres]
+        genres = ", ".join(self.genre_names[genre] for genre in top)
+        return f"{genres} ({self.sizes[cluster]} tracks)"
+
+    def get_tracks(self, cluster):
+        """
+        Return the tracks of a cluster.
+
+        Args:
+            cluster (int): Cluster id
+
+        Returns:
+            np array: Indexes of the tracks in the cluster
+        """
+        return self.order[self.offsets[cluster] : self.offsets[cluster + 1]]
+
+
+def load_cluster_index(source):
+    """
+    Load the clustering of a feature source if it is built and up to date
+
+    Args:
+        source (str): Clustered features, "discogs", "msd" or "genres"
+
+    Returns:
+        ClusterIndex : The index, or None if it has not been built or is stale
+    """
+
+    _, _, assignments_name, genres_name = get_cluster_names(source)
+    source_paths = get_source_paths(source)
+    if any(is_stale(name, source_paths) for name in [assignments_name, genres_name]):
+        return None
+    return ClusterIndex(
+        load_array(assignments_name), load_array(genres_name), get_genre_names()
+    )
+
+
+if __name__ == "__main__":
+    for source in CLUSTER_SOURCES:
+        build_clusters(source)
@@ -0,0 +1,313 @@
+import hashlib
+import itertools
+import json
+import os
+import pickle
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fileio import iter_pickled, replace_atomically
+from config import (
+    ALL_FEATURES_PATH,
+    GENRE_COUNTS_PATH,
+    COLLECTION_STATS_PATH,
+    COLLECTION_STATS_STATE_PATH,
+    STATS_CHUNK_SIZE,
+    STATS_WORKERS,
+)
+
+# Fixed histogram bin edges, so partial histograms from any chunk can be added
+HISTOGRAM_BINS = {
+    "tempo": np.linspace(0, 250, 51),
+    "loudness": np.linspace(-60, 0, 61),
+    "danceability_probability": np.linspace(0, 1, 41),
+    "instrumental_probability": np.linspace(0, 1, 31),
+    "arousal": np.linspace(1, 9, 33),
+    "valence": np.linspace(1, 9, 33),
+}
+SUMMARY_COLUMNS = list(HISTOGRAM_BINS)
+KEY_COLUMNS = ["key_temperley", "key_krumhansl", "key_edma"]
+
+
+class CollectionStats:
+    def __init__(self):
+        """
+        Mergeable aggregates of the extracted features: genre and style
+        counts, key counts, fixed-bin histograms and descriptor summaries.
+        """
+        self.n_tracks = 0
+        self.genre_counts = Counter()
+        self.style_counts = Counter()
+        self.key_counts = {column: Counter() for column in KEY_COLUMNS}
+        self.keys_agree = 0
+        self.histograms = {
+            column: np.zeros(len(edges) - 1, dtype=np.int64)
+            for column, edges in HISTOGRAM_BINS.items()
+        }
+        self.summaries = {
+            column: {"count": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf}
+            for column in SUMMARY_COLUMNS
+        }
+
+    def update(self, features):
+        """
+        Add a chunk of tracks to the aggregates.
+
+        Args:
+            features (list): List of feature dictionaries
+
+        Returns:
+            CollectionStats: The updated aggregates
+        """
+        if not features:
+            return self
+
+        self.n_tracks += len(features)
+        genres = [track["genre"] for track in features]
+        self.genre_counts.update(genres)
+        self.style_counts.update(genre.split("---")[0] for genre in genres)
+        for column in KEY_COLUMNS:
+            self.key_counts[column].update(track[column] for track in features)
+        self.keys_agree += sum(
+            track["key_temperley"] == track["key_krumhansl"] == track["key_edma"]
+            for track in features
+        )
+
+        for column in SUMMARY_COLUMNS:
+            values = np.array([track[column] for track in features], dtype=np.float64)
+            edges = HISTOGRAM_BINS[column]
+
+            # Clip to the outer bins so every track is counted
+            clipped = np.clip(values, edges[0], edges[-1])
+            self.histograms[column] += np.histogram(clipped, bins=edges)[0]
+
+            chunk = {
+                "count": len(values),
+                "mean": values.mean(),
+                "m2": ((values - values.mean()) ** 2).sum(),
+                "min": values.min(),
+                "max": values.max(),
+            }
+            self.summaries[column] = merge_summaries(self.summaries[column], chunk)
+        return self
+
+    def merge(self, other):
+        """
+        Add the aggregates of another CollectionStats computed on other tracks.
+
+        Args:
+            other (CollectionStats): Aggregates to merge
+
+        Returns:
+            CollectionStats: The merged aggregates
+        """
+        self.n_tracks += other.n_tracks
+        self.genre_counts.update(other.genre_counts)
+        self.style_counts.update(other.style_counts)
+        for column in KEY_COLUMNS:
+            self.key_counts[column].update(other.key_counts[column])
+        self.keys_agree += other.keys_agree
+        for column in SUMMARY_COLUMNS:
+            self.histograms[column] += other.histograms[column]
+            self.summaries[column] = merge_summaries(
+                self.summaries[column], other.summaries[column]
+            )
+        return self
+
+    def to_dict(self):
+        """
+        Convert the aggregates to a JSON serialisable report.
+
+        Returns:
+            dict: Collection statistics
+        """
+        summaries = {}
+        for column, summary in self.summaries.items():
+            count = summary["count"]
+            summaries[column] = {
+                "count": count,
+                "mean": float(summary["mean"]) if count else None,
+                "std": float(np.sqrt(summary["m2"] / count)) if count else None,
+                "min": float(summary["min"]) if count else None,
+                "max": float(summary["max"]) if count else None,
+            }
+
+        return {
+            "n_tracks": self.n_tracks,
+            "keys_agree_percentage": (
+                100 * self.keys_agree / self.n_tracks if self.n_tracks else None
+            ),
+            "style_counts": dict(self.style_counts.most_common()),
+            "key_counts": {
+                column: dict(counts.most_common())
+                for column, counts in self.key_counts.items()
+            },
+            "histograms": {
+                column: {
+                    "edges": HISTOGRAM_BINS[column].tolist(),
+                    "counts": counts.tolist(),
+                }
+                for column, counts in self.histograms.items()
+            },
+            "summaries": summaries,
+        }
+
+
+def merge_summaries(a, b):
+    """
+    Merge count, mean, sum of squared deviations, min and max of two
+    disjoint sets of values with the parallel variance formula
+
+    Args:
+        a (dict): First summary
+        b (dict): Second summary
+
+    Returns:
+        dict: Merged summary
+    """
+
+    count = a["count"] + b["count"]
+    if count == 0:
+        return dict(a)
+    delta = b["mean"] - a["mean"]
+    return {
+        "count": count,
+        "mean": a["mean"] + delta * b["count"] / count,
+        "m2": a["m2"] + b["m2"] + delta**2 * a["count"] * b["count"] / count,
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+    }
+
+
+def aggregate_chunk(features):
+    """
+    Compute the aggregates of one chunk of tracks in a worker process
+
+    Args:
+        features (list): List of feature dictionaries
+
+    Returns:
+        CollectionStats: Aggregates of the chunk
+    """
+
+    return CollectionStats().update(features)
+
+
+def get_tail_digest(file_path, offset, size=4096):
+    """
+    Hash the bytes right before an offset, to detect a file that was
+    rewritten instead of appended to since the offset was saved
+
+    Args:
+        file_path (str): Path to the file
+        offset (int): Byte offset
+        size (int): Number of bytes to hash
+
+    Returns:
+        str: Hex digest
+    """
+
+    with open(file_path, "rb") as f:
+        f.seek(max(offset - size, 0))
+        return hashlib.blake2b(f.read(min(offset, size))).hexdigest()
+
+
+def load_state():
+    """
+    Load the saved aggregates and the offset of the last aggregated track
+
+    Returns:
+        CollectionStats: Saved aggregates
+        int: Byte offset in the all features file after the last aggregated track
+    """
+
+    if not os.path.exists(COLLECTION_STATS_STATE_PATH):
+        return CollectionStats(), 0
+    with open(COLLECTION_STATS_STATE_PATH, "rb") as f:
+        state = pickle.load(f)
+
+    # Start over if the features file was rewritten since the last update
+    if (
+        not os.path.exists(ALL_FEATURES_PATH)
+        or os.path.getsize(ALL_FEATURES_PATH) < state["offset"]
+        or get_tail_digest(ALL_FEATURES_PATH, state["offset"]) != state["digest"]
+    ):
+        return CollectionStats(), 0
+    return state["stats"], state["offset"]
+
+
+def save_results(stats, offset):
+    """
+    Save the aggregates, the JSON report and the genre counts
+
+    Args:
+        stats (CollectionStats): Aggregates to save
+        offset (int): Byte offset after the last aggregated track
+
+    Returns:
+        None
+    """
+
+    state = {
+        "stats": stats,
+        "offset": offset,
+        "digest": get_tail_digest(ALL_FEATURES_PATH, offset),
+    }
+    replace_atomically(COLLECTION_STATS_STATE_PATH, lambda f: pickle.dump(state, f))
+
+    report = json.dumps(stats.to_dict(), indent=2).encode()
+    replace_atomically(COLLECTION_STATS_PATH, lambda f: f.write(report))
+
+    genre_counts = "genre\tcount\n" + "".join(
+        f"{genre}\t{count}\n" for genre, count in stats.genre_counts.most_common()
+    )
+    replace_atomically(GENRE_COUNTS_PATH, lambda f: f.write(genre_counts.encode()))
+
+
+def update_collection_stats(workers=STATS_WORKERS, chunk_size=STATS_CHUNK_SIZE):
+    """
+    Aggregate the tracks extracted since the last update in one chunked pass
+    and save the results. A backlog of several chunks is aggregated in
+    parallel worker processes, while the few tracks of an ingest are
+    aggregated in this process.
+
+    Args:
+        workers (int): Number of worker processes
+        chunk_size (int): Number of tracks per chunk
+
+    Returns:
+        CollectionStats: Aggregates over the whole collection
+    """
+
+    stats, offset = load_state()
+    if not os.path.exists(ALL_FEATURES_PATH):
+        return stats
+
+    chunks = iter_pickled(ALL_FEATURES_PATH, chunk_size, offset)
+    first = list(itertools.islice(chunks, 2))
+    if len(first) < 2:
+        # Starting the workers costs more than aggregating a single chunk
+        for chunk, chunk_end in first:
+            stats.update(chunk)
+            offset = chunk_end
+        save_results(stats, offset)
+        return stats
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk, chunk_end in itertools.chain(first, chunks):
+            pending.append(executor.submit(aggregate_chunk, chunk))
+
+            # Keep a bounded number of chunks in flight
+            if len(pending) >= 2 * workers:
+                stats.merge(pending.pop(0).result())
+            offset = chunk_end
+        for future in pending:
+            stats.merge(future.result())
+
+    save_results(stats, offset)
+    return stats
+
+
+if __name__ == "__main__":
+    update_collection_stats()
@@ -4,6 +4,9 @@ WEIGHTS_DIR_PATH = "./weights"
 METADATA_DIR_PATH = "./metadata"
 RESULTS_DIR_PATH = "./results"
 PLAYLISTS_DIR_PATH = "./playlists"
+STORE_DIR_PATH = "./features/store"
+SHARDS_DIR_PATH = "./features/shards"
+PREVIEW_DIR_PATH = "./features/previews"
 
 # File Paths
 DATA_PATH = "./MusAV"
@@ -12,9 +15,28 @@ MSD_EMBEDDINGS_PATH = "./features/msd_embeddings.pkl"
 GENRE_DISCOGS_PATH = "./features/genre_discogs.pkl"
 ALL_FEATURES_PATH = "./features/all_features.pkl"
 FILE_PATHS_PATH = "./features/file_paths.pkl"
+ARCHIVE_PATH = "./features/features.archive"
+
+# Index Paths
+DISCOGS_VECTORS_PATH = "./features/discogs_vectors.npy"
+MSD_VECTORS_PATH = "./features/msd_vectors.npy"
+DISCOGS_PQ_INDEX_PATH = "./features/discogs_pq.npz"
+MSD_PQ_INDEX_PATH = "./features/msd_pq.npz"
+SNAPSHOT_PATH = "./features/snapshot.pkl"
+DUPLICATES_PATH = "./features/duplicates.json"
+STORE_LOCK_PATH = "./features/store.lock"
+SHARDS_DB_PATH = "./features/shards/coordinator.db"
 
 # Result Paths
 GENRE_COUNTS_PATH = "./results/all_styles.tsv"
+COLLECTION_STATS_PATH = "./results/collection_stats.json"
+COLLECTION_STATS_STATE_PATH = "./results/collection_stats.pkl"
+FAILURES_LOG_PATH = "./results/failures.tsv"
+TF_PROFILE_PATH = "./results/tf_profile.json"
+MEMORY_REPORT_PATH = "./results/memory_report.json"
+
+# Cache Paths
+EMBEDDING_CACHE_PATH = "./features/embedding_cache.sqlite"
 
 # Playlist Paths
 DESCRIPTOR_PLAYLIST_PATH = "./playlists/descriptor_playlist.m3u8"
@@ -31,3 +53,121 @@ AROUSAL_MUSICNN_MODEL_PATH = "./weights/emomusic-msd-musicnn-2.pb"
 # Metadata paths
 DISCOGS_EMBEDDINGS_METADATA_PATH = "./metadata/discogs-effnet-bs64-1.json"
 MSD_EMBEDDINGS_METADATA_PATH = "./metadata/msd-musicnn-1.json"
+
+# Product quantisation
+# Bytes per code for each embedding, must divide the embedding dimension
+PQ_SUBVECTORS = {"discogs": 32, "msd": 8}
+PQ_CENTROIDS = 256
+PQ_TRAIN_SAMPLE = 50000
+PQ_KMEANS_ITERATIONS = 20
+PQ_RERANK_CANDIDATES = 100
+
+# Genre activation bitmap index
+GENRE_BITMAP_BINS = 20
+
+# Collection statistics
+STATS_CHUNK_SIZE = 10000
+STATS_WORKERS = 4
+
+# Audio file discovery
+AUDIO_EXTENSIONS = [".mp3"]
+DISCOVERY_WORKERS = 16
+
+# Analysis policy for tempo, key and embeddings: "full" track, "middle"
+# excerpt, or up to ANALYSIS_WINDOWS "windows" exiting once two agree
+ANALYSIS_POLICY = "full"
+ANALYSIS_SECONDS = 30
+ANALYSIS_WINDOWS = 3
+TEMPO_AGREEMENT_BPM = 2
+
+# Precomputed neighbour tables, k covers the longest playlist plus the
+# duplicate search margin
+KNN_K = 128
+KNN_TILE = 256
+KNN_THREADS = 4
+
+# Target point search over the descriptors
+KDTREE_LEAF_SIZE = 32
+
+# Streaming mini-batch k-means for cluster playlists, over the embeddings
+# or the genre activations
+CLUSTER_SOURCES = ["discogs", "genres"]
+CLUSTER_COUNT = 256
+CLUSTER_BATCH_SIZE = 4096
+CLUSTER_EPOCHS = 3
+CLUSTER_CHUNK_SIZE = 16384
+
+# Playlist query results cached by the apps, per feature store version
+QUERY_CACHE_MAX_ENTRIES = 1024
+
+# Compressed feature archive, codecs fall back to zlib when zstandard or lz4
+# is not installed
+ARCHIVE_CODEC = "zstd"
+ARCHIVE_LEVEL = 3
+ARCHIVE_CHUNK_ROWS = 4096
+ARCHIVE_VECTOR_DTYPE = "float16"
+
+# Result tables and audio previews rendered per page in the apps
+RESULTS_PAGE_SIZE = 50
+PREVIEWS_PAGE_SIZE = 10
+
+# Duplicate detection
+DEDUP_EMBEDDINGS = ["discogs", "msd"]
+DEDUP_TABLES = 8
+DEDUP_BITS = 16
+DEDUP_THRESHOLD = 0.98
+DEDUP_SEARCH_MARGIN = 20
+
+# Feature writer
+FEATURE_WRITE_BATCH_SIZE = 32
+FEATURE_FSYNC = True
+
+# Model output cache
+EMBEDDING_CACHE_ENABLED = True
+EMBEDDING_CACHE_MAX_MB = 2048
+
+# Extraction workers, and threads for the DSP descriptors within a track
+EXTRACTION_WORKERS = 1
+TRACK_TIMEOUT = 600
+WORKER_SETUP_TIMEOUT = 600
+WORKER_MEMORY_LIMIT_MB = 8192
+INTRA_TRACK_THREADS = 1
+
+# Sharded extraction, leases expire when a worker stops renewing them
+SHARD_COUNT = 256
+SHARD_LEASE_SECONDS = 120
+SHARD_HEARTBEAT_SECONDS = 30
+
+# Preview clips served by the playlist apps
+PREVIEW_SECONDS = 30
+PREVIEW_BITRATE = 64
+PREVIEW_SAMPLE_RATE = 22050
+PREVIEW_CACHE_MAX_MB = 512
+
+# Collection watcher, seconds a file must be unchanged before it is extracted
+WATCH_DEBOUNCE = 5
+WATCH_POLL_INTERVAL = 30
+WATCH_BATCH_SIZE = 64
+WATCH_WORKERS = 1
+
+# TensorFlow inference settings, replaced by the profile written by
+# `autotune.py`. 0 threads leaves the thread pools to TensorFlow
+TF_INTRA_OP_THREADS = 0
+TF_INTER_OP_THREADS = 0
+TF_BATCH_SIZE = 64
+AUTOTUNE_SECONDS = 30
+AUTOTUNE_TRACKS = 4
+AUTOTUNE_BATCH_SIZES = [16, 64, 256]
+AUTOTUNE_INTER_OP_THREADS = [1, 2]
+
+# Memory soak benchmark and allocation profile of the extraction on
+# synthetic tracks, failing above the peak RSS or leak thresholds
+MEMORY_SOAK_TRACKS = 2000
+MEMORY_PROFILE_TRACKS = 20
+MEMORY_WARMUP_TRACKS = 10
+MEMORY_TRACK_SECONDS = 30
+MEMORY_SAMPLE_INTERVAL = 0.01
+MEMORY_TOP_ALLOCATIONS = 15
+MEMORY_TRACE_FRAMES = 16
+MEMORY_MAX_PEAK_RSS_MB = 4096
+MEMORY_MAX_LEAK_KB_PER_TRACK = 64
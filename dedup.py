@@ -0,0 +1,241 @@
+import json
+import os
+import numpy as np
+from fileio import get_saved_file_paths, replace_atomically
+from store import get_shared_embeddings
+from quantization import normalize_rows
+from config import (
+    DUPLICATES_PATH,
+    DEDUP_EMBEDDINGS,
+    DEDUP_TABLES,
+    DEDUP_BITS,
+    DEDUP_THRESHOLD,
+)
+
+# Number of rows hashed or compared at once
+BLOCK_SIZE = 4096
+
+
+def get_signatures(embeddings, n_tables, n_bits, seed=0):
+    """
+    Random hyperplane signatures of every vector, one integer per hash table.
+    Vectors with a small angle between them fall on the same side of most
+    hyperplanes, so they likely share a signature in at least one table.
+
+    Args:
+        embeddings (np array): Vectors of shape (N, D)
+        n_tables (int): Number of hash tables
+        n_bits (int): Number of hyperplanes per table, at most 63
+        seed (int): Seed for the hyperplanes
+
+    Returns:
+        np array : int64 signatures of shape (N, n_tables)
+    """
+
+    rng = np.random.default_rng(seed)
+    planes = rng.standard_normal((embeddings.shape[1], n_tables * n_bits))
+    planes = planes.astype(np.float32)
+    powers = 2 ** np.arange(n_bits, dtype=np.int64)
+
+    signatures = np.zeros((len(embeddings), n_tables), dtype=np.int64)
+    for start in range(0, len(embeddings), BLOCK_SIZE):
+        block = np.asarray(embeddings[start : start + BLOCK_SIZE], dtype=np.float32)
+        bits = (block @ planes > 0).reshape(len(block), n_tables, n_bits)
+        signatures[start : start + BLOCK_SIZE] = bits @ powers
+    return signatures
+
+
+def get_buckets(signatures):
+    """
+    Group the rows sharing a signature in each hash table
+
+    Args:
+        signatures (np array): Signatures of shape (N, n_tables)
+
+    Yields:
+        np array : Sorted row indexes of a bucket with at least two rows
+    """
+
+    for table in range(signatures.shape[1]):
+        keys = signatures[:, table]
+        order = np.argsort(keys, kind="stable")
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        for bucket in np.split(order, boundaries):
+            if len(bucket) > 1:
+                yield np.sort(bucket)
+
+
+class UnionFind:
+    def __init__(self):
+        """
+        Disjoint sets of row indexes, with the smallest index as the root.
+        """
+        self.parents = {}
+
+    def find(self, i):
+        """
+        Find the root of the set of a row.
+
+        Args:
+            i (int): Row index
+
+        Returns:
+            int: Root row index
+        """
+        root = i
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        while i != root:
+            self.parents[i], i = root, self.parents.get(i, i)
+        return root
+
+    def union(self, i, j):
+        """
+        Merge the sets of two rows.
+
+        Args:
+            i (int): Row index
+            j (int): Row index
+
+        Returns:
+            None
+        """
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parents[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def confirm_bucket(bucket, embeddings_list, threshold, union_find):
+    """
+    Join the rows of a bucket whose exact cosine similarity is above the
+    threshold in every embedding
+
+    Args:
+        bucket (np array): Sorted row indexes
+        embeddings_list (list): Embedding matrices to compare
+        threshold (float): Minimum cosine similarity
+        union_find (UnionFind): Sets of duplicates to update
+
+    Returns:
+        None
+    """
+
+    vectors = [normalize_rows(embeddings[bucket]) for embeddings in embeddings_list]
+    for start in range(0, len(bucket), BLOCK_SIZE):
+        duplicate = np.ones((min(BLOCK_SIZE, len(bucket) - start), len(bucket)), bool)
+        for normalized in vectors:
+            duplicate &= normalized[start : start + BLOCK_SIZE] @ normalized.T >= threshold
+
+        rows, columns = np.nonzero(duplicate)
+        for row, column in zip(rows + start, columns):
+            if row < column:
+                union_find.union(int(bucket[row]), int(bucket[column]))
+
+
+def find_duplicates(
+    embedding_names=DEDUP_EMBEDDINGS,
+    n_tables=DEDUP_TABLES,
+    n_bits=DEDUP_BITS,
+    threshold=DEDUP_THRESHOLD,
+):
+    """
+    Find clusters of duplicate tracks. Candidates come from LSH buckets over
+    the first embedding and are confirmed with exact cosine in all embeddings.
+
+    Args:
+        embedding_names (list): Names of the embeddings to compare
+        n_tables (int): Number of hash tables
+        n_bits (int): Number of hyperplanes per table
+        threshold (float): Minimum cosine similarity of duplicates
+
+    Returns:
+        dict: Row index of every duplicate mapped to the first row of its cluster
+    """
+
+    embeddings_list = [get_shared_embeddings(name) for name in embedding_names]
+    signatures = get_signatures(embeddings_list[0], n_tables, n_bits)
+
+    union_find = UnionFind()
+    for bucket in get_buckets(signatures):
+        confirm_bucket(bucket, embeddings_list, threshold, union_find)
+
+    return {
+        i: union_find.find(i) for i in union_find.parents if union_find.find(i) != i
+    }
+
+
+def build_duplicate_map():
+    """
+    Find the duplicate tracks and save them as a map from path to the path
+    of the first track of its cluster
+
+    Returns:
+        dict: Duplicate map
+    """
+
+    file_paths = get_saved_file_paths()
+    duplicate_map = {
+        file_paths[i]: file_paths[root] for i, root in find_duplicates().items()
+    }
+    data = json.dumps(duplicate_map, indent=2).encode()
+    replace_atomically(DUPLICATES_PATH, lambda f: f.write(data))
+    return duplicate_map
+
+
+def get_duplicate_map_version():
+    """
+    Return the version of the saved duplicate map, which changes every time
+    `build_duplicate_map` saves it
+
+    Returns:
+        int: Modification time in nanoseconds, None if it has not been built
+    """
+
+    if not os.path.exists(DUPLICATES_PATH):
+        return None
+    return os.stat(DUPLICATES_PATH).st_mtime_ns
+
+
+def load_duplicate_map():
+    """
+    Load the duplicate map built by `build_duplicate_map`
+
+    Returns:
+        dict: Duplicate map, empty if it has not been built
+    """
+
+    if not os.path.exists(DUPLICATES_PATH):
+        return {}
+    with open(DUPLICATES_PATH) as f:
+        return json.load(f)
+
+
+def collapse_duplicates(tracks, duplicate_map, exclude=None):
+    """
+    Keep only the first track of every duplicate cluster, preserving the order
+
+    Args:
+        tracks (list): Track paths
+        duplicate_map (dict): Duplicate map
+        exclude (str): Track whose duplicates are also removed, such as a query track
+
+    Returns:
+        list: Track paths without duplicates
+    """
+
+    seen = set()
+    if exclude is not None:
+        seen.add(duplicate_map.get(exclude, exclude))
+
+    collapsed = []
+    for track in tracks:
+        cluster = duplicate_map.get(track, track)
+        if cluster not in seen:
+            seen.add(cluster)
+            collapsed.append(track)
+    return collapsed
+
+
+if __name__ == "__main__":
+    duplicates = build_duplicate_map()
+    print(f"Found {len(duplicates)} duplicate tracks.")
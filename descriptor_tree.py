@@ -0,0 +1,188 @@
+import heapq
+import numpy as np
+from config import KDTREE_LEAF_SIZE
+
+# Descriptors of the target point queries
+TREE_COLUMNS = [
+    "arousal",
+    "valence",
+    "tempo",
+    "danceability_probability",
+    "instrumental_probability",
+    "loudness",
+]
+
+
+class DescriptorTree:
+    def __init__(self, points, leaf_size=KDTREE_LEAF_SIZE):
+        """
+        KD-tree answering k nearest neighbour and radius queries in
+        logarithmic time. Each query can weight the dimensions, so a target
+        on a subset of the descriptors ignores the others.
+
+        Args:
+            points (np array): Normalised points of shape (N, D)
+            leaf_size (int): Maximum number of points in a leaf
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.order = np.arange(len(self.points))
+        self.starts, self.ends, self.children = [], [], []
+        self.lows, self.highs = [], []
+
+        # Split on the dimension with the largest spread at the median point
+        stack = [(0, len(self.points), None, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(self.starts)
+            if parent is not None:
+                self.children[parent][side] = node
+
+            node_points = self.points[self.order[start:end]]
+            self.starts.append(start)
+            self.ends.append(end)
+            self.lows.append(node_points.min(axis=0, initial=np.inf))
+            self.highs.append(node_points.max(axis=0, initial=-np.inf))
+            if end - start <= leaf_size:
+                self.children.append(None)
+                continue
+
+            dim = int(np.argmax(self.highs[node] - self.lows[node]))
+            mid = (start + end) // 2
+            split = np.argpartition(node_points[:, dim], mid - start)
+            self.order[start:end] = self.order[start:end][split]
+            self.children.append([None, None])
+            stack.append((mid, end, node, 1))
+            stack.append((start, mid, node, 0))
+
+        self.lows = np.array(self.lows)
+        self.highs = np.array(self.highs)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _box_distance(self, node, target, weights):
+        """
+        Squared weighted distance from the target to the bounding box of a node.
+
+        Args:
+            node (int): Node id
+            target (np array): Query point
+            weights (np array): Weight of each dimension
+
+        Returns:
+            float: Lower bound of the distance to any point in the node
+        """
+        gap = np.maximum(self.lows[node] - target, 0) + np.maximum(
+            target - self.highs[node], 0
+        )
+        return float(np.dot(weights, gap**2))
+
+    def query(self, target, k=0, radius=np.inf, weights=None, mask=None):
+        """
+        Find the points closest to a target, visiting nodes in order of their
+        distance and pruning the nodes that cannot hold a closer point.
+
+        Args:
+            target (np array): Normalised query point of shape (D,)
+            k (int): Maximum number of points, 0 for no limit
+            radius (float): Maximum distance
+            weights (np array): Weight of each dimension, None for equal weights
+            mask (np array): Boolean mask of the points that can be returned
+
+        Returns:
+            np array : Indexes of the points, closest first
+            np array : Distances of the points
+        """
+        target = np.asarray(target, dtype=np.float64)
+        weights = np.ones(len(target)) if weights is None else np.asarray(weights)
+        limit = radius**2
+
+        # Max-heap of the best points as (-distance, index)
+        best = []
+        nodes = [(self._box_distance(0, target, weights), 0)] if len(self) else []
+        while nodes:
+            distance, node = heapq.heappop(nodes)
+            bound = -best[0][0] if k and len(best) == k else limit
+            if distance > bound:
+                break
+
+            if self.children[node] is not None:
+                for child in self.children[node]:
+                    child_distance = self._box_distance(child, target, weights)
+                    if child_distance <= bound:
+                        heapq.heappush(nodes, (child_distance, child))
+                continue
+
+            indexes = self.order[self.starts[node] : self.ends[node]]
+            if mask is not None:
+                indexes = indexes[mask[indexes]]
+            distances = ((self.points[indexes] - target) ** 2) @ weights
+            for index, point_distance in zip(indexes, distances):
+                if point_distance > limit:
+                    continue
+                if not k or len(best) < k:
+                    heapq.heappush(best, (-point_distance, int(index)))
+                elif point_distance < -best[0][0]:
+                    heapq.heapreplace(best, (-point_distance, int(index)))
+
+        best.sort(reverse=True)
+        indexes = np.array([index for _, index in best], dtype=np.int64)
+        distances = np.sqrt(np.array([-distance for distance, _ in best]))
+        return indexes, distances
+
+
+def get_descriptor_points(all_features_df):
+    """
+    Standardise the tree descriptors of every track to zero mean and unit
+    variance, so every descriptor contributes on the same scale
+
+    Args:
+        all_features_df (pd.DataFrame): DataFrame with all features
+
+    Returns:
+        np array : Normalised points of shape (N, len(TREE_COLUMNS))
+        np array : Mean of each descriptor
+        np array : Standard deviation of each descriptor
+    """
+
+    values = all_features_df[TREE_COLUMNS].to_numpy(dtype=np.float64)
+    mean = values.mean(axis=0) if len(values) else np.zeros(len(TREE_COLUMNS))
+    std = values.std(axis=0) if len(values) else np.ones(len(TREE_COLUMNS))
+    std[std == 0] = 1
+    return (values - mean) / std, mean, std
+
+
+class DescriptorIndex:
+    def __init__(self, all_features_df):
+        """
+        Target point search over the descriptors of the tracks.
+
+        Args:
+            all_features_df (pd.DataFrame): DataFrame with all features
+        """
+        self.tracks = all_features_df.index
+        points, self.mean, self.std = get_descriptor_points(all_features_df)
+        self.tree = DescriptorTree(points)
+
+    def query(self, target, k=0, radius=np.inf, tracks=None):
+        """
+        Find the tracks closest to target values of some descriptors.
+
+        Args:
+            target (dict): Target value of each descriptor in TREE_COLUMNS to use
+            k (int): Maximum number of tracks, 0 for no limit
+            radius (float): Maximum distance in standard deviations
+            tracks (list): Tracks that can be returned, None for all
+
+        Returns:
+            list: Tracks, closest first
+        """
+        weights = np.array([column in target for column in TREE_COLUMNS], dtype=float)
+        point = np.array([target.get(column, 0.0) for column in TREE_COLUMNS])
+        point = np.where(weights > 0, (point - self.mean) / self.std, 0)
+
+        mask = None
+        if tracks is not None:
+            mask = self.tracks.isin(tracks)
+        indexes, _ = self.tree.query(point, k, radius, weights, mask)
+        return list(self.tracks[indexes])
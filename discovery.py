@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import DATA_PATH, AUDIO_EXTENSIONS, DISCOVERY_WORKERS
+
+
+def scan_directory(directory, extensions):
+    """
+    List the audio files and subdirectories of one directory
+
+    Args:
+        directory (str): Directory path
+        extensions (set): Lowercase audio file extensions, such as ".mp3"
+
+    Returns:
+        list: (path, size in bytes) of the audio files
+        list: Paths of the subdirectories
+    """
+
+    files, subdirectories = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions:
+                        if entry.is_file():
+                            path = os.path.normpath(entry.path)
+                            files.append((path, entry.stat().st_size))
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"Error scanning {directory}: {str(e)}")
+    return files, subdirectories
+
+
+def discover_audio_files(
+    root=DATA_PATH,
+    extensions=AUDIO_EXTENSIONS,
+    workers=DISCOVERY_WORKERS,
+    longest_first=True,
+):
+    """
+    Find all audio files under a directory, scanning directories concurrently
+
+    Args:
+        root (str): Root directory of the collection
+        extensions (list): Audio file extensions to include, such as ".mp3"
+        workers (int): Number of directories scanned at the same time
+        longest_first (bool): Order by decreasing file size, as a proxy for
+            duration, so long tracks do not finish last in parallel runs.
+            Otherwise order by path.
+
+    Returns:
+        list: Paths of the audio files
+    """
+
+    extensions = {extension.lower() for extension in extensions}
+    files = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, root, extensions)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirectories = future.result()
+                files.extend(found)
+                pending |= {
+                    executor.submit(scan_directory, subdirectory, extensions)
+                    for subdirectory in subdirectories
+                }
+
+    if longest_first:
+        files.sort(key=lambda file: (-file[1], file[0]))
+    else:
+        files.sort()
+    return [path for path, _ in files]
@@ -0,0 +1,221 @@
+import hashlib
+import pickle
+import sqlite3
+import time
+from config import (
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_MB,
+    TEMPOCNN_MODEL_PATH,
+    DISCOGS_EMBEDDINGS_MODEL_PATH,
+    MSD_EMBEDDINGS_MODEL_PATH,
+    GENRE_DISCOGS_MODEL_PATH,
+    VOICE_DISCOGS_MODEL_PATH,
+    DANCEABILITY_DISCOGS_MODEL_PATH,
+    AROUSAL_MUSICNN_MODEL_PATH,
+)
+
+MODEL_PATHS = [
+    TEMPOCNN_MODEL_PATH,
+    DISCOGS_EMBEDDINGS_MODEL_PATH,
+    MSD_EMBEDDINGS_MODEL_PATH,
+    GENRE_DISCOGS_MODEL_PATH,
+    VOICE_DISCOGS_MODEL_PATH,
+    DANCEABILITY_DISCOGS_MODEL_PATH,
+    AROUSAL_MUSICNN_MODEL_PATH,
+]
+
+# Bytes read at once when hashing files
+HASH_BLOCK_SIZE = 2**20
+
+
+def hash_file(file_path, start=0, end=None):
+    """
+    Hash a byte range of a file
+
+    Args:
+        file_path (str): Path to the file
+        start (int): First byte to hash
+        end (int): Byte after the last one to hash, None for the end of the file
+
+    Returns:
+        str: Hex digest
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = HASH_BLOCK_SIZE if remaining is None else min(HASH_BLOCK_SIZE, remaining)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+def get_audio_range(audio_path):
+    """
+    Byte range of an MP3 file without its ID3v2 header and ID3v1 trailer, so
+    retagged copies of the same audio have the same content hash
+
+    Args:
+        audio_path (str): Path to the audio file
+
+    Returns:
+        int: First byte of the audio data
+        int: Byte after the last byte of the audio data
+    """
+
+    with open(audio_path, "rb") as f:
+        header = f.read(10)
+        f.seek(0, 2)
+        end = f.tell()
+        if end >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b"TAG":
+                end -= 128
+
+    start = 0
+    if len(header) == 10 and header[:3] == b"ID3":
+        # Tag size is a 28 bit syncsafe integer, plus a footer if flagged
+        size = (
+            (header[6] & 0x7F) << 21
+            | (header[7] & 0x7F) << 14
+            | (header[8] & 0x7F) << 7
+            | (header[9] & 0x7F)
+        )
+        start = 10 + size + (10 if header[5] & 0x10 else 0)
+    return min(start, end), end
+
+
+def get_content_hash(audio_path):
+    """
+    Hash of the audio data of a file, independent of its path and tags
+
+    Args:
+        audio_path (str): Path to the audio file
+
+    Returns:
+        str: Hex digest
+    """
+
+    start, end = get_audio_range(audio_path)
+    return hash_file(audio_path, start, end)
+
+
+def get_model_version(extra=""):
+    """
+    Hash of all model graph files, so cached outputs are invalidated when a
+    model changes
+
+    Args:
+        extra (str): Other settings that change the outputs
+
+    Returns:
+        str: Hex digest
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    for model_path in MODEL_PATHS:
+        digest.update(hash_file(model_path).encode())
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_path=EMBEDDING_CACHE_PATH, max_mb=EMBEDDING_CACHE_MAX_MB):
+        """
+        Persistent cache of per-track model outputs in SQLite, bounded in size
+        with least recently used eviction. Safe to share between processes.
+
+        Args:
+            cache_path (str): Path to the SQLite database
+            max_mb (float): Maximum total size of the cached values in MB
+        """
+        self.max_bytes = int(max_mb * 2**20)
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        """
+        Return the cached value of a key and mark it as recently used.
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            object: Cached value, None on a miss
+        """
+        row = self.connection.execute(
+            "SELECT value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Store a value and evict the least recently used entries over the size limit.
+
+        Args:
+            key (str): Cache key
+            value (object): Picklable value
+
+        Returns:
+            None
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache fits its limit.
+
+        Returns:
+            None
+        """
+        (total,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+
+        keys = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM entries ORDER BY last_access"
+        ):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+
+    def close(self):
+        """
+        Close the database connection.
+
+        Returns:
+            None
+        """
+        self.connection.close()
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from fileio import get_genre_names
+
+# Shared dictionaries for the categorical descriptors
+TONICS = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+SCALES = ["major", "minor"]
+KEY_NAMES = [f"{tonic} {scale}" for tonic in TONICS for scale in SCALES]
+GENRE_NAMES = get_genre_names()
+
+
+def encode(values, dictionary):
+    """
+    Encode strings as a categorical with a fixed dictionary. Codes are stored
+    as int8 for up to 126 entries and int16 above, with -1 for missing values.
+    Values outside the dictionary are added after it, so they are kept and
+    the codes of the dictionary stay the same.
+
+    Args:
+        values (iterable): Strings to encode
+        dictionary (list): Shared dictionary of all possible values
+
+    Returns:
+        pd.Categorical: Encoded values
+    """
+
+    values = pd.Series(list(values), dtype=object)
+    known = set(dictionary)
+    unknown = [value for value in values.dropna().unique() if value not in known]
+    return pd.Categorical(values, categories=list(dictionary) + unknown)
+
+
+def decode(categorical):
+    """
+    Restore the strings of encoded values
+
+    Args:
+        categorical (pd.Categorical or pd.Series): Encoded values
+
+    Returns:
+        list: Strings, None for missing values
+    """
+
+    values = np.asarray(categorical, dtype=object)
+    return [None if pd.isna(value) else value for value in values]
+
+
+def encode_keys(values):
+    """
+    Encode key strings such as "C# minor" with the 24 key dictionary
+
+    Args:
+        values (iterable): Key strings
+
+    Returns:
+        pd.Categorical: Encoded keys, code = tonic index * 2 + scale index
+    """
+
+    return encode(values, KEY_NAMES)
+
+
+def encode_genres(values):
+    """
+    Encode genre strings such as "Electronic---Techno" with the 400 Discogs classes
+
+    Args:
+        values (iterable): Genre strings
+
+    Returns:
+        pd.Categorical: Encoded genres
+    """
+
+    return encode(values, GENRE_NAMES)
+
+
+def lookup_table(selected, dictionary):
+    """
+    Boolean lookup table marking the selected entries of a dictionary. It has
+    one extra False entry at the end, which `filter_codes` uses for missing
+    values and values outside the dictionary.
+
+    Args:
+        selected (iterable): Selected values
+        dictionary (list): Shared dictionary of all possible values
+
+    Returns:
+        np array : Boolean array of length len(dictionary) + 1
+    """
+
+    table = np.zeros(len(dictionary) + 1, dtype=bool)
+    table[pd.Index(dictionary).get_indexer(list(selected))] = True
+    table[-1] = False
+    return table
+
+
+def key_lookup_table(tonics, scales):
+    """
+    Boolean lookup table over the 24 key codes for a tonic and scale selection.
+    An empty selection does not filter on that part of the key.
+
+    Args:
+        tonics (list): Selected tonics such as "C#", empty for all
+        scales (list): Selected scales "major" or "minor", empty for all
+
+    Returns:
+        np array : Boolean array of length 25
+    """
+
+    tonics = tonics or TONICS
+    scales = scales or SCALES
+    return lookup_table(
+        [f"{tonic} {scale}" for tonic in tonics for scale in scales], KEY_NAMES
+    )
+
+
+def filter_codes(categorical, table):
+    """
+    Mask of the values of a categorical Series whose code is in a lookup table
+
+    Args:
+        categorical (pd.Series): Series with a categorical dtype
+        table (np array): Lookup table from `lookup_table`
+
+    Returns:
+        np array : Boolean mask
+    """
+
+    codes = categorical.cat.codes.to_numpy()
+    return table[np.minimum(codes, len(table) - 1)]
@@ -0,0 +1,93 @@
+import essentia
+from audio import load_audio
+from embedding_cache import EmbeddingCache, get_content_hash, get_model_version
+from features import (
+    get_audio_features,
+    get_embeddings,
+    get_genre_distribution,
+    get_embeddings_features,
+)
+from config import (
+    EMBEDDING_CACHE_ENABLED,
+    ANALYSIS_POLICY,
+    ANALYSIS_SECONDS,
+    ANALYSIS_WINDOWS,
+    TEMPO_AGREEMENT_BPM,
+)
+
+# Deactivate the warnings
+essentia.log.warningActive = False
+
+# Cache of model outputs keyed by audio content, model version and the
+# analysis policy, which also changes the outputs
+if EMBEDDING_CACHE_ENABLED:
+    cache = EmbeddingCache()
+    model_version = get_model_version(
+        f"{ANALYSIS_POLICY}:{ANALYSIS_SECONDS}:{ANALYSIS_WINDOWS}:{TEMPO_AGREEMENT_BPM}"
+    )
+
+
+def extract_track(audio_path, on_stage=None):
+    """
+    Extract all features of one audio file, reusing the cached outputs of
+    files with the same audio content
+
+    Args:
+        audio_path (str): Path to the audio file
+        on_stage (callable): Called with the name of each stage before it starts
+
+    Returns:
+        dict : Mean Discogs and MSD embeddings, genre activations and all features
+    """
+
+    def stage(name):
+        if on_stage is not None:
+            on_stage(name)
+
+    if EMBEDDING_CACHE_ENABLED:
+        stage("cache")
+        cache_key = f"{model_version}:{get_content_hash(audio_path)}"
+        features = cache.get(cache_key)
+        if features is not None:
+            return features
+
+    features = compute_track_features(audio_path, stage)
+    if EMBEDDING_CACHE_ENABLED:
+        cache.put(cache_key, features)
+    return features
+
+
+def compute_track_features(audio_path, stage):
+    """
+    Run the audio analysis and the models on one audio file
+
+    Args:
+        audio_path (str): Path to the audio file
+        stage (callable): Called with the name of each stage before it starts
+
+    Returns:
+        dict : Mean Discogs and MSD embeddings, genre activations and all features
+    """
+
+    # Load audio as stereo, mono, resampled 16kHz and resampled 11kHz
+    stage("load")
+    stereo, mono, resampled_16k, resampled_11k = load_audio(audio_path)
+
+    # Get features
+    stage("audio_features")
+    audio_features = get_audio_features(stereo, mono, resampled_11k)
+    stage("embeddings")
+    discogs_embeddings, msd_embeddings = get_embeddings(resampled_16k)
+    stage("genre")
+    genre_activations, genre_feature = get_genre_distribution(discogs_embeddings)
+    stage("embeddings_features")
+    embeddings_features = get_embeddings_features(discogs_embeddings, msd_embeddings)
+    all_features = audio_features | genre_feature | embeddings_features
+
+    # Compute average embeddings before saving
+    return {
+        "discogs_embeddings": discogs_embeddings.mean(axis=0),
+        "msd_embeddings": msd_embeddings.mean(axis=0),
+        "genre_activations": genre_activations,
+        "all_features": all_features,
+    }
@@ -1,5 +1,14 @@
+import threading
 import essentia.standard as estd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from segments import (
+    get_segments,
+    analyse_segments,
+    most_common,
+    tempo_agrees,
+    median_tempo,
+)
 from config import (
     TEMPOCNN_MODEL_PATH,
     DISCOGS_EMBEDDINGS_MODEL_PATH,
@@ -8,43 +17,100 @@ from config import (
     VOICE_DISCOGS_MODEL_PATH,
     DANCEABILITY_DISCOGS_MODEL_PATH,
     AROUSAL_MUSICNN_MODEL_PATH,
+    INTRA_TRACK_THREADS,
 )
 from fileio import get_genre_names
-
-# Create instances of the algorithms
-tempo_model = estd.TempoCNN(graphFilename=TEMPOCNN_MODEL_PATH)
-key_temperley_model = estd.KeyExtractor(profileType="temperley")
-key_krumhansl_model = estd.KeyExtractor(profileType="krumhansl")
-key_edma_model = estd.KeyExtractor(profileType="edma")
-loudness_model = estd.LoudnessEBUR128()
+from autotune import get_profile
+
+# Factories of the DSP algorithms, instantiated once per thread because
+# algorithm instances cannot be shared between threads
+dsp_algorithms = {
+    "tempo": lambda: estd.TempoCNN(graphFilename=TEMPOCNN_MODEL_PATH),
+    "key_temperley": lambda: estd.KeyExtractor(profileType="temperley"),
+    "key_krumhansl": lambda: estd.KeyExtractor(profileType="krumhansl"),
+    "key_edma": lambda: estd.KeyExtractor(profileType="edma"),
+    "loudness": lambda: estd.LoudnessEBUR128(),
+}
+thread_local = threading.local()
+
+# Thread pools running the independent DSP descriptors of a track, by size
+dsp_executors = {}
+
+# Create instances of the algorithms. The EffNet graph has a fixed batch of
+# 64, the other models use the batch size of the autotuned profile
+batch_size = get_profile()["batch_size"]
 embeddings_discogs_model = estd.TensorflowPredictEffnetDiscogs(
     graphFilename=DISCOGS_EMBEDDINGS_MODEL_PATH, output="PartitionedCall:1"
 )
 embeddings_msd_model = estd.TensorflowPredictMusiCNN(
-    graphFilename=MSD_EMBEDDINGS_MODEL_PATH, output="model/dense/BiasAdd"
+    graphFilename=MSD_EMBEDDINGS_MODEL_PATH,
+    output="model/dense/BiasAdd",
+    batchSize=batch_size,
 )
 genre_model = estd.TensorflowPredict2D(
     graphFilename=GENRE_DISCOGS_MODEL_PATH,
     input="serving_default_model_Placeholder",
     output="PartitionedCall:0",
+    batchSize=batch_size,
 )
 instrumental_model = estd.TensorflowPredict2D(
-    graphFilename=VOICE_DISCOGS_MODEL_PATH, output="model/Softmax"
+    graphFilename=VOICE_DISCOGS_MODEL_PATH,
+    output="model/Softmax",
+    batchSize=batch_size,
 )
 danceability_model = estd.TensorflowPredict2D(
-    graphFilename=DANCEABILITY_DISCOGS_MODEL_PATH, output="model/Softmax"
+    graphFilename=DANCEABILITY_DISCOGS_MODEL_PATH,
+    output="model/Softmax",
+    batchSize=batch_size,
 )
 arousal_valence_model = estd.TensorflowPredict2D(
-    graphFilename=AROUSAL_MUSICNN_MODEL_PATH, output="model/Identity"
+    graphFilename=AROUSAL_MUSICNN_MODEL_PATH,
+    output="model/Identity",
+    batchSize=batch_size,
 )
 
 # Load the genre classes
 genre_classes = get_genre_names()
 
 
+def get_dsp_algorithm(name):
+    """
+    Returns the instance of a DSP algorithm owned by the current thread
+
+    Args:
+        name (str): Name of the algorithm in dsp_algorithms
+
+    Returns:
+        essentia algorithm : Algorithm instance
+    """
+
+    algorithms = thread_local.__dict__.setdefault("algorithms", {})
+    if name not in algorithms:
+        algorithms[name] = dsp_algorithms[name]()
+    return algorithms[name]
+
+
+def get_dsp_executor(threads):
+    """
+    Returns the thread pool for the DSP descriptors, creating it on first use
+
+    Args:
+        threads (int): Number of threads
+
+    Returns:
+        ThreadPoolExecutor : Thread pool
+    """
+
+    if threads not in dsp_executors:
+        dsp_executors[threads] = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="dsp"
+        )
+    return dsp_executors[threads]
+
+
 def get_tempo(resampled_11k_audio):
     """
-    Returns the tempo of the audio
+    Returns the tempo of the audio for the configured analysis policy
 
     Args:
         resampled_11k_audio (np array): Mono audio resampled to 11,025 Hz
@@ -53,13 +119,18 @@ def get_tempo(resampled_11k_audio):
         int : Tempo of the audio in BPM
     """
 
-    global_tempo, _, _ = tempo_model(resampled_11k_audio)
-    return global_tempo
+    def analyse(segment):
+        global_tempo, _, _ = get_dsp_algorithm("tempo")(segment)
+        return global_tempo
+
+    segments = get_segments(resampled_11k_audio, 11025)
+    return analyse_segments(segments, analyse, tempo_agrees, median_tempo)
 
 
 def get_key_temperley(mono_audio):
     """
-    Returns the key of the audio using the temperley model
+    Returns the key of the audio using the temperley model for the configured
+    analysis policy
 
     Args:
         mono_audio (np array): Mono audio with a sample rate of 44,100 Hz
@@ -68,13 +139,18 @@ def get_key_temperley(mono_audio):
         str : Key of the audio
     """
 
-    key, scale, _ = key_temperley_model(mono_audio)
-    return key + " " + scale
+    def analyse(segment):
+        key, scale, _ = get_dsp_algorithm("key_temperley")(segment)
+        return key + " " + scale
+
+    segments = get_segments(mono_audio, 44100)
+    return analyse_segments(segments, analyse, str.__eq__, most_common)
 
 
 def get_key_krumhansl(mono_audio):
     """
-    Returns the key of the audio using the krumhansl model
+    Returns the key of the audio using the krumhansl model for the configured
+    analysis policy
 
     Args:
         mono_audio (np array): Mono audio with a sample rate of 44,100 Hz
@@ -83,13 +159,18 @@ def get_key_krumhansl(mono_audio):
         str : Key of the audio
     """
 
-    key, scale, _ = key_krumhansl_model(mono_audio)
-    return key + " " + scale
+    def analyse(segment):
+        key, scale, _ = get_dsp_algorithm("key_krumhansl")(segment)
+        return key + " " + scale
+
+    segments = get_segments(mono_audio, 44100)
+    return analyse_segments(segments, analyse, str.__eq__, most_common)
 
 
 def get_key_edma(mono_audio):
     """
-    Returns the key of the audio using the edma model
+    Returns the key of the audio using the edma model for the configured
+    analysis policy
 
     Args:
         mono_audio (np array): Mono audio with a sample rate of 44,100 Hz
@@ -98,8 +179,12 @@ def get_key_edma(mono_audio):
         str : Key of the audio
     """
 
-    key, scale, _ = key_edma_model(mono_audio)
-    return key + " " + scale
+    def analyse(segment):
+        key, scale, _ = get_dsp_algorithm("key_edma")(segment)
+        return key + " " + scale
+
+    segments = get_segments(mono_audio, 44100)
+    return analyse_segments(segments, analyse, str.__eq__, most_common)
 
 
 def get_loudness(stereo_audio):
@@ -113,7 +198,7 @@ def get_loudness(stereo_audio):
         float : Loudness of the audio in LUFS
     """
 
-    _, _, integrated_loudness, _ = loudness_model(stereo_audio)
+    _, _, integrated_loudness, _ = get_dsp_algorithm("loudness")(stereo_audio)
     return integrated_loudness
 
 
@@ -212,36 +297,44 @@ def get_valence_arousal(msd_embeddings):
     return valence, arousal
 
 
-def get_audio_features(stereo_audio, mono_audio, resampled_11k_audio):
+def get_audio_features(
+    stereo_audio, mono_audio, resampled_11k_audio, threads=INTRA_TRACK_THREADS
+):
     """
-    Returns the audio features
+    Returns the audio features. The descriptors are independent, so with more
+    than one thread they run concurrently while Essentia releases the GIL.
 
     Args:
         stereo_audio (np array): Stereo audio with a sample rate of 44,100 Hz
         mono_audio (np array): Mono audio with a sample rate of 44,100 Hz
         resampled_11k_audio (np array): Mono audio resampled to 11,025 Hz
+        threads (int): Number of threads for the descriptors
 
     Returns:
         dict : Audio features
     """
 
-    tempo = get_tempo(resampled_11k_audio)
-    key_temperley = get_key_temperley(mono_audio)
-    key_krumhansl = get_key_krumhansl(mono_audio)
-    key_edma = get_key_edma(mono_audio)
-    loudness = get_loudness(stereo_audio)
-    return {
-        "tempo": tempo,
-        "key_temperley": key_temperley,
-        "key_krumhansl": key_krumhansl,
-        "key_edma": key_edma,
-        "loudness": loudness,
+    descriptors = {
+        "tempo": (get_tempo, resampled_11k_audio),
+        "key_temperley": (get_key_temperley, mono_audio),
+        "key_krumhansl": (get_key_krumhansl, mono_audio),
+        "key_edma": (get_key_edma, mono_audio),
+        "loudness": (get_loudness, stereo_audio),
+    }
+    if threads <= 1:
+        return {name: func(audio) for name, (func, audio) in descriptors.items()}
+
+    executor = get_dsp_executor(threads)
+    futures = {
+        name: executor.submit(func, audio)
+        for name, (func, audio) in descriptors.items()
     }
+    return {name: future.result() for name, future in futures.items()}
 
 
 def get_embeddings(resampled_16k_audio):
     """
-    Returns the embeddings of the audio
+    Returns the embeddings of the audio for the configured analysis policy
 
     Args:
         resampled_16k_audio (np array): Mono audio resampled to 16,000 Hz
@@ -251,8 +344,14 @@ def get_embeddings(resampled_16k_audio):
         np array : MSD embeddings of the audio
     """
 
-    discogs_embeddings = get_discogs_embeddings(resampled_16k_audio)
-    msd_embeddings = get_msd_embeddings(resampled_16k_audio)
+    # Frame-level embeddings of every analysed segment
+    segments = get_segments(resampled_16k_audio, 16000)
+    discogs_embeddings = np.concatenate(
+        [get_discogs_embeddings(segment) for segment in segments]
+    )
+    msd_embeddings = np.concatenate(
+        [get_msd_embeddings(segment) for segment in segments]
+    )
     return discogs_embeddings, msd_embeddings
 
 
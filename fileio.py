@@ -1,6 +1,10 @@
+import fcntl
+import io
 import json
 import pickle
 import os
+from contextlib import contextmanager
+import tempfile
 import numpy as np
 from config import (
     DISCOGS_EMBEDDINGS_PATH,
@@ -14,8 +18,17 @@ from config import (
     METADATA_DIR_PATH,
     RESULTS_DIR_PATH,
     PLAYLISTS_DIR_PATH,
+    FEATURE_WRITE_BATCH_SIZE,
+    FEATURE_FSYNC,
+    STORE_LOCK_PATH,
 )
 
+# Manifest recording the committed rows, next to the feature files
+MANIFEST_FILENAME = "manifest.json"
+
+# Suffix of the rewritten files of a compaction before they are moved into place
+COMPACT_SUFFIX = ".compact"
+
 
 def create_dir_if_not_exist(directory):
     """
@@ -65,75 +78,384 @@ def get_genre_names():
     return load_json(DISCOGS_EMBEDDINGS_METADATA_PATH)["classes"]
 
 
-def open_files():
+def get_feature_paths(directory=None):
     """
-    Open all file objects and return the file objects
+    Return the paths of the five feature files of a feature store
+
+    Args:
+        directory (str): Directory of the feature store, None for the paths in config
 
     Returns:
-        tuple: Tuple of file objects
+        dict: Feature file paths keyed by feature name
     """
 
-    discogs_embeddings_file = open(DISCOGS_EMBEDDINGS_PATH, "wb")
-    msd_embeddings_file = open(MSD_EMBEDDINGS_PATH, "wb")
-    genre_discogs_file = open(GENRE_DISCOGS_PATH, "wb")
-    all_features_file = open(ALL_FEATURES_PATH, "wb")
-    file_paths_file = open(FILE_PATHS_PATH, "wb")
-    return (
-        discogs_embeddings_file,
-        msd_embeddings_file,
-        genre_discogs_file,
-        all_features_file,
-        file_paths_file,
-    )
+    paths = {
+        "discogs_embeddings": DISCOGS_EMBEDDINGS_PATH,
+        "msd_embeddings": MSD_EMBEDDINGS_PATH,
+        "genre_activations": GENRE_DISCOGS_PATH,
+        "all_features": ALL_FEATURES_PATH,
+        "file_paths": FILE_PATHS_PATH,
+    }
+    if directory is None:
+        return paths
+    return {
+        name: os.path.join(directory, os.path.basename(path))
+        for name, path in paths.items()
+    }
+
+
+def get_manifest_path(file_path):
+    """
+    Return the path of the manifest of the feature store containing a file
+
+    Args:
+        file_path (str): Path of a feature file
+
+    Returns:
+        str: Path to the manifest
+    """
+
+    return os.path.join(os.path.dirname(file_path) or ".", MANIFEST_FILENAME)
 
 
-def dump_pickle(file, data):
+def load_manifest(manifest_path):
     """
-    Dump data to pickle file
+    Load the manifest recording the committed rows of a feature store
 
     Args:
-        file (file object): File object to write to
-        data (object): Data to write to file
+        manifest_path (str): Path to the manifest
 
     Returns:
+        dict: Manifest with "version", "rows" and the committed byte "sizes"
+            of each file, or None for stores written without a manifest
+    """
+
+    if not os.path.exists(manifest_path):
+        return None
+    return load_json(manifest_path)
+
+
+def get_committed_size(file_path):
+    """
+    Return the number of committed bytes of a feature file
+
+    Args:
+        file_path (str): Path of a feature file
+
+    Returns:
+        int: Committed bytes, None if the whole file can be read
+    """
+
+    manifest = load_manifest(get_manifest_path(file_path))
+    if manifest is None:
+        return None
+    return manifest["sizes"].get(os.path.basename(file_path))
+
+
+def get_store_version():
+    """
+    Return the version of the feature store, which changes on every commit
+
+    Returns:
+        int: Manifest version, None for stores written without a manifest
+    """
+
+    manifest = load_manifest(get_manifest_path(FILE_PATHS_PATH))
+    if manifest is None:
+        return None
+    return manifest["version"]
+
+
+@contextmanager
+def store_lock(shared=False):
+    """
+    Hold the lock of the feature store. Ingestion holds it exclusively while
+    appending rows and updating the indexes, and readers hold it shared while
+    loading, so they never see the indexes halfway through an update.
+
+    Args:
+        shared (bool): Take a shared lock instead of an exclusive one
+
+    Yields:
         None
     """
 
-    pickle.dump(data, file)
+    with open(STORE_LOCK_PATH, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def close_files(
-    discogs_embeddings_file,
-    msd_embeddings_file,
-    genre_discogs_file,
-    all_features_file,
-    file_paths_file,
-):
+def fsync_directory(directory):
     """
-    Close all file objects
+    Flush a directory entry to disk so renames in it survive a crash
 
     Args:
-        discogs_embeddings_file (file object): File object
-        msd_embeddings_file (file object): File object
-        genre_discogs_file (file object): File object
-        all_features_file (file object): File object
-        file_paths_file (file object): File object
+        directory (str): Directory path
 
     Returns:
         None
     """
 
-    discogs_embeddings_file.close()
-    msd_embeddings_file.close()
-    genre_discogs_file.close()
-    all_features_file.close()
-    file_paths_file.close()
-    return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FeatureWriter:
+    def __init__(
+        self,
+        directory=None,
+        append=False,
+        batch_size=FEATURE_WRITE_BATCH_SIZE,
+        fsync=FEATURE_FSYNC,
+    ):
+        """
+        Write extracted features to the five pickle files of a feature store
+        in atomic batches. Rows are buffered and appended together, then the
+        manifest recording the committed size of every file is replaced
+        atomically. Readers only read committed bytes, so a crash can never
+        leave the files with different numbers of rows.
+
+        Args:
+            directory (str): Directory of the feature store, None for the paths in config
+            append (bool): Keep the committed rows instead of starting a new store
+            batch_size (int): Number of rows per commit
+            fsync (bool): Flush the files to disk before each commit
+        """
+        self.paths = get_feature_paths(directory)
+        self.manifest_path = get_manifest_path(self.paths["file_paths"])
+        self.batch_size = batch_size
+        self.fsync = fsync
+        create_dir_if_not_exist(os.path.dirname(self.manifest_path))
+        finish_compaction(directory)
+
+        manifest = load_manifest(self.manifest_path)
+        if append:
+            manifest = self._recover(manifest)
+        else:
+            version = manifest["version"] + 1 if manifest else 0
+            manifest = {
+                "version": version,
+                "rows": 0,
+                "sizes": {os.path.basename(path): 0 for path in self.paths.values()},
+            }
+            self._write_manifest(manifest)
+
+        # Drop anything written after the last commit
+        for path in self.paths.values():
+            with open(path, "ab") as f:
+                f.truncate(manifest["sizes"][os.path.basename(path)])
+
+        self.manifest = manifest
+        self.buffers = {name: [] for name in self.paths}
+        self.buffered_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _recover(self, manifest):
+        """
+        Build the manifest of a store written without one. A write
+        interrupted between the files leaves at most one extra row in some of
+        them, which is dropped. Stores missing files or with more rows in some
+        files are not touched.
+
+        Args:
+            manifest (dict): Existing manifest, or None
+
+        Returns:
+            dict: Manifest of the committed rows
+        """
+        if manifest is not None:
+            return manifest
+
+        missing = [path for path in self.paths.values() if not os.path.exists(path)]
+        if len(missing) == len(self.paths):
+            # A new store
+            offsets = {path: [0] for path in self.paths.values()}
+        elif missing:
+            raise FileNotFoundError(
+                f"Feature files {', '.join(missing)} are missing, "
+                "restore them or start a new store."
+            )
+        else:
+            offsets = {path: get_pickled_offsets(path) for path in self.paths.values()}
+
+        counts = [len(file_offsets) - 1 for file_offsets in offsets.values()]
+        if max(counts) - min(counts) > 1:
+            raise ValueError(
+                f"Feature files have between {min(counts)} and {max(counts)} rows, "
+                "the store cannot be recovered without a manifest."
+            )
+        rows = min(counts)
+        manifest = {
+            "version": 0,
+            "rows": rows,
+            "sizes": {
+                os.path.basename(path): file_offsets[rows]
+                for path, file_offsets in offsets.items()
+            },
+        }
+        self._write_manifest(manifest)
+        return manifest
+
+    def _write_manifest(self, manifest):
+        """
+        Atomically replace the manifest.
+
+        Args:
+            manifest (dict): Manifest to write
+
+        Returns:
+            None
+        """
+        data = json.dumps(manifest).encode()
+        replace_atomically(self.manifest_path, lambda f: f.write(data), self.fsync)
+
+    def write(self, file_path, features):
+        """
+        Buffer the features of one track, committing when the batch is full.
+
+        Args:
+            file_path (str): Path of the audio file
+            features (dict): Features returned by `extraction.extract_track`
+
+        Returns:
+            None
+        """
+        row = dict(features, file_paths=file_path)
+        for name in self.paths:
+            self.buffers[name].append(pickle.dumps(row[name]))
+        self.buffered_rows += 1
+        if self.buffered_rows >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        """
+        Append the buffered rows to every file and commit them in the manifest.
+
+        Returns:
+            None
+        """
+        if not self.buffered_rows:
+            return
+
+        sizes = dict(self.manifest["sizes"])
+        for name, path in self.paths.items():
+            with open(path, "ab") as f:
+                f.write(b"".join(self.buffers[name]))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+                sizes[os.path.basename(path)] = f.tell()
+            self.buffers[name] = []
+
+        self.manifest = {
+            "version": self.manifest["version"] + 1,
+            "rows": self.manifest["rows"] + self.buffered_rows,
+            "sizes": sizes,
+        }
+        self._write_manifest(self.manifest)
+        self.buffered_rows = 0
+
+    def close(self):
+        """
+        Commit the remaining buffered rows.
+
+        Returns:
+            None
+        """
+        self.commit()
+
+
+def finish_compaction(directory=None):
+    """
+    Complete a compaction of a feature store interrupted by a crash. The
+    compacted files are only moved into place once the compacted manifest is
+    written, so an unfinished compaction is either rolled forward or dropped.
+
+    Args:
+        directory (str): Directory of the feature store, None for the paths in config
+
+    Returns:
+        None
+    """
+
+    paths = get_feature_paths(directory)
+    manifest_path = get_manifest_path(paths["file_paths"])
+    committed = os.path.exists(manifest_path + COMPACT_SUFFIX)
+    for path in paths.values():
+        if os.path.exists(path + COMPACT_SUFFIX):
+            if committed:
+                os.replace(path + COMPACT_SUFFIX, path)
+            else:
+                os.remove(path + COMPACT_SUFFIX)
+    if committed:
+        os.replace(manifest_path + COMPACT_SUFFIX, manifest_path)
+        fsync_directory(os.path.dirname(manifest_path))
+
+
+def compact_store(removed, directory=None, fsync=FEATURE_FSYNC):
+    """
+    Remove tracks from a feature store by rewriting the five files without
+    their rows. No audio is analysed again, the stored rows are copied.
+
+    Args:
+        removed (set): Paths of the audio files to remove
+        directory (str): Directory of the feature store, None for the paths in config
+        fsync (bool): Flush the compacted files to disk before committing them
+
+    Returns:
+        np array: Boolean mask of the rows that were kept, None if no row was removed
+    """
+
+    finish_compaction(directory)
+    paths = get_feature_paths(directory)
+    keep = np.array(
+        [path not in removed for path in load_pickled(paths["file_paths"])], dtype=bool
+    )
+    if keep.all():
+        return None
+
+    sizes = {}
+    for path in paths.values():
+        with open(path + COMPACT_SUFFIX, "wb") as f:
+            row = 0
+            for chunk, _ in iter_pickled(path, chunk_size=1024):
+                for obj in chunk:
+                    if keep[row]:
+                        pickle.dump(obj, f)
+                    row += 1
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            sizes[os.path.basename(path)] = f.tell()
+
+    # Writing the compacted manifest commits the compaction
+    manifest_path = get_manifest_path(paths["file_paths"])
+    manifest = load_manifest(manifest_path)
+    manifest = {
+        "version": manifest["version"] + 1 if manifest else 0,
+        "rows": int(keep.sum()),
+        "sizes": sizes,
+    }
+    data = json.dumps(manifest).encode()
+    replace_atomically(manifest_path + COMPACT_SUFFIX, lambda f: f.write(data), fsync)
+    finish_compaction(directory)
+    return keep
 
 
 def load_pickled(file_path):
     """
-    Given a file path, load pickled objects until the end of the file
+    Given a file path, load pickled objects until the end of the committed data
 
     Args:
         file_path (str): Path to the pickled file
@@ -143,13 +465,182 @@ def load_pickled(file_path):
     """
 
     res = []
+    for chunk, _ in iter_pickled(file_path, chunk_size=None):
+        res.extend(chunk)
+    return res
+
+
+def iter_pickled(file_path, chunk_size, offset=0):
+    """
+    Given a file path, load pickled objects in chunks starting at a byte
+    offset until the end of the committed data
+
+    Args:
+        file_path (str): Path to the pickled file
+        chunk_size (int): Maximum number of objects per chunk, None for one chunk
+        offset (int): Byte offset of the first object to load
+
+    Yields:
+        list: Chunk of pickled objects
+        int: Byte offset right after the chunk
+    """
+
+    end = get_committed_size(file_path)
     with open(file_path, "rb") as file:
-        while True:
+        file.seek(offset)
+        chunk = []
+        while end is None or file.tell() < end:
             try:
-                res.append(pickle.load(file))
+                chunk.append(pickle.load(file))
             except EOFError:
                 break
-    return res
+            if len(chunk) == chunk_size:
+                yield chunk, file.tell()
+                chunk = []
+        if chunk:
+            yield chunk, file.tell()
+
+
+def iter_store_rows(directory=None, chunk_size=1024):
+    """
+    Iterate over the committed rows of a feature store
+
+    Args:
+        directory (str): Directory of the feature store, None for the paths in config
+        chunk_size (int): Number of rows loaded from each file at once
+
+    Yields:
+        str: Path of the audio file
+        dict: Features of the row, as returned by `extraction.extract_track`
+    """
+
+    paths = get_feature_paths(directory)
+    names = list(paths)
+    chunks = zip(*(iter_pickled(paths[name], chunk_size) for name in names))
+    for chunk in chunks:
+        columns = {name: rows for name, (rows, _) in zip(names, chunk)}
+        for i, file_path in enumerate(columns.pop("file_paths")):
+            yield file_path, {name: rows[i] for name, rows in columns.items()}
+
+
+def get_pickled_offsets(file_path):
+    """
+    Return the byte offset of every complete pickled object in a file
+
+    Args:
+        file_path (str): Path to the pickled file
+
+    Returns:
+        list: Offsets of the objects followed by the offset after the last one
+    """
+
+    offsets = [0]
+    with open(file_path, "rb") as file:
+        while True:
+            try:
+                pickle.load(file)
+            except Exception:
+                # A truncated object at the end of the file
+                break
+            offsets.append(file.tell())
+    return offsets
+
+
+def replace_atomically(file_path, write_func, fsync=False):
+    """
+    Write a file through a temporary file in the same directory and rename it
+    into place, so readers never see a partially written file
+
+    Args:
+        file_path (str): Path of the file to write
+        write_func (callable): Function writing the contents to a binary file object
+        fsync (bool): Flush the file and the rename to disk
+
+    Returns:
+        None
+    """
+
+    directory = os.path.dirname(file_path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_func(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if fsync:
+        fsync_directory(directory)
+
+
+def append_npy(file_path, rows):
+    """
+    Append rows to a .npy file in place. The data is written first and the
+    header last, so a reader sees either the old or the new shape. The file
+    is rewritten if the new header does not fit in the padding of the old one.
+
+    Args:
+        file_path (str): Path to the .npy file
+        rows (np array): Rows to append, with the shape of the stored rows
+
+    Returns:
+        None
+    """
+
+    with open(file_path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+
+        rows = np.ascontiguousarray(rows, dtype=dtype).reshape((-1,) + shape[1:])
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header,
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False,
+                "shape": (shape[0] + len(rows),) + shape[1:],
+            },
+        )
+
+        if not fortran_order and len(header.getvalue()) == header_size:
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    array = np.concatenate([np.load(file_path, mmap_mode="r"), rows])
+    replace_atomically(file_path, lambda f: np.save(f, array))
+
+
+def is_older_than(file_path, source_paths):
+    """
+    Check if a derived file is missing or older than any of its source files
+
+    Args:
+        file_path (str): Path of the derived file
+        source_paths (list): Paths of the files it is built from
+
+    Returns:
+        bool: True if the derived file needs to be rebuilt
+    """
+
+    if not os.path.exists(file_path):
+        return True
+    mtime = os.path.getmtime(file_path)
+    return any(
+        os.path.exists(source) and os.path.getmtime(source) > mtime
+        for source in source_paths
+    )
 
 
 def get_saved_discogs_embeddings():
@@ -174,6 +665,25 @@ def get_saved_msd_embeddings():
     return np.array(load_pickled(MSD_EMBEDDINGS_PATH))
 
 
+def get_saved_embeddings(embedding_name):
+    """
+    Return a 2D numpy array with the given embeddings for each audio file
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        np array: Embeddings for each audio file
+    """
+
+    if embedding_name == "discogs":
+        return get_saved_discogs_embeddings()
+    elif embedding_name == "msd":
+        return get_saved_msd_embeddings()
+    else:
+        raise ValueError("Invalid embedding name.")
+
+
 def get_saved_genre_activations():
     """
     Return a 2D numpy array with genre activations for each audio file
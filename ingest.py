@@ -0,0 +1,310 @@
+import argparse
+import os
+import numpy as np
+from tqdm import tqdm
+from sandbox import SandboxPool
+from autotune import get_profile
+from discovery import discover_audio_files
+from fileio import (
+    FeatureWriter,
+    store_lock,
+    compact_store,
+    get_saved_file_paths,
+    is_older_than,
+)
+from store import (
+    append_array,
+    remove_array_rows,
+    get_store_path,
+    get_embeddings_path,
+)
+from snapshot import append_snapshot, remove_snapshot_rows
+from bitmap_index import append_genre_bitmaps, remove_genre_bitmap_rows
+from quantization import append_to_pq_index, remove_from_pq_index, get_index_paths
+from knn_graph import append_to_knn_graph, remove_from_knn_graph, get_graph_names
+from clustering import (
+    append_to_clusters,
+    remove_from_clusters,
+    get_cluster_names,
+    get_source_paths,
+)
+from collection_stats import update_collection_stats
+from config import (
+    FILE_PATHS_PATH,
+    ALL_FEATURES_PATH,
+    GENRE_DISCOGS_PATH,
+    SNAPSHOT_PATH,
+    CLUSTER_SOURCES,
+)
+
+
+def get_new_paths(paths):
+    """
+    Expand directories into their audio files and drop the paths that are
+    already in the feature store
+
+    Args:
+        paths (list): Paths of audio files or directories
+
+    Returns:
+        list: Normalised paths of the audio files to ingest
+    """
+
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(discover_audio_files(path))
+        else:
+            expanded.append(os.path.normpath(path))
+
+    existing = set(get_saved_file_paths()) if os.path.exists(FILE_PATHS_PATH) else set()
+    return [path for path in dict.fromkeys(expanded) if path not in existing]
+
+
+def analyse_files(paths, pool):
+    """
+    Extract the features of the audio files in sandboxed worker processes
+
+    Args:
+        paths (list): Paths of the audio files
+        pool (SandboxPool): Extraction workers
+
+    Returns:
+        list: (path, features) of every file that was analysed successfully
+    """
+
+    tracks = []
+    for path, features in tqdm(pool.imap(paths), total=len(paths)):
+        if features is not None:
+            tracks.append((path, features))
+    return tracks
+
+
+def update_indexes(tracks, n_rows):
+    """
+    Insert new tracks into the snapshot, the shared store arrays, the genre
+    bitmap index, the PQ indexes, the neighbour tables and the clusterings.
+    Structures that are missing or out of date are skipped and rebuilt from
+    the feature files when next loaded.
+
+    Args:
+        tracks (list): (path, features) of the new tracks
+        n_rows (int): Number of tracks in the feature store before the new ones
+
+    Returns:
+        dict: Name of each structure mapped to True if it was updated in place
+    """
+
+    file_paths = [path for path, _ in tracks]
+    genre_activations = np.array(
+        [features["genre_activations"] for _, features in tracks], dtype=np.float32
+    )
+
+    updated = {
+        "snapshot": append_snapshot(
+            [features["all_features"] for _, features in tracks], file_paths, n_rows
+        ),
+        "genre_bitmaps": append_genre_bitmaps(genre_activations, n_rows),
+        "genre_activations": append_array(
+            "genre_activations", genre_activations, n_rows
+        ),
+    }
+    for name in ["discogs", "msd"]:
+        embeddings = np.array(
+            [features[f"{name}_embeddings"] for _, features in tracks],
+            dtype=np.float32,
+        )
+        updated[f"{name}_embeddings"] = append_array(
+            f"{name}_embeddings", embeddings, n_rows
+        )
+        updated[f"{name}_pq_index"] = append_to_pq_index(name, embeddings, n_rows)
+        updated[f"{name}_knn_graph"] = append_to_knn_graph(name, n_rows)
+    for source in CLUSTER_SOURCES:
+        updated[f"{source}_clusters"] = append_to_clusters(source, n_rows)
+    return updated
+
+
+def remove_from_indexes(keep):
+    """
+    Drop removed tracks from the snapshot, the shared store arrays, the genre
+    bitmap index, the PQ indexes, the neighbour tables and the clusterings.
+    Structures that are missing or out of date are skipped and rebuilt from
+    the feature files when next loaded.
+
+    Args:
+        keep (np array): Boolean mask of the tracks that were kept
+
+    Returns:
+        dict: Name of each structure mapped to True if it was updated in place
+    """
+
+    updated = {
+        "snapshot": remove_snapshot_rows(keep),
+        "genre_activations": remove_array_rows("genre_activations", keep),
+        "genre_bitmaps": remove_genre_bitmap_rows(keep),
+    }
+    for name in ["discogs", "msd"]:
+        updated[f"{name}_embeddings"] = remove_array_rows(f"{name}_embeddings", keep)
+        updated[f"{name}_pq_index"] = remove_from_pq_index(name, keep)
+        updated[f"{name}_knn_graph"] = remove_from_knn_graph(name, keep)
+    for source in CLUSTER_SOURCES:
+        updated[f"{source}_clusters"] = remove_from_clusters(source, keep)
+    return updated
+
+
+def get_derived_sources():
+    """
+    List the files built from the feature store with the feature files each
+    of them is built from
+
+    Returns:
+        dict: Paths of the feature files of each derived file
+    """
+
+    genres = [GENRE_DISCOGS_PATH]
+    sources = {SNAPSHOT_PATH: [ALL_FEATURES_PATH, FILE_PATHS_PATH, GENRE_DISCOGS_PATH]}
+    for name in ["genre_activations", "genre_bitmaps", "genre_bitmap_rows"]:
+        sources[get_store_path(name)] = genres
+    for name in ["discogs", "msd"]:
+        embeddings = [get_embeddings_path(name)]
+        sources[get_store_path(f"{name}_embeddings")] = embeddings
+        for path in get_index_paths(name):
+            sources[path] = embeddings
+        for array in get_graph_names(name):
+            sources[get_store_path(array)] = embeddings
+    for source in CLUSTER_SOURCES:
+        for array in get_cluster_names(source):
+            sources[get_store_path(array)] = get_source_paths(source)
+    return sources
+
+
+def remove_files(paths):
+    """
+    Delete the files that exist among some paths
+
+    Args:
+        paths (list): Paths of the files
+
+    Returns:
+        list: Paths of the deleted files
+    """
+
+    deleted = [path for path in paths if os.path.exists(path)]
+    for path in deleted:
+        os.remove(path)
+    return deleted
+
+
+def remove_derived_indexes():
+    """
+    Delete the snapshot, the shared store arrays and the indexes built from
+    the feature store, for stores rewritten from scratch. The rows of the new
+    store need not match the old ones, so they cannot be updated and are
+    rebuilt by their scripts or on their next load.
+
+    Returns:
+        list: Paths of the deleted files
+    """
+
+    return remove_files(get_derived_sources())
+
+
+def remove_stale_indexes():
+    """
+    Delete the derived files older than their feature files. Their rows need
+    not match the store, and an update in place would make them look up to
+    date, so they must be rebuilt instead.
+
+    Returns:
+        list: Paths of the deleted files
+    """
+
+    return remove_files(
+        path
+        for path, source_paths in get_derived_sources().items()
+        if is_older_than(path, source_paths)
+    )
+
+
+def apply_changes(tracks, removed=()):
+    """
+    Remove tracks from the feature store and append analysed tracks to it,
+    updating the indexes used by the playlist apps in place
+
+    Args:
+        tracks (list): (path, features) of the tracks to append
+        removed (set): Paths of the tracks to remove
+
+    Returns:
+        dict: Name of each index structure mapped to True if it was updated in place
+    """
+
+    if not tracks and not removed:
+        return {}
+
+    updated = {}
+    with store_lock():
+        # Check before the feature files are written, which makes everything stale
+        remove_stale_indexes()
+        if removed:
+            keep = compact_store(set(removed))
+            if keep is not None:
+                updated = remove_from_indexes(keep)
+        if tracks:
+            with FeatureWriter(append=True) as writer:
+                n_rows = writer.manifest["rows"]
+                for path, features in tracks:
+                    writer.write(path, features)
+            appended = update_indexes(tracks, n_rows)
+            updated = {
+                name: done and updated.get(name, True)
+                for name, done in appended.items()
+            }
+
+    update_collection_stats()
+    return updated
+
+
+def ingest_files(paths, n_workers=None):
+    """
+    Analyse new audio files, append them to the feature store and insert them
+    into the indexes used by the playlist apps. The apps reload when the
+    feature store version changes, so running apps pick up the new tracks on
+    their next rerun.
+
+    Args:
+        paths (list): Paths of audio files or directories
+        n_workers (int): Maximum number of worker processes, from the
+            autotuned profile by default
+
+    Returns:
+        list: Paths of the ingested tracks
+        dict: Name of each index structure mapped to True if it was updated in place
+    """
+
+    paths = get_new_paths(paths)
+    if not paths:
+        return [], {}
+
+    # Analyse before taking the lock, so the apps are only blocked while writing
+    n_workers = n_workers or get_profile()["workers"]
+    with SandboxPool(min(n_workers, len(paths))) as pool:
+        tracks = analyse_files(paths, pool)
+    return [path for path, _ in tracks], apply_changes(tracks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add audio files to the feature store and the playlist indexes."
+    )
+    parser.add_argument("paths", nargs="+", help="Audio files or directories")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Worker processes"
+    )
+    args = parser.parse_args()
+
+    ingested, updated = ingest_files(args.paths, args.workers)
+    print(f"Ingested {len(ingested)} tracks.")
+    stale = [name for name, done in updated.items() if not done]
+    if stale:
+        print(f"Rebuilt on next load: {', '.join(stale)}")
@@ -0,0 +1,274 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from quantization import normalize_rows
+from store import (
+    get_store_path,
+    export_array,
+    load_array,
+    is_stale,
+    get_embeddings_path,
+    get_shared_embeddings,
+)
+from config import KNN_K, KNN_TILE, KNN_THREADS
+
+
+def get_graph_names(embedding_name):
+    """
+    Return the names of the neighbour table arrays in the shared store
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        str : Name of the int32 neighbour indexes
+        str : Name of the float16 neighbour similarities
+    """
+
+    return f"{embedding_name}_knn_indexes", f"{embedding_name}_knn_similarities"
+
+
+def top_k_neighbours(vectors, rows, k=KNN_K, tile=KNN_TILE, threads=KNN_THREADS):
+    """
+    Exact top-k cosine neighbours of some rows among all vectors. Row tiles
+    are multiplied with all vectors in parallel threads and reduced with
+    argpartition, so memory stays O(tile x N) per thread.
+
+    Args:
+        vectors (np array): float32 vectors with unit length rows, of shape (N, D)
+        rows (np array): Indexes of the query rows
+        k (int): Number of neighbours
+        tile (int): Number of rows per matrix multiplication
+        threads (int): Number of tiles computed at the same time
+
+    Returns:
+        np array : int32 neighbour indexes of shape (len(rows), k), most similar first
+        np array : float16 cosine similarities of shape (len(rows), k)
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    k = min(k, len(vectors) - 1)
+    indexes = np.zeros((len(rows), k), dtype=np.int32)
+    similarities = np.zeros((len(rows), k), dtype=np.float16)
+    if k < 1 or len(rows) == 0:
+        return indexes, similarities
+
+    def run_tile(start):
+        tile_rows = rows[start : start + tile]
+        tile_similarities = vectors[tile_rows] @ vectors.T
+        tile_similarities[np.arange(len(tile_rows)), tile_rows] = -np.inf
+
+        top = np.argpartition(tile_similarities, -k, axis=1)[:, -k:]
+        top_similarities = np.take_along_axis(tile_similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1, kind="stable")
+        end = start + len(tile_rows)
+        indexes[start:end] = np.take_along_axis(top, order, axis=1)
+        similarities[start:end] = np.take_along_axis(top_similarities, order, axis=1)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(run_tile, range(0, len(rows), tile)))
+    return indexes, similarities
+
+
+def get_normalized_embeddings(embedding_name):
+    """
+    Load the embeddings from the shared store with unit length rows
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        np array : float32 normalised embeddings
+    """
+
+    return normalize_rows(get_shared_embeddings(embedding_name))
+
+
+def build_knn_graph(embedding_name, k=KNN_K):
+    """
+    Compute the top-k neighbours of every track and save the neighbour table
+    to the shared store
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        k (int): Number of neighbours per track
+
+    Returns:
+        None
+    """
+
+    vectors = get_normalized_embeddings(embedding_name)
+    indexes, similarities = top_k_neighbours(vectors, np.arange(len(vectors)), k)
+    indexes_name, similarities_name = get_graph_names(embedding_name)
+    export_array(indexes_name, indexes)
+    export_array(similarities_name, similarities)
+
+
+class KNNGraph:
+    def __init__(self, indexes, similarities):
+        """
+        Precomputed neighbour table answering similarity queries with a lookup.
+
+        Args:
+            indexes (np array): int32 neighbour indexes of shape (N, k)
+            similarities (np array): float16 similarities of shape (N, k)
+        """
+        self.indexes = indexes
+        self.similarities = similarities
+        self.k = indexes.shape[1]
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def search(self, track_index, k):
+        """
+        Return the most similar tracks to a track.
+
+        Args:
+            track_index (int): Index of the query track
+            k (int): Number of similar tracks, at most the k of the table
+
+        Returns:
+            list: Indexes of the similar tracks, most similar first
+        """
+        return [int(i) for i in self.indexes[track_index, :k]]
+
+
+def load_knn_graph(embedding_name):
+    """
+    Memory-map the neighbour table of an embedding if it is built and up to date
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        KNNGraph : The graph, or None if it has not been built or is stale
+    """
+
+    names = get_graph_names(embedding_name)
+    if any(is_stale(name, [get_embeddings_path(embedding_name)]) for name in names):
+        return None
+    return KNNGraph(*(load_array(name) for name in names))
+
+
+def load_stored_graph(embedding_name, n_rows):
+    """
+    Load the stored neighbour table if it holds the expected number of tracks
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        n_rows (int): Expected number of tracks
+
+    Returns:
+        np array : Neighbour indexes, or None
+        np array : Neighbour similarities, or None
+    """
+
+    names = get_graph_names(embedding_name)
+    if not all(os.path.exists(get_store_path(name)) for name in names):
+        return None, None
+    indexes, similarities = (load_array(name) for name in names)
+    if len(indexes) != n_rows:
+        return None, None
+    return indexes, similarities
+
+
+def append_to_knn_graph(embedding_name, n_rows, k=KNN_K, tile=KNN_TILE):
+    """
+    Insert tracks appended to the stored embeddings into the neighbour table,
+    computing the neighbours of the new tracks and offering the new tracks
+    as neighbours to the existing ones
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        n_rows (int): Number of tracks in the table before the append
+        k (int): Number of neighbours per track
+        tile (int): Number of existing rows compared with the new tracks at once
+
+    Returns:
+        bool: True if the tracks were inserted, False if the table is missing
+            or out of date and needs a rebuild
+    """
+
+    indexes, similarities = load_stored_graph(embedding_name, n_rows)
+    if indexes is None:
+        return False
+    vectors = get_normalized_embeddings(embedding_name)
+    if len(vectors) <= n_rows:
+        return False
+
+    new_rows = np.arange(n_rows, len(vectors))
+    new_indexes, new_similarities = top_k_neighbours(vectors, new_rows, k)
+    k = new_indexes.shape[1]
+
+    merged_indexes = np.zeros((n_rows, k), dtype=np.int32)
+    merged_similarities = np.zeros((n_rows, k), dtype=np.float16)
+    for start in range(0, n_rows, tile):
+        end = min(start + tile, n_rows)
+        new_candidates = np.broadcast_to(new_rows, (end - start, len(new_rows)))
+        candidate_indexes = np.concatenate([indexes[start:end], new_candidates], axis=1)
+        candidate_similarities = np.concatenate(
+            [
+                np.asarray(similarities[start:end], dtype=np.float32),
+                vectors[start:end] @ vectors[new_rows].T,
+            ],
+            axis=1,
+        )
+        order = np.argsort(-candidate_similarities, axis=1, kind="stable")[:, :k]
+        merged_indexes[start:end] = np.take_along_axis(candidate_indexes, order, axis=1)
+        merged_similarities[start:end] = np.take_along_axis(
+            candidate_similarities, order, axis=1
+        )
+
+    indexes_name, similarities_name = get_graph_names(embedding_name)
+    export_array(indexes_name, np.concatenate([merged_indexes, new_indexes]))
+    export_array(
+        similarities_name, np.concatenate([merged_similarities, new_similarities])
+    )
+    return True
+
+
+def remove_from_knn_graph(embedding_name, keep, k=KNN_K):
+    """
+    Drop removed tracks from the neighbour table, recomputing the neighbours
+    of the tracks that had a removed track among their neighbours
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        keep (np array): Boolean mask of the tracks that were kept
+        k (int): Number of neighbours per track
+
+    Returns:
+        bool: True if the tracks were removed, False if the table is missing
+            or out of date and needs a rebuild
+    """
+
+    indexes, similarities = load_stored_graph(embedding_name, len(keep))
+    if indexes is None:
+        return False
+    vectors = get_normalized_embeddings(embedding_name)
+    if len(vectors) != keep.sum():
+        return False
+
+    # Renumber the kept tracks, removed tracks become -1
+    positions = np.where(keep, np.cumsum(keep) - 1, -1).astype(np.int32)
+    indexes = positions[indexes[keep]]
+    similarities = np.array(similarities[keep])
+
+    if min(k, len(vectors) - 1) == indexes.shape[1]:
+        affected = np.flatnonzero((indexes < 0).any(axis=1))
+    else:
+        affected = np.arange(len(vectors))
+        indexes = np.zeros((len(vectors), min(k, len(vectors) - 1)), dtype=np.int32)
+        similarities = np.zeros(indexes.shape, dtype=np.float16)
+    indexes[affected], similarities[affected] = top_k_neighbours(vectors, affected, k)
+
+    indexes_name, similarities_name = get_graph_names(embedding_name)
+    export_array(indexes_name, indexes)
+    export_array(similarities_name, similarities)
+    return True
+
+
+if __name__ == "__main__":
+    for name in ["discogs", "msd"]:
+        build_knn_graph(name)
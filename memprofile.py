@@ -0,0 +1,521 @@
+import argparse
+import ast
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+import wave
+import numpy as np
+from tqdm import tqdm
+from autotune import load_profile, apply_profile, create_synthetic_audio
+from sandbox import get_rss_mb
+from fileio import load_json, replace_atomically
+from config import (
+    MEMORY_REPORT_PATH,
+    MEMORY_SOAK_TRACKS,
+    MEMORY_PROFILE_TRACKS,
+    MEMORY_WARMUP_TRACKS,
+    MEMORY_TRACK_SECONDS,
+    MEMORY_SAMPLE_INTERVAL,
+    MEMORY_TOP_ALLOCATIONS,
+    MEMORY_TRACE_FRAMES,
+    MEMORY_MAX_PEAK_RSS_MB,
+    MEMORY_MAX_LEAK_KB_PER_TRACK,
+)
+
+# Allocations are attributed to the innermost function of these modules
+PROFILER_PATH = os.path.abspath(__file__)
+PROJECT_DIR_PATH = os.path.dirname(PROFILER_PATH)
+
+# Allocations of the profiler itself are left out of the snapshots
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, PROFILER_PATH),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def write_synthetic_track(path, seconds, seed=0, sample_rate=44100):
+    """
+    Write a stereo 16-bit WAV file of synthetic audio, so the benchmark
+    loads and resamples it like a track of the collection
+
+    Args:
+        path (str): Path of the WAV file
+        seconds (float): Length of the audio
+        seed (int): Seed of the random generator
+        sample_rate (int): Sample rate of the audio
+
+    Returns:
+        None
+    """
+
+    left = create_synthetic_audio(seconds, seed, sample_rate)
+    right = create_synthetic_audio(seconds, seed + 1, sample_rate)
+    stereo = np.stack([left, right], axis=1)
+    samples = (np.clip(stereo, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def get_current_rss_mb():
+    """
+    Resident memory of the current process. Raises instead of returning a
+    placeholder, so the benchmark never passes its thresholds by measuring
+    nothing on platforms without /proc and psutil.
+
+    Returns:
+        float: Resident memory in MB
+    """
+
+    rss = get_rss_mb(os.getpid())
+    if rss is None:
+        raise RuntimeError(
+            "Cannot read the resident memory of the process, "
+            "install psutil on platforms without /proc."
+        )
+    return rss
+
+
+class RssSampler:
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        """
+        Sample the resident memory of the current process in a thread, to
+        catch the peak within a track. The kernel high water mark only grows,
+        so it cannot give the peak of each track.
+
+        Args:
+            interval (float): Seconds between samples
+        """
+        self.interval = interval
+        self.peak = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        # Fail here rather than in the sampling thread
+        self.reset()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, get_current_rss_mb())
+
+    def reset(self):
+        """
+        Start a new peak from the current resident memory.
+
+        Returns:
+            float: Resident memory in MB
+        """
+        rss = get_current_rss_mb()
+        self.peak = rss
+        return rss
+
+
+@functools.lru_cache(maxsize=None)
+def get_function_ranges(filename):
+    """
+    List the line ranges of the functions of a source file
+
+    Args:
+        filename (str): Path of the source file
+
+    Returns:
+        list: (first line, last line, qualified name) of each function, the
+            innermost functions last
+    """
+
+    try:
+        with open(filename) as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return []
+
+    ranges = []
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                name = f"{prefix}{child.name}"
+                if not isinstance(child, ast.ClassDef):
+                    ranges.append((child.lineno, child.end_lineno, name))
+                visit(child, f"{name}.")
+            else:
+                visit(child, prefix)
+
+    visit(tree, "")
+    return ranges
+
+
+def get_location(traceback):
+    """
+    Find the module and function of a traced allocation. Memory allocated
+    inside NumPy or another library is attributed to the innermost function
+    of this project that called it.
+
+    Args:
+        traceback (tracemalloc.Traceback): Frames of the allocation
+
+    Returns:
+        str: Module name
+        str: Function name, "<module>" for module level code
+    """
+
+    frame = traceback[-1]
+    for candidate in reversed(traceback):
+        filename = os.path.abspath(candidate.filename)
+        if filename.startswith(PROJECT_DIR_PATH) and filename != PROFILER_PATH:
+            frame = candidate
+            break
+    module = os.path.splitext(os.path.basename(frame.filename))[0]
+    function = "<module>"
+    for first, last, name in get_function_ranges(frame.filename):
+        if first <= frame.lineno <= last:
+            function = name
+    return module, function
+
+
+def group_allocations(snapshot, n_top=MEMORY_TOP_ALLOCATIONS):
+    """
+    Sum the live allocations of a snapshot by module and function
+
+    Args:
+        snapshot (tracemalloc.Snapshot): Snapshot of the traced memory
+        n_top (int): Number of locations to return
+
+    Returns:
+        list: Module, function, size in MB and count of the largest locations
+    """
+
+    groups = {}
+    for stat in snapshot.filter_traces(SNAPSHOT_FILTERS).statistics("traceback"):
+        location = get_location(stat.traceback)
+        size, count = groups.get(location, (0, 0))
+        groups[location] = (size + stat.size, count + stat.count)
+    return format_groups(groups, n_top)
+
+
+def group_growth(old_snapshot, new_snapshot, n_top=MEMORY_TOP_ALLOCATIONS):
+    """
+    Sum the growth of the live allocations between two snapshots by module
+    and function
+
+    Args:
+        old_snapshot (tracemalloc.Snapshot): Earlier snapshot
+        new_snapshot (tracemalloc.Snapshot): Later snapshot
+        n_top (int): Number of locations to return
+
+    Returns:
+        list: Module, function, growth in MB and count of the locations that
+            grew the most
+    """
+
+    groups = {}
+    old_snapshot = old_snapshot.filter_traces(SNAPSHOT_FILTERS)
+    new_snapshot = new_snapshot.filter_traces(SNAPSHOT_FILTERS)
+    for stat in new_snapshot.compare_to(old_snapshot, "traceback"):
+        location = get_location(stat.traceback)
+        size, count = groups.get(location, (0, 0))
+        groups[location] = (size + stat.size_diff, count + stat.count_diff)
+    return format_groups(groups, n_top)
+
+
+def format_groups(groups, n_top):
+    """
+    Sort allocations grouped by location for the report
+
+    Args:
+        groups (dict): (size in bytes, count) of each (module, function)
+        n_top (int): Number of locations to return
+
+    Returns:
+        list: Module, function, size in MB and count of the largest locations
+    """
+
+    largest = sorted(groups.items(), key=lambda item: item[1][0], reverse=True)
+    return [
+        {"module": module, "function": function, "mb": size / 2**20, "count": count}
+        for (module, function), (size, count) in largest[:n_top]
+    ]
+
+
+def get_leak_slope(values, warmup):
+    """
+    Fit a line to a memory measurement after each track, skipping the
+    tracks that fill the caches and the model sessions
+
+    Args:
+        values (list): Memory in MB after each track
+        warmup (int): Number of tracks to skip
+
+    Returns:
+        float: Growth in KB per track, 0 with fewer than two tracks
+    """
+
+    values = values[warmup:]
+    if len(values) < 2:
+        return 0.0
+    slope, _ = np.polyfit(np.arange(len(values)), values, 1)
+    return float(slope) * 1024
+
+
+def check_thresholds(
+    report,
+    max_peak_rss_mb=MEMORY_MAX_PEAK_RSS_MB,
+    max_leak_kb=MEMORY_MAX_LEAK_KB_PER_TRACK,
+):
+    """
+    Compare a report with the memory thresholds
+
+    Args:
+        report (dict): Report of `soak` or `profile`
+        max_peak_rss_mb (float): Maximum resident memory during any track
+        max_leak_kb (float): Maximum growth in KB per track
+
+    Returns:
+        list: Description of each exceeded threshold, empty if none
+    """
+
+    failures = []
+    if report["peak_rss_mb"] > max_peak_rss_mb:
+        failures.append(
+            f"Peak RSS of {report['peak_rss_mb']:.0f} MB is above "
+            f"{max_peak_rss_mb} MB."
+        )
+    for name in ["rss_leak_kb_per_track", "traced_leak_kb_per_track"]:
+        if report.get(name, 0.0) > max_leak_kb:
+            failures.append(
+                f"{name} of {report[name]:.1f} KB is above {max_leak_kb} KB."
+            )
+    return failures
+
+
+def load_extraction():
+    """
+    Import the extraction with the TensorFlow settings of the workers
+
+    Returns:
+        callable: `compute_track_features`, which skips the embedding cache
+    """
+
+    apply_profile(load_profile())
+    from extraction import compute_track_features
+
+    return compute_track_features
+
+
+def soak(
+    n_tracks=MEMORY_SOAK_TRACKS,
+    seconds=MEMORY_TRACK_SECONDS,
+    warmup=MEMORY_WARMUP_TRACKS,
+):
+    """
+    Extract the features of a synthetic track many times, measuring the
+    resident memory during and after every track. Essentia and TensorFlow
+    allocate outside of Python, so only the resident memory shows them.
+
+    Args:
+        n_tracks (int): Number of tracks
+        seconds (float): Length of the synthetic track
+        warmup (int): Tracks excluded from the leak slope
+
+    Returns:
+        dict: Peak and per track resident memory and the leak slope
+    """
+
+    # Check before the slow import of the extraction
+    get_current_rss_mb()
+    compute_track_features = load_extraction()
+    peaks, after, growth = [], [], []
+    with tempfile.TemporaryDirectory() as directory, RssSampler() as sampler:
+        path = os.path.join(directory, "synthetic.wav")
+        write_synthetic_track(path, seconds)
+        for _ in tqdm(range(n_tracks), desc="Soak"):
+            before = sampler.reset()
+            compute_track_features(path, lambda stage: None)
+            rss = get_current_rss_mb()
+            peak = max(sampler.peak, rss)
+            peaks.append(peak)
+            after.append(rss)
+            growth.append(peak - before)
+
+    report = {
+        "mode": "soak",
+        "tracks": n_tracks,
+        "seconds": seconds,
+        "peak_rss_mb": max(peaks),
+        "median_track_peak_rss_mb": float(np.median(peaks)),
+        "max_track_growth_mb": max(growth),
+        "first_rss_mb": after[min(warmup, n_tracks - 1)],
+        "last_rss_mb": after[-1],
+        "rss_leak_kb_per_track": get_leak_slope(after, warmup),
+    }
+    report["failures"] = check_thresholds(report)
+    return report
+
+
+def profile(
+    n_tracks=MEMORY_PROFILE_TRACKS,
+    seconds=MEMORY_TRACK_SECONDS,
+    warmup=MEMORY_WARMUP_TRACKS,
+    n_top=MEMORY_TOP_ALLOCATIONS,
+):
+    """
+    Trace the Python and NumPy allocations of the extraction. Reports the
+    peak allocated by each stage, the largest live allocations by module
+    and function at the stage boundaries of the last track, and the
+    allocations that grew after the warmup tracks.
+
+    Args:
+        n_tracks (int): Number of tracks
+        seconds (float): Length of the synthetic track
+        warmup (int): Tracks before the baseline snapshot
+        n_top (int): Number of locations in each list
+
+    Returns:
+        dict: Stage peaks, hot spots, growth and leak slopes
+    """
+
+    get_current_rss_mb()
+    compute_track_features = load_extraction()
+    warmup = min(warmup, n_tracks - 1)
+    stage_peaks = {}
+    boundaries = []
+    current = {"stage": None, "start": 0, "snapshots": False}
+
+    def finish_stage():
+        if current["stage"] is not None:
+            peak = tracemalloc.get_traced_memory()[1] - current["start"]
+            stage = current["stage"]
+            stage_peaks[stage] = max(stage_peaks.get(stage, 0), peak / 2**20)
+        if current["snapshots"]:
+            boundaries.append(tracemalloc.take_snapshot())
+
+    def on_stage(name):
+        finish_stage()
+        current["stage"] = name
+        tracemalloc.reset_peak()
+        current["start"] = tracemalloc.get_traced_memory()[0]
+
+    traced, peaks = [], []
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+    try:
+        with tempfile.TemporaryDirectory() as directory, RssSampler() as sampler:
+            path = os.path.join(directory, "synthetic.wav")
+            write_synthetic_track(path, seconds)
+            for i in tqdm(range(n_tracks), desc="Profile"):
+                if i == warmup:
+                    baseline = tracemalloc.take_snapshot()
+                current["snapshots"] = i == n_tracks - 1
+                sampler.reset()
+                compute_track_features(path, on_stage)
+                finish_stage()
+                current["stage"] = None
+                traced.append(tracemalloc.get_traced_memory()[0] / 2**20)
+                peaks.append(max(sampler.peak, get_current_rss_mb()))
+            final = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # Largest size of each location over the stage boundaries
+    hot_spots = {}
+    for snapshot in boundaries:
+        for row in group_allocations(snapshot, n_top=None):
+            location = (row["module"], row["function"])
+            if row["mb"] * 2**20 > hot_spots.get(location, (0, 0))[0]:
+                hot_spots[location] = (row["mb"] * 2**20, row["count"])
+
+    report = {
+        "mode": "profile",
+        "tracks": n_tracks,
+        "seconds": seconds,
+        "peak_rss_mb": max(peaks),
+        "stage_peak_mb": stage_peaks,
+        "hot_spots": format_groups(hot_spots, n_top),
+        "growth": group_growth(baseline, final, n_top),
+        "traced_leak_kb_per_track": get_leak_slope(traced, warmup),
+    }
+    report["failures"] = check_thresholds(report)
+    return report
+
+
+def save_report(report, report_path=MEMORY_REPORT_PATH):
+    """
+    Save a report next to the last report of the other mode
+
+    Args:
+        report (dict): Report of `soak` or `profile`
+        report_path (str): Path to the JSON reports
+
+    Returns:
+        None
+    """
+
+    reports = load_json(report_path) if os.path.exists(report_path) else {}
+    reports[report["mode"]] = report
+    data = json.dumps(reports, indent=2).encode()
+    replace_atomically(report_path, lambda f: f.write(data))
+
+
+def print_report(report):
+    """
+    Print the measurements of a report
+
+    Args:
+        report (dict): Report of `soak` or `profile`
+
+    Returns:
+        None
+    """
+
+    for name, value in report.items():
+        if isinstance(value, float):
+            print(f"{name}: {value:.2f}")
+    for stage, peak in report.get("stage_peak_mb", {}).items():
+        print(f"Stage {stage}: {peak:.1f} MB peak")
+    for name in ["hot_spots", "growth"]:
+        if name in report:
+            print(f"{name}:")
+        for row in report.get(name, []):
+            print(
+                f"  {row['mb']:10.2f} MB {row['count']:8d} "
+                f"{row['module']}.{row['function']}"
+            )
+    for failure in report["failures"]:
+        print(f"FAIL: {failure}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory soak benchmark and allocation profile of the extraction."
+    )
+    parser.add_argument("mode", choices=["soak", "profile"])
+    parser.add_argument("--tracks", type=int, default=None)
+    parser.add_argument("--seconds", type=float, default=MEMORY_TRACK_SECONDS)
+    parser.add_argument("--warmup", type=int, default=MEMORY_WARMUP_TRACKS)
+    args = parser.parse_args()
+
+    if args.mode == "soak":
+        report = soak(args.tracks or MEMORY_SOAK_TRACKS, args.seconds, args.warmup)
+    else:
+        report = profile(
+            args.tracks or MEMORY_PROFILE_TRACKS, args.seconds, args.warmup
+        )
+    save_report(report)
+    print_report(report)
+    print(f"Saved the report to {MEMORY_REPORT_PATH}.")
+    sys.exit(1 if report["failures"] else 0)
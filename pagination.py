@@ -0,0 +1,51 @@
+import streamlit as st
+from config import RESULTS_PAGE_SIZE
+
+
+def paginate(n_items, key, page_size=RESULTS_PAGE_SIZE):
+    """
+    Show a page selector for a result list and return the rows of the
+    selected page, so only one page is rendered and sent to the browser
+
+    Args:
+        n_items (int): Number of results
+        key (str): Unique widget key of the list
+        page_size (int): Number of results per page
+
+    Returns:
+        int: First row of the page
+        int: Row after the last one of the page
+    """
+
+    n_pages = max(1, -(-n_items // page_size))
+    page = 1
+    if n_pages > 1:
+        # The selector restarts at the first page when the number of pages changes
+        page = st.number_input(
+            f"Page (of {n_pages}):",
+            min_value=1,
+            max_value=n_pages,
+            value=1,
+            step=1,
+            key=f"{key}_page_{n_pages}",
+        )
+    start = (page - 1) * page_size
+    return start, min(start + page_size, n_items)
+
+
+def display_table(table, key, page_size=RESULTS_PAGE_SIZE):
+    """
+    Display one page of a DataFrame with the position of the page
+
+    Args:
+        table (pd.DataFrame): Table to display
+        key (str): Unique widget key of the table
+        page_size (int): Number of rows per page
+
+    Returns:
+        None
+    """
+
+    start, stop = paginate(len(table), key, page_size)
+    st.dataframe(table.iloc[start:stop])
+    st.caption(f"Rows {min(start + 1, stop)}-{stop} of {len(table)}.")
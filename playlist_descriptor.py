@@ -1,14 +1,34 @@
 import os
 import streamlit as st
-import pandas as pd
 import random
-from fileio import (
-    get_saved_genre_activations,
-    get_saved_file_paths,
-    get_genre_names,
-    get_saved_all_features,
+import pandas as pd
+from fileio import get_store_version, store_lock
+from snapshot import load_snapshot
+from bitmap_index import load_genre_bitmap_index
+from descriptor_tree import DescriptorIndex
+from clustering import load_cluster_index
+from dedup import load_duplicate_map, get_duplicate_map_version, collapse_duplicates
+from previews import get_preview
+from query_cache import QueryCache
+from pagination import paginate, display_table
+from encoding import TONICS, SCALES, key_lookup_table, filter_codes
+from config import (
+    GENRE_DISCOGS_PATH,
+    ALL_FEATURES_PATH,
+    PLAYLISTS_DIR_PATH,
+    CLUSTER_SOURCES,
+    PREVIEWS_PAGE_SIZE,
 )
-from config import GENRE_DISCOGS_PATH, ALL_FEATURES_PATH, PLAYLISTS_DIR_PATH
+
+# Slider label, range and default value of each target point descriptor
+TARGET_SLIDERS = {
+    "arousal": ("Arousal", 0.0, 9.0, 5.0),
+    "valence": ("Valence", 0.0, 9.0, 5.0),
+    "tempo": ("BPM", 0.0, 250.0, 120.0),
+    "danceability_probability": ("Danceability", 0.0, 1.0, 0.5),
+    "instrumental_probability": ("Instrumental", 0.0, 1.0, 0.5),
+    "loudness": ("Loudness (dB)", -30.0, 0.0, -10.0),
+}
 
 
 class DescriptorPlaylist:
@@ -16,53 +36,145 @@ class DescriptorPlaylist:
         """
         Create a playlist based on audio analysis data.
         """
-        self.genre_activations = self._load_genre_activations()
-        self.all_features = self._load_all_features()
+        # Reload when tracks are ingested, waiting for a running ingestion
+        # to finish updating the indexes
+        with store_lock(shared=True):
+            self.version = get_store_version()
+            version = self.version
+            self.all_features, self.genre_activations = self._load_snapshot(version)
+            self.genre_index = self._load_genre_index(version)
+            self.genre_summaries = self._load_genre_summaries(version)
+            self.descriptor_index = self._load_descriptor_index(version)
+            self.cluster_indexes = {
+                source: self._load_cluster_index(source, version)
+                for source in CLUSTER_SOURCES
+            }
+        # Reload when `dedup.py` rebuilds the map
+        self.duplicates_version = get_duplicate_map_version()
+        self.duplicate_map = self._load_duplicate_map(self.duplicates_version)
+        self.query_cache = self._get_query_cache()
         self.tracks = list(self.genre_activations.index)
 
+        # Skip clusterings that are not built or were not updated with new tracks
+        self.cluster_indexes = {
+            source: cluster_index
+            for source, cluster_index in self.cluster_indexes.items()
+            if cluster_index is not None and len(cluster_index) == len(self.tracks)
+        }
+
         self.create_sidebar()
         self.create_mainpage()
         self.results_handler()
 
-    @st.cache_data
-    def _load_genre_activations(_self):
+    # Loaded data is shared by all sessions with st.cache_resource instead of
+    # being copied for every caller, so it must be treated as read-only.
+    # Only the data of the latest feature store version is kept.
+    @st.cache_resource(max_entries=1)
+    def _load_snapshot(_self, version):
         """
-        Load the genre activations from the saved file.
+        Load the prebuilt query snapshot built by `snapshot.py`.
+
+        Args:
+            version (int): Feature store version, so new tracks are loaded
 
         Returns:
-            pd.DataFrame: DataFrame with genre activations
+            pd.DataFrame: DataFrame with all features
+            pd.DataFrame: Read-only DataFrame with genre activations
         """
-        genre_activation = get_saved_genre_activations()
-        file_paths = get_saved_file_paths()
-        genre_names = get_genre_names()
+        return load_snapshot()
 
-        # Create a DataFrame with the genre activations
-        genre_activation_df = pd.DataFrame(
-            genre_activation, columns=genre_names, index=file_paths
-        )
-        return genre_activation_df
+    @st.cache_resource(max_entries=1)
+    def _load_genre_index(_self, version):
+        """
+        Load the bitmap index over the genre activations.
+
+        Args:
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            GenreBitmapIndex: The index
+        """
+        return load_genre_bitmap_index()
 
-    @st.cache_data
-    def _load_all_features(_self):
+    @st.cache_resource(max_entries=1)
+    def _load_genre_summaries(_self, version):
         """
-        Load all features from the saved file.
+        Create the cache of the activation statistics of each genre, filled
+        as genres are selected.
+
+        Args:
+            version (int): Feature store version, so new tracks are loaded
 
         Returns:
-            pd.DataFrame: DataFrame with all features
+            dict: Genre names mapped to their statistics
         """
-        all_features = get_saved_all_features()
-        file_paths = get_saved_file_paths()
-        all_features_df = pd.DataFrame(all_features, index=file_paths)
+        return {}
 
-        # Extract the key and scale from the key_edma field
-        all_features_df["key"] = all_features_df["key_krumhansl"].apply(
-            lambda x: x.split(" ")[0]
-        )
-        all_features_df["scale"] = all_features_df["key_krumhansl"].apply(
-            lambda x: x.split(" ")[1]
-        )
+    @st.cache_resource(max_entries=1)
+    def _load_descriptor_index(_self, version):
+        """
+        Build the KD-tree over the descriptors for target point queries.
+
+        Args:
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            DescriptorIndex: The index
+        """
+        return DescriptorIndex(_self.all_features)
+
+    @st.cache_resource(max_entries=len(CLUSTER_SOURCES))
+    def _load_cluster_index(_self, source, version):
+        """
+        Load the clustering built by `clustering.py`.
 
-        return all_features_df
+        Args:
+            source (str): Clustered features, "discogs", "msd" or "genres"
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            ClusterIndex: The index, or None if it has not been built or is stale
+        """
+        return load_cluster_index(source)
+
+    @st.cache_resource(max_entries=1)
+    def _load_duplicate_map(_self, duplicates_version):
+        """
+        Load the duplicate map built by `dedup.py`.
+
+        Args:
+            duplicates_version (int): Version of the map, so a rebuilt map is loaded
+
+        Returns:
+            dict: Duplicate track paths mapped to the first track of their cluster
+        """
+        return load_duplicate_map()
+
+    @st.cache_resource
+    def _get_query_cache(_self):
+        """
+        Create the query result cache shared by all sessions.
+
+        Returns:
+            QueryCache: The cache
+        """
+        return QueryCache()
+
+    def get_genre_summary(self, genres):
+        """
+        Return the activation statistics of some genres, computing each genre
+        once per feature store version.
+
+        Args:
+            genres (list): Genre names
+
+        Returns:
+            pd.DataFrame: Statistics of each genre
+        """
+        for genre in genres:
+            if genre not in self.genre_summaries:
+                self.genre_summaries[genre] = self.genre_activations[genre].describe()
+        return pd.concat([self.genre_summaries[genre] for genre in genres], axis=1)
 
     def create_sidebar(self):
         """
@@ -83,14 +195,8 @@ class DescriptorPlaylist:
         self.danceability_slider = st.sidebar.slider(f"Danceability", value=[0.0, 1.0])
         self.arousal_slider = st.sidebar.slider(f"Arousal", value=[0.0, 9.0])
         self.valence_slider = st.sidebar.slider(f"Valence", value=[0.0, 9.0])
-        self.key_select = st.sidebar.multiselect(
-            "Key",
-            ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"],
-        )
-        self.scale_select = st.sidebar.multiselect(
-            "Scale",
-            ["major", "minor"],
-        )
+        self.key_select = st.sidebar.multiselect("Key", TONICS)
+        self.scale_select = st.sidebar.multiselect("Scale", SCALES)
 
     def create_mainpage(self):
         """
@@ -107,13 +213,31 @@ class DescriptorPlaylist:
         # Select genre activations
         genre_names = self.genre_activations.columns
         st.write("Loaded audio analysis for", len(self.genre_activations), "tracks.")
+
+        # Browse the clusters of similar sounding tracks
+        st.write("## 🧭 Browse by sound")
+        self.cluster_select = None
+        if self.cluster_indexes:
+            self.cluster_source = st.selectbox(
+                "Cluster by:", list(self.cluster_indexes)
+            )
+            cluster_index = self.cluster_indexes[self.cluster_source]
+            self.cluster_select = st.selectbox(
+                "Select tracks from the cluster:",
+                cluster_index.get_clusters(),
+                index=None,
+                format_func=cluster_index.get_label,
+            )
+        else:
+            st.write("Run `clustering.py` to browse the tracks by clusters.")
+
         st.write("## 🔍 Select by Genre")
 
         self.genre_select = st.multiselect("Select by genre activations:", genre_names)
 
         if self.genre_select:
             # Show the distribution of activation values for the selected styles.
-            st.write(self.genre_activations[self.genre_select].describe())
+            st.write(self.get_genre_summary(self.genre_select))
 
             genre_select_str = ", ".join(self.genre_select)
             self.genre_activation_range = st.slider(
@@ -129,6 +253,29 @@ class DescriptorPlaylist:
             [],
         )
 
+        # Order by the distance to target descriptor values
+        st.write("## 🎯 Target")
+        self.target_select = st.multiselect(
+            "Order by the distance to target values of:",
+            list(TARGET_SLIDERS),
+            format_func=lambda column: TARGET_SLIDERS[column][0],
+        )
+        self.target = {}
+        for column in self.target_select:
+            label, low, high, default = TARGET_SLIDERS[column]
+            self.target[column] = st.slider(
+                f"Target {label}", min_value=low, max_value=high, value=default
+            )
+        if self.target:
+            self.target_k = st.number_input(
+                "Number of closest tracks (0 for all):", min_value=0, step=1, value=50
+            )
+            self.target_radius = st.number_input(
+                "Maximum distance in standard deviations (0 for no limit):",
+                min_value=0.0,
+                value=0.0,
+            )
+
         # Post-process to limit the number of tracks and add shuffle
         st.write("## 🔀 Post-process")
         self.max_tracks = st.number_input(
@@ -144,12 +291,74 @@ class DescriptorPlaylist:
             None
         """
         st.write("## 🔊 Results")
-        self.process_genre_fields()
-        self.process_sidebar_fields()
+
+        # Reuse the results of identical queries on the same tracks
+        key = self.get_query_key()
+        result = self.query_cache.get(key)
+        if result is None:
+            self.ranked = None
+            self.process_cluster_fields()
+            self.process_genre_fields()
+            self.process_sidebar_fields()
+            self.process_target_fields()
+            result = (tuple(self.tracks), self.ranked)
+            self.query_cache.put(key, result)
+        tracks, self.ranked = result
+        self.tracks = list(tracks)
+
+        if self.ranked is not None:
+            st.write("Applied ranking by audio style predictions.")
+            display_table(self.ranked, "ranked")
+        if self.target:
+            st.write("Ordered by the distance to the target values.")
         self.post_process()
         self.display_playlist()
+        self.display_cache_stats()
         self.save_playlist()
 
+    def get_query_key(self):
+        """
+        Build the query cache key of the selected filters.
+
+        Returns:
+            tuple: Hashable key
+        """
+        params = {
+            "duplicates": self.duplicates_version,
+            "cluster": (
+                (self.cluster_source, self.cluster_select)
+                if self.cluster_select is not None
+                else None
+            ),
+            "genres": set(self.genre_select),
+            "genre_range": self.genre_activation_range if self.genre_select else None,
+            "rank": self.genre_rank,
+            "tempo": self.tempo_slider,
+            "danceability": self.danceability_slider,
+            "arousal": self.arousal_slider,
+            "valence": self.valence_slider,
+            "voice_instrumental": set(self.voice_instrumental_select),
+            "keys": set(self.key_select),
+            "scales": set(self.scale_select),
+            "target": self.target,
+        }
+        if self.target:
+            params["target_k"] = self.target_k
+            params["target_radius"] = self.target_radius
+        return self.query_cache.make_key(self.version, "descriptor", **params)
+
+    def process_cluster_fields(self):
+        """
+        Process the cluster field to select the tracks of a cluster.
+
+        Returns:
+            None
+        """
+        if self.cluster_select is not None:
+            cluster_index = self.cluster_indexes[self.cluster_source]
+            cluster_tracks = cluster_index.get_tracks(self.cluster_select)
+            self.tracks = list(self.genre_activations.index[cluster_tracks])
+
     def process_genre_fields(self):
         """
         Process the genre fields to filter the tracks.
@@ -158,16 +367,17 @@ class DescriptorPlaylist:
             None
         """
         if self.genre_select:
-            audio_analysis_query = self.genre_activations.loc[self.tracks][
-                self.genre_select
-            ]
-
             # Extract all tracks that have at least one genre activation within the selected range.
-            audio_analysis_query = audio_analysis_query[
-                (audio_analysis_query >= self.genre_activation_range[0]).any(axis=1)
-                & (audio_analysis_query <= self.genre_activation_range[1]).any(axis=1)
+            matching = self.genre_index.query(
+                self.genre_select,
+                self.genre_activation_range[0],
+                self.genre_activation_range[1],
+            )
+            tracks = pd.Index(self.tracks)
+            audio_analysis_query = tracks[
+                tracks.isin(self.genre_activations.index[matching])
             ]
-            self.tracks = list(audio_analysis_query.index)
+            self.tracks = list(audio_analysis_query)
 
         if self.genre_rank:
             audio_analysis_query = self.genre_activations.loc[self.tracks][
@@ -177,11 +387,8 @@ class DescriptorPlaylist:
             for style in self.genre_rank[1:]:
                 audio_analysis_query["RANK"] *= audio_analysis_query[style]
             ranked = audio_analysis_query.sort_values(["RANK"], ascending=[False])
-            ranked = ranked[["RANK"] + self.genre_rank]
-            self.tracks = list(ranked.index)
-
-            st.write("Applied ranking by audio style predictions.")
-            st.write(ranked)
+            self.ranked = ranked[["RANK"] + self.genre_rank]
+            self.tracks = list(self.ranked.index)
 
     def process_sidebar_fields(self):
         """
@@ -251,32 +458,46 @@ class DescriptorPlaylist:
 
             self.tracks = list(audio_analysis_query.index)
 
-        # Filter by key
-        if self.key_select:
-            audio_analysis_query = self.all_features.loc[self.tracks]["key"]
+        # Filter by key and scale with a lookup table over the krumhansl key codes
+        if self.key_select or self.scale_select:
+            audio_analysis_query = self.all_features.loc[self.tracks]["key_krumhansl"]
 
+            key_table = key_lookup_table(self.key_select, self.scale_select)
             audio_analysis_query = audio_analysis_query[
-                audio_analysis_query.isin(self.key_select)
+                filter_codes(audio_analysis_query, key_table)
             ]
             self.tracks = list(audio_analysis_query.index)
 
-        # Filter by scale
-        if self.scale_select:
-            audio_analysis_query = self.all_features.loc[self.tracks]["scale"]
+    def process_target_fields(self):
+        """
+        Keep the tracks closest to the target descriptor values, closest first.
 
-            audio_analysis_query = audio_analysis_query[
-                audio_analysis_query.isin(self.scale_select)
-            ]
-            self.tracks = list(audio_analysis_query.index)
+        Returns:
+            None
+        """
+        if not self.target:
+            return
+
+        # Only restrict the search when the filters removed some tracks
+        tracks = self.tracks if len(self.tracks) < len(self.all_features) else None
+        self.tracks = self.descriptor_index.query(
+            self.target,
+            k=self.target_k,
+            radius=self.target_radius or float("inf"),
+            tracks=tracks,
+        )
 
     def post_process(self):
         """
-        Post-process the tracks to limit the number and add shuffle.
+        Post-process the tracks to collapse duplicates, limit the number and add shuffle.
 
         Returns:
             None
         """
 
+        if self.duplicate_map:
+            self.tracks = collapse_duplicates(self.tracks, self.duplicate_map)
+
         if self.max_tracks:
             self.tracks = self.tracks[: self.max_tracks]
             st.write("Using top", len(self.tracks), "tracks from the results.")
@@ -285,6 +506,19 @@ class DescriptorPlaylist:
             random.shuffle(self.tracks)
             st.write("Applied random shuffle.")
 
+    def display_cache_stats(self):
+        """
+        Display the hit rate of the query cache.
+
+        Returns:
+            None
+        """
+        stats = self.query_cache.get_stats()
+        st.caption(
+            f"Query cache: {stats['hit_rate']:.0%} hit rate over "
+            f"{stats['hits'] + stats['misses']} queries, {stats['entries']} cached."
+        )
+
     def display_playlist(self):
         """
         Display the playlist with audio previews.
@@ -293,10 +527,13 @@ class DescriptorPlaylist:
             None
         """
         st.write(f"Total tracks in the playlist: {len(self.tracks)}")
-        display_tracks = self.tracks[:10]
-        st.write(f"Audio previews for the first {len(display_tracks)} results:")
-        for mp3 in display_tracks:
-            st.audio(mp3, format="audio/mp3", start_time=0)
+        if not self.tracks:
+            return
+        start, stop = paginate(len(self.tracks), "playlist", PREVIEWS_PAGE_SIZE)
+        st.write(f"Audio previews for results {start + 1}-{stop}:")
+        for mp3 in self.tracks[start:stop]:
+            # Serve a short cached excerpt instead of the full file
+            st.audio(get_preview(mp3), format="audio/mp3", start_time=0)
 
     def save_playlist(self):
         """
@@ -1,13 +1,22 @@
 import os
 import streamlit as st
-import numpy as np
 import random
-from fileio import (
-    get_saved_file_paths,
-    get_saved_discogs_embeddings,
-    get_saved_msd_embeddings,
+from fileio import get_saved_file_paths, get_store_version, store_lock
+from quantization import load_pq_index
+from knn_graph import load_knn_graph, get_normalized_embeddings, top_k_neighbours
+from clustering import load_cluster_index
+from dedup import load_duplicate_map, get_duplicate_map_version, collapse_duplicates
+from previews import get_preview
+from query_cache import QueryCache
+from pagination import paginate
+from config import (
+    DISCOGS_EMBEDDINGS_PATH,
+    MSD_EMBEDDINGS_PATH,
+    PLAYLISTS_DIR_PATH,
+    DEDUP_SEARCH_MARGIN,
+    CLUSTER_SOURCES,
+    PREVIEWS_PAGE_SIZE,
 )
-from config import DISCOGS_EMBEDDINGS_PATH, MSD_EMBEDDINGS_PATH, PLAYLISTS_DIR_PATH
 
 
 class EmbeddingPlaylist:
@@ -15,18 +24,55 @@ class EmbeddingPlaylist:
         """
         Create a playlist based on audio analysis data.
         """
-        self.discogs_embeddings_similarity = self._cosine_similarity("discogs")
-        self.msd_embeddings_similarity = self._cosine_similarity("msd")
-        self.all_tracks = self._load_file_paths()
+        # Reload when tracks are ingested, waiting for a running ingestion
+        # to finish updating the indexes
+        with store_lock(shared=True):
+            self.version = get_store_version()
+            version = self.version
+            self.all_tracks = self._load_file_paths(version)
+
+            # Look up precomputed neighbours when a graph is built, search
+            # compressed PQ codes when an index is built, otherwise fall back
+            # to exact cosine against the embeddings, which ingestion appends
+            # to without rebuilding anything
+            self.discogs_graph = self._load_knn_graph("discogs", version)
+            self.msd_graph = self._load_knn_graph("msd", version)
+            self.discogs_index = self._load_pq_index("discogs", version)
+            self.msd_index = self._load_pq_index("msd", version)
+            if self.discogs_index is None:
+                self.discogs_vectors = self._load_vectors("discogs", version)
+            if self.msd_index is None:
+                self.msd_vectors = self._load_vectors("msd", version)
+            self.cluster_indexes = {
+                source: self._load_cluster_index(source, version)
+                for source in CLUSTER_SOURCES
+            }
+        # Reload when `dedup.py` rebuilds the map
+        self.duplicates_version = get_duplicate_map_version()
+        self.duplicate_map = self._load_duplicate_map(self.duplicates_version)
+        self.query_cache = self._get_query_cache()
+
+        # Skip clusterings that are not built or were not updated with new tracks
+        self.cluster_indexes = {
+            source: cluster_index
+            for source, cluster_index in self.cluster_indexes.items()
+            if cluster_index is not None and len(cluster_index) == len(self.all_tracks)
+        }
 
         self.create_page()
         self.results_handler()
 
-    @st.cache_data
-    def _load_file_paths(_self):
+    # Loaded data is shared by all sessions with st.cache_resource instead of
+    # being copied for every caller, so it must be treated as read-only.
+    # Only the data of the latest feature store version is kept.
+    @st.cache_resource(max_entries=1)
+    def _load_file_paths(_self, version):
         """
         Load the file paths from the saved file.
 
+        Args:
+            version (int): Feature store version, so new tracks are loaded
+
         Returns:
             list: The file paths.
         """
@@ -34,28 +80,90 @@ class EmbeddingPlaylist:
         file_paths = get_saved_file_paths()
         return file_paths
 
-    @st.cache_data
-    def _cosine_similarity(_self, embedding_name):
+    @st.cache_resource(max_entries=1)
+    def _load_duplicate_map(_self, duplicates_version):
+        """
+        Load the duplicate map built by `dedup.py`.
+
+        Args:
+            duplicates_version (int): Version of the map, so a rebuilt map is loaded
+
+        Returns:
+            dict: Duplicate track paths mapped to the first track of their cluster.
+        """
+
+        return load_duplicate_map()
+
+    @st.cache_resource
+    def _get_query_cache(_self):
+        """
+        Create the query result cache shared by all sessions.
+
+        Returns:
+            QueryCache: The cache.
+        """
+
+        return QueryCache()
+
+    @st.cache_resource(max_entries=2)
+    def _load_knn_graph(_self, embedding_name, version):
         """
-        Compute the cosine similarity between the embedding vectors.
+        Load the neighbour table built by `knn_graph.py`.
 
         Args:
             embedding_name (str): The name of the embedding to use.
+            version (int): Feature store version, so new tracks are loaded
 
         Returns:
-            np.array: The cosine similarity matrix.
+            KNNGraph: The graph, or None if it has not been built or is stale.
         """
 
-        if embedding_name == "discogs":
-            embeddings_func = get_saved_discogs_embeddings
-        elif embedding_name == "msd":
-            embeddings_func = get_saved_msd_embeddings
-        else:
-            raise ValueError("Invalid embedding name.")
+        return load_knn_graph(embedding_name)
+
+    @st.cache_resource(max_entries=2)
+    def _load_pq_index(_self, embedding_name, version):
+        """
+        Load the product-quantised index built by `quantization.py`.
 
-        A = embeddings_func()
-        Anorm = A / np.linalg.norm(A, axis=1)[:, np.newaxis]
-        return np.dot(Anorm, Anorm.T)
+        Args:
+            embedding_name (str): The name of the embedding to use.
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            PQIndex: The index, or None if it has not been built.
+        """
+
+        return load_pq_index(embedding_name)
+
+    @st.cache_resource(max_entries=len(CLUSTER_SOURCES))
+    def _load_cluster_index(_self, source, version):
+        """
+        Load the clustering built by `clustering.py`.
+
+        Args:
+            source (str): Clustered features, "discogs", "msd" or "genres".
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            ClusterIndex: The index, or None if it has not been built or is stale.
+        """
+
+        return load_cluster_index(source)
+
+    @st.cache_resource(max_entries=2)
+    def _load_vectors(_self, embedding_name, version):
+        """
+        Load the embedding vectors from the shared store with unit length rows.
+
+        Args:
+            embedding_name (str): The name of the embedding to use.
+            version (int): Feature store version, so new tracks are loaded
+
+        Returns:
+            np array: The normalised embeddings.
+        """
+
+        return get_normalized_embeddings(embedding_name)
 
     def create_page(self):
         # Title and Description
@@ -76,7 +184,9 @@ class EmbeddingPlaylist:
             # Display the selected track
             if self.track_select:
                 st.write("### Selected Track")
-                st.audio(self.track_select, format="audio/mp3", start_time=0)
+                st.audio(
+                    get_preview(self.track_select), format="audio/mp3", start_time=0
+                )
 
             # Select the number of tracks for the playlist
             st.write("### Select number of required tracks for the playlists")
@@ -84,6 +194,21 @@ class EmbeddingPlaylist:
                 "Number of tracks(0 for all)", min_value=0, max_value=100, value=10
             )
 
+            # Select a cluster of similar sounding tracks to browse
+            self.cluster_select = None
+            if self.cluster_indexes:
+                st.write("### Or browse by sound")
+                self.cluster_source = st.selectbox(
+                    "Cluster by", list(self.cluster_indexes)
+                )
+                cluster_index = self.cluster_indexes[self.cluster_source]
+                self.cluster_select = st.selectbox(
+                    "Select the cluster",
+                    cluster_index.get_clusters(),
+                    index=None,
+                    format_func=cluster_index.get_label,
+                )
+
     def results_handler(self):
         """
         Handle the results and display the playlist.
@@ -98,6 +223,9 @@ class EmbeddingPlaylist:
                 self.process_discogs()
             with col2:
                 self.process_msd()
+        if self.cluster_select is not None:
+            self.process_cluster()
+        self.display_cache_stats()
 
     def process_discogs(self):
         """
@@ -108,7 +236,7 @@ class EmbeddingPlaylist:
         """
         st.write("### Discogs Playlist")
         self.top_discogs_similar_tracks = self.find_similar_tracks("discogs")
-        self.display_playlist(self.top_discogs_similar_tracks)
+        self.display_playlist(self.top_discogs_similar_tracks, "discogs")
         self.save_discogs_playlist()
 
     def process_msd(self):
@@ -120,12 +248,54 @@ class EmbeddingPlaylist:
         """
         st.write("### MSD Playlist")
         self.top_msd_similar_tracks = self.find_similar_tracks("msd")
-        self.display_playlist(self.top_msd_similar_tracks)
+        self.display_playlist(self.top_msd_similar_tracks, "msd")
         self.save_msd_playlist()
 
+    def process_cluster(self):
+        """
+        Display the playlist of the selected cluster.
+
+        Returns:
+            None
+        """
+        st.write("## 🧭 Cluster Playlist")
+        cluster_index = self.cluster_indexes[self.cluster_source]
+        cluster_tracks = collapse_duplicates(
+            [self.all_tracks[i] for i in cluster_index.get_tracks(self.cluster_select)],
+            self.duplicate_map,
+        )
+        self.cluster_tracks = cluster_tracks[: self.playlist_length or None]
+        self.display_playlist(self.cluster_tracks, "cluster")
+        self.save_cluster_playlist()
+
     def find_similar_tracks(self, embedding_name):
         """
-        Get the top similar tracks to the selected track using the embeddings.
+        Get the top similar tracks to the selected track using the embeddings,
+        reusing the results of identical queries on the same tracks.
+
+        Args:
+            embedding_name (str): The name of the embedding to use.
+
+        Returns:
+            list: The top similar tracks.
+        """
+        key = self.query_cache.make_key(
+            self.version,
+            "similarity",
+            duplicates=self.duplicates_version,
+            embedding=embedding_name,
+            track=self.track_select,
+            length=self.playlist_length,
+        )
+        similar_tracks = self.query_cache.get(key)
+        if similar_tracks is None:
+            similar_tracks = tuple(self.search_similar_tracks(embedding_name))
+            self.query_cache.put(key, similar_tracks)
+        return list(similar_tracks)
+
+    def search_similar_tracks(self, embedding_name):
+        """
+        Search the top similar tracks to the selected track using the embeddings.
 
         Args:
             embedding_name (str): The name of the embedding to use.
@@ -134,31 +304,76 @@ class EmbeddingPlaylist:
             list: The top similar tracks.
         """
         if embedding_name == "discogs":
-            similarity_matrix = self.discogs_embeddings_similarity
+            graph, index = self.discogs_graph, self.discogs_index
         elif embedding_name == "msd":
-            similarity_matrix = self.msd_embeddings_similarity
+            graph, index = self.msd_graph, self.msd_index
         else:
             raise ValueError("Invalid embedding name.")
 
+        # Fetch extra candidates so the playlist stays full once duplicates are collapsed
+        n_candidates = (
+            self.playlist_length + DEDUP_SEARCH_MARGIN if self.playlist_length else 0
+        )
+
         track_index = self.all_tracks.index(self.track_select)
-        top_similar_indexes = np.argsort(similarity_matrix[track_index])[::-1][
-            1 : self.playlist_length + 1
-        ]
+        if (
+            graph is not None
+            and len(graph) == len(self.all_tracks)
+            and 0 < n_candidates <= graph.k
+        ):
+            top_similar_indexes = graph.search(track_index, n_candidates)
+        elif index is not None and len(index) == len(self.all_tracks):
+            top_similar_indexes = index.search(track_index, n_candidates)
+        else:
+            if embedding_name == "discogs":
+                vectors = self.discogs_vectors
+            else:
+                vectors = self.msd_vectors
+
+            top_similar_indexes, _ = top_k_neighbours(
+                vectors, [track_index], n_candidates or len(vectors), threads=1
+            )
+            top_similar_indexes = top_similar_indexes[0]
+
+        similar_tracks = collapse_duplicates(
+            [self.all_tracks[i] for i in top_similar_indexes],
+            self.duplicate_map,
+            exclude=self.track_select,
+        )
+        return similar_tracks[: self.playlist_length or None]
 
-        return [self.all_tracks[i] for i in top_similar_indexes]
+    def display_cache_stats(self):
+        """
+        Display the hit rate of the query cache.
+
+        Returns:
+            None
+        """
+        stats = self.query_cache.get_stats()
+        st.caption(
+            f"Query cache: {stats['hit_rate']:.0%} hit rate over "
+            f"{stats['hits'] + stats['misses']} queries, {stats['entries']} cached."
+        )
 
-    def display_playlist(self, playlist):
+    def display_playlist(self, playlist, key):
         """
         Display the playlist with audio previews.
 
+        Args:
+            playlist (list): The tracks of the playlist.
+            key (str): Unique widget key of the playlist.
+
         Returns:
             None
         """
         st.write(f"Total tracks in the playlist: {len(playlist)}")
-        display_tracks = playlist[:10]
-        st.write(f"Audio previews for the first {len(display_tracks)} results:")
-        for mp3 in display_tracks:
-            st.audio(mp3, format="audio/mp3", start_time=0)
+        if not playlist:
+            return
+        start, stop = paginate(len(playlist), key, PREVIEWS_PAGE_SIZE)
+        st.write(f"Audio previews for results {start + 1}-{stop}:")
+        for mp3 in playlist[start:stop]:
+            # Serve a short cached excerpt instead of the full file
+            st.audio(get_preview(mp3), format="audio/mp3", start_time=0)
 
     def save_discogs_playlist(self):
         """
@@ -212,6 +427,30 @@ class EmbeddingPlaylist:
                 f.write("\n".join(mp3_paths))
                 st.write(f"Stored msd playlist to `{playlist_path}`.")
 
+    def save_cluster_playlist(self):
+        """
+        Save the cluster playlist to a file.
+
+        Returns:
+            None
+        """
+        # Add a button for saving the playlist
+        st.write("#### 💾 Save Cluster Playlist")
+        self.cluster_playlist_name = st.text_input(
+            "Cluster Playlist name:", "cluster_playlist"
+        )
+        if st.button("Save Cluster Playlist"):
+            playlist_path = os.path.join(
+                PLAYLISTS_DIR_PATH, f"{self.cluster_playlist_name}.m3u8"
+            )
+
+            with open(playlist_path, "w") as f:
+                # Modify relative mp3 paths to make them accessible from the playlist folder.
+                mp3_paths = [os.path.join("..", mp3) for mp3 in self.cluster_tracks]
+
+                f.write("\n".join(mp3_paths))
+                st.write(f"Stored cluster playlist to `{playlist_path}`.")
+
 
 def main():
     embedding_playlist = EmbeddingPlaylist()
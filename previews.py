@@ -0,0 +1,159 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from tqdm import tqdm
+from fileio import create_dir_if_not_exist, get_saved_file_paths
+from config import (
+    PREVIEW_DIR_PATH,
+    PREVIEW_SECONDS,
+    PREVIEW_BITRATE,
+    PREVIEW_SAMPLE_RATE,
+    PREVIEW_CACHE_MAX_MB,
+)
+
+create_dir_if_not_exist(PREVIEW_DIR_PATH)
+
+
+def get_preview_start(audio, sample_rate, seconds=PREVIEW_SECONDS):
+    """
+    Find the start of the excerpt with the highest energy, as a proxy for the
+    most representative part of the track
+
+    Args:
+        audio (np array): Mono audio
+        sample_rate (int): Sample rate of the audio
+        seconds (float): Length of the excerpt
+
+    Returns:
+        int : Start sample of the excerpt
+    """
+
+    length = int(seconds * sample_rate)
+    if len(audio) <= length:
+        return 0
+
+    # Energy per one second block, summed over sliding windows of blocks
+    block = int(sample_rate)
+    n_blocks = len(audio) // block
+    energy = np.square(audio[: n_blocks * block], dtype=np.float64)
+    energy = energy.reshape(n_blocks, block).sum(axis=1)
+    window = min(int(seconds), n_blocks)
+    window_energy = np.convolve(energy, np.ones(window), mode="valid")
+    start = int(np.argmax(window_energy)) * block
+    return min(start, len(audio) - length)
+
+
+def get_preview_path(audio_path):
+    """
+    Return the cache path of the preview of an audio file. The key includes
+    the size and modification time of the file and the preview settings, so
+    changed files and settings get new previews.
+
+    Args:
+        audio_path (str): Path to the audio file
+
+    Returns:
+        str : Path to the cached preview
+    """
+
+    stat = os.stat(audio_path)
+    key = (
+        f"{os.path.abspath(audio_path)}:{stat.st_size}:{stat.st_mtime_ns}:"
+        f"{PREVIEW_SECONDS}:{PREVIEW_BITRATE}:{PREVIEW_SAMPLE_RATE}"
+    )
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return os.path.join(PREVIEW_DIR_PATH, f"{digest}.mp3")
+
+
+def create_preview(audio_path, preview_path):
+    """
+    Encode a low bitrate excerpt of an audio file
+
+    Args:
+        audio_path (str): Path to the audio file
+        preview_path (str): Path of the mp3 preview to write
+
+    Returns:
+        None
+    """
+
+    # Essentia is only needed on a cache miss, so the apps start without it
+    import essentia.standard as estd
+
+    audio = estd.MonoLoader(filename=audio_path, sampleRate=PREVIEW_SAMPLE_RATE)()
+    start = get_preview_start(audio, PREVIEW_SAMPLE_RATE)
+    excerpt = audio[start : start + int(PREVIEW_SECONDS * PREVIEW_SAMPLE_RATE)]
+
+    # Encode to a temporary file and rename it, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=PREVIEW_DIR_PATH, suffix=".mp3.tmp")
+    os.close(fd)
+    try:
+        estd.MonoWriter(
+            filename=tmp_path,
+            format="mp3",
+            bitrate=PREVIEW_BITRATE,
+            sampleRate=PREVIEW_SAMPLE_RATE,
+        )(excerpt)
+        os.replace(tmp_path, preview_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def evict_previews(max_mb=PREVIEW_CACHE_MAX_MB):
+    """
+    Delete the least recently used previews until the cache fits its limit
+
+    Args:
+        max_mb (float): Maximum total size of the previews in MB
+
+    Returns:
+        None
+    """
+
+    previews = []
+    for entry in os.scandir(PREVIEW_DIR_PATH):
+        if entry.name.endswith(".mp3"):
+            stat = entry.stat()
+            previews.append((stat.st_mtime, stat.st_size, entry.path))
+
+    excess = sum(size for _, size, _ in previews) - max_mb * 2**20
+    for _, size, path in sorted(previews):
+        if excess <= 0:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        excess -= size
+
+
+def get_preview(audio_path):
+    """
+    Return a cached preview of an audio file, creating it on a miss. The
+    modification time of a preview marks its last use for eviction.
+
+    Args:
+        audio_path (str): Path to the audio file
+
+    Returns:
+        str : Path to the preview, or to the audio file if no preview could be made
+    """
+
+    try:
+        preview_path = get_preview_path(audio_path)
+        if os.path.exists(preview_path):
+            os.utime(preview_path)
+            return preview_path
+        create_preview(audio_path, preview_path)
+    except Exception:
+        return audio_path
+    evict_previews()
+    return preview_path
+
+
+if __name__ == "__main__":
+    # Warm the cache, most useful when it can hold the whole collection
+    for path in tqdm(get_saved_file_paths()):
+        get_preview(path)
@@ -0,0 +1,409 @@
+import os
+import numpy as np
+from fileio import (
+    get_saved_embeddings,
+    append_npy,
+    replace_atomically,
+    is_older_than,
+    get_feature_paths,
+)
+from config import (
+    DISCOGS_VECTORS_PATH,
+    MSD_VECTORS_PATH,
+    DISCOGS_PQ_INDEX_PATH,
+    MSD_PQ_INDEX_PATH,
+    PQ_SUBVECTORS,
+    PQ_CENTROIDS,
+    PQ_TRAIN_SAMPLE,
+    PQ_KMEANS_ITERATIONS,
+    PQ_RERANK_CANDIDATES,
+)
+
+
+def get_index_paths(embedding_name):
+    """
+    Return the paths of the full vectors and the PQ index for an embedding
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        str : Path to the normalised float32 vectors
+        str : Path to the PQ codebooks and codes
+    """
+
+    if embedding_name == "discogs":
+        return DISCOGS_VECTORS_PATH, DISCOGS_PQ_INDEX_PATH
+    elif embedding_name == "msd":
+        return MSD_VECTORS_PATH, MSD_PQ_INDEX_PATH
+    else:
+        raise ValueError("Invalid embedding name.")
+
+
+def normalize_rows(vectors):
+    """
+    Scale every row to unit length so squared L2 distance ranks like cosine
+
+    Args:
+        vectors (np array): 2D array of vectors
+
+    Returns:
+        np array : float32 array with unit length rows
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def squared_distances(vectors, centroids):
+    """
+    Squared L2 distance between every vector and every centroid
+
+    Args:
+        vectors (np array): Array of shape (N, D)
+        centroids (np array): Array of shape (K, D)
+
+    Returns:
+        np array : Array of shape (N, K)
+    """
+
+    distances = (
+        np.sum(vectors**2, axis=1)[:, np.newaxis]
+        - 2 * vectors @ centroids.T
+        + np.sum(centroids**2, axis=1)[np.newaxis, :]
+    )
+    return np.maximum(distances, 0)
+
+
+def kmeans(vectors, n_clusters, n_iter, rng):
+    """
+    Lloyd's k-means used to train one sub-quantiser
+
+    Args:
+        vectors (np array): Training vectors of shape (N, D)
+        n_clusters (int): Number of centroids
+        n_iter (int): Number of iterations
+        rng (np.random.Generator): Random generator for the initialisation
+
+    Returns:
+        np array : Centroids of shape (n_clusters, D)
+    """
+
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmin(squared_distances(vectors, centroids), axis=1)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # Keep the previous centroid for clusters that lost all their points
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    return centroids
+
+
+class ProductQuantizer:
+    def __init__(self, n_subvectors, n_centroids=PQ_CENTROIDS, seed=0):
+        """
+        Product quantiser that splits vectors into subvectors and stores one
+        byte per subvector.
+
+        Args:
+            n_subvectors (int): Number of subvectors, also the code size in bytes
+            n_centroids (int): Number of centroids per subvector, at most 256
+            seed (int): Seed for sampling and centroid initialisation
+        """
+        if n_centroids > 256:
+            raise ValueError("At most 256 centroids fit in a one byte code.")
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.seed = seed
+        self.codebooks = None
+
+    def _split(self, vectors):
+        """
+        Reshape vectors of shape (N, D) into (N, M, D / M) subvectors.
+
+        Args:
+            vectors (np array): Array of shape (N, D)
+
+        Returns:
+            np array : Array of shape (N, M, D / M)
+        """
+        n, dim = vectors.shape
+        if dim % self.n_subvectors:
+            raise ValueError(
+                f"Dimension {dim} is not divisible by {self.n_subvectors} subvectors."
+            )
+        return vectors.reshape(n, self.n_subvectors, dim // self.n_subvectors)
+
+    def fit(self, vectors, train_sample=PQ_TRAIN_SAMPLE, n_iter=PQ_KMEANS_ITERATIONS):
+        """
+        Train one codebook per subvector on a sample of the vectors.
+
+        Args:
+            vectors (np array): Training vectors of shape (N, D)
+            train_sample (int): Maximum number of vectors used for training
+            n_iter (int): Number of k-means iterations
+
+        Returns:
+            ProductQuantizer : The fitted quantiser
+        """
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > train_sample:
+            vectors = vectors[np.sort(rng.choice(len(vectors), train_sample, replace=False))]
+        subvectors = self._split(np.asarray(vectors, dtype=np.float32))
+
+        n_centroids = min(self.n_centroids, len(subvectors))
+        self.codebooks = np.zeros(
+            (self.n_subvectors, n_centroids, subvectors.shape[2]), dtype=np.float32
+        )
+        for m in range(self.n_subvectors):
+            self.codebooks[m] = kmeans(subvectors[:, m], n_centroids, n_iter, rng)
+        return self
+
+    def encode(self, vectors, chunk_size=65536):
+        """
+        Encode vectors into one byte per subvector.
+
+        Args:
+            vectors (np array): Vectors of shape (N, D)
+            chunk_size (int): Number of vectors encoded at once
+
+        Returns:
+            np array : uint8 codes of shape (N, M)
+        """
+        codes = np.zeros((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            subvectors = self._split(
+                np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+            )
+            for m in range(self.n_subvectors):
+                codes[start : start + chunk_size, m] = np.argmin(
+                    squared_distances(subvectors[:, m], self.codebooks[m]), axis=1
+                )
+        return codes
+
+    def decode(self, codes):
+        """
+        Reconstruct approximate vectors from their codes.
+
+        Args:
+            codes (np array): uint8 codes of shape (N, M)
+
+        Returns:
+            np array : Approximate vectors of shape (N, D)
+        """
+        subvectors = self.codebooks[np.arange(self.n_subvectors), codes]
+        return subvectors.reshape(len(codes), -1)
+
+    def distance_table(self, query):
+        """
+        Squared distances from each query subvector to every centroid.
+
+        Args:
+            query (np array): Query vector of shape (D,)
+
+        Returns:
+            np array : Lookup table of shape (M, K)
+        """
+        query_subvectors = self._split(np.asarray(query, dtype=np.float32)[np.newaxis])[0]
+        return np.sum(
+            (self.codebooks - query_subvectors[:, np.newaxis, :]) ** 2, axis=2
+        )
+
+    def asymmetric_distances(self, query, codes):
+        """
+        Approximate squared distances between an uncompressed query and
+        compressed vectors, summed from the distance table.
+
+        Args:
+            query (np array): Query vector of shape (D,)
+            codes (np array): uint8 codes of shape (N, M)
+
+        Returns:
+            np array : Approximate squared distances of shape (N,)
+        """
+        table = self.distance_table(query)
+        distances = np.zeros(len(codes), dtype=np.float32)
+        for m in range(self.n_subvectors):
+            distances += table[m, codes[:, m]]
+        return distances
+
+
+class PQIndex:
+    def __init__(self, quantizer, codes, vectors):
+        """
+        Similarity index searching PQ codes in memory and re-ranking the best
+        candidates with the full vectors memory-mapped from disk.
+
+        Args:
+            quantizer (ProductQuantizer): Fitted quantiser
+            codes (np array): uint8 codes of shape (N, M)
+            vectors (np array): Normalised full vectors, usually a np.memmap
+        """
+        self.quantizer = quantizer
+        self.codes = codes
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.codes)
+
+    def search(self, track_index, k, rerank=PQ_RERANK_CANDIDATES):
+        """
+        Find the most similar tracks to a track in the index.
+
+        Args:
+            track_index (int): Index of the query track
+            k (int): Number of similar tracks to return, 0 for all
+            rerank (int): Number of PQ candidates re-ranked with exact cosine
+
+        Returns:
+            list: Indexes of the similar tracks, most similar first
+        """
+        query = np.asarray(self.vectors[track_index], dtype=np.float32)
+        distances = self.quantizer.asymmetric_distances(query, self.codes)
+        distances[track_index] = np.inf
+
+        n_others = len(self) - 1
+        k = n_others if k == 0 else min(k, n_others)
+        n_candidates = min(max(k, rerank), n_others)
+        if n_candidates <= 0:
+            return []
+        candidates = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+
+        # Exact cosine on the candidates, reading only their rows from disk
+        candidates = np.sort(candidates)
+        similarities = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+        order = np.argsort(similarities)[::-1][:k]
+        return [int(i) for i in candidates[order]]
+
+
+def build_pq_index(embedding_name):
+    """
+    Store normalised vectors for re-ranking and train and save the PQ index
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        None
+    """
+
+    vectors_path, index_path = get_index_paths(embedding_name)
+    vectors = normalize_rows(get_saved_embeddings(embedding_name))
+    np.save(vectors_path, vectors)
+
+    quantizer = ProductQuantizer(PQ_SUBVECTORS[embedding_name]).fit(vectors)
+    codes = quantizer.encode(vectors)
+    np.savez(index_path, codebooks=quantizer.codebooks, codes=codes)
+
+
+def load_pq_index(embedding_name):
+    """
+    Load the PQ index of an embedding if it is built and up to date
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        PQIndex : The index, or None if it has not been built or is stale
+    """
+
+    index_paths = get_index_paths(embedding_name)
+    source_paths = [get_feature_paths()[f"{embedding_name}_embeddings"]]
+    if any(is_older_than(path, source_paths) for path in index_paths):
+        return None
+    return load_stored_pq_index(embedding_name)
+
+
+def load_stored_pq_index(embedding_name):
+    """
+    Load the stored PQ index of an embedding, even if the embeddings were
+    written after it, to update it in place
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        PQIndex : The index, or None if it has not been built
+    """
+
+    vectors_path, index_path = get_index_paths(embedding_name)
+    if not (os.path.exists(vectors_path) and os.path.exists(index_path)):
+        return None
+
+    with np.load(index_path) as data:
+        codebooks = data["codebooks"]
+        codes = data["codes"]
+    quantizer = ProductQuantizer(codebooks.shape[0], codebooks.shape[1])
+    quantizer.codebooks = codebooks
+    vectors = np.load(vectors_path, mmap_mode="r")
+    return PQIndex(quantizer, codes, vectors)
+
+
+def append_to_pq_index(embedding_name, embeddings, n_rows):
+    """
+    Insert new tracks into a built PQ index, encoding them with the trained
+    codebooks. The codebooks are not retrained, rerun `quantization.py` once
+    the collection has grown a lot.
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        embeddings (np array): Mean embeddings of the new tracks
+        n_rows (int): Number of tracks the index must hold before the append
+
+    Returns:
+        bool: True if the tracks were inserted, False if the index is missing
+            or out of date and needs a rebuild
+    """
+
+    index = load_stored_pq_index(embedding_name)
+    if index is None or len(index) != n_rows or len(index.vectors) != n_rows:
+        return False
+
+    vectors_path, index_path = get_index_paths(embedding_name)
+    vectors = normalize_rows(embeddings)
+    codes = np.concatenate([index.codes, index.quantizer.encode(vectors)])
+    append_npy(vectors_path, vectors)
+    replace_atomically(
+        index_path,
+        lambda f: np.savez(f, codebooks=index.quantizer.codebooks, codes=codes),
+    )
+    return True
+
+
+def remove_from_pq_index(embedding_name, keep):
+    """
+    Drop tracks from a built PQ index, keeping the trained codebooks
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+        keep (np array): Boolean mask of the tracks to keep
+
+    Returns:
+        bool: True if the tracks were removed, False if the index is missing
+            or out of date and needs a rebuild
+    """
+
+    index = load_stored_pq_index(embedding_name)
+    if index is None or len(index) != len(keep) or len(index.vectors) != len(keep):
+        return False
+
+    vectors_path, index_path = get_index_paths(embedding_name)
+    vectors = np.asarray(index.vectors[keep])
+    codes = index.codes[keep]
+    replace_atomically(vectors_path, lambda f: np.save(f, vectors))
+    replace_atomically(
+        index_path,
+        lambda f: np.savez(f, codebooks=index.quantizer.codebooks, codes=codes),
+    )
+    return True
+
+
+if __name__ == "__main__":
+    for name in PQ_SUBVECTORS:
+        build_pq_index(name)
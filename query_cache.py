@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import QUERY_CACHE_MAX_ENTRIES
+
+
+def normalize_value(value):
+    """
+    Convert a query parameter to a hashable value that is equal for equal
+    queries. Sets are sorted, as the order of their items does not change
+    the results, while lists keep their order.
+
+    Args:
+        value (object): Query parameter
+
+    Returns:
+        object : Hashable normalised value
+    """
+
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(normalize_value(item) for item in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize_value(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(
+            sorted((key, normalize_value(item)) for key, item in value.items())
+        )
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+class QueryCache:
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        """
+        Bounded least recently used cache of playlist query results, shared
+        by the sessions of an app. Keys include the feature store version, so
+        results computed before an ingestion are never returned after it.
+
+        Args:
+            max_entries (int): Maximum number of cached results
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, version, namespace, **params):
+        """
+        Build the key of a query from its normalised parameters.
+
+        Args:
+            version (int): Feature store version
+            namespace (str): Kind of query
+            **params: Query parameters
+
+        Returns:
+            tuple: Hashable key
+        """
+        return (version, namespace, normalize_value(params))
+
+    def get(self, key):
+        """
+        Return a cached result, marking it as recently used.
+
+        Args:
+            key (tuple): Key from make_key
+
+        Returns:
+            object: The cached result, or None on a miss
+        """
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        """
+        Cache a result, dropping the results of older feature store versions
+        and the least recently used results above the limit. Results of a
+        version older than the cached ones, from sessions that started before
+        an ingestion, are not cached.
+
+        Args:
+            key (tuple): Key from make_key
+            result (object): Result to cache, which must not be modified later
+
+        Returns:
+            None
+        """
+        version = key[0]
+        with self.lock:
+            # Stores without a manifest have no version and come first
+            if self.version is not None and (version is None or version < self.version):
+                return
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Return the hit rate metrics of the cache.
+
+        Returns:
+            dict: Hits, misses, hit rate and number of cached results
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+            }
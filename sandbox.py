@@ -0,0 +1,414 @@
+import os
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from autotune import load_profile, apply_profile, get_profile
+from config import (
+    TRACK_TIMEOUT,
+    WORKER_SETUP_TIMEOUT,
+    WORKER_MEMORY_LIMIT_MB,
+    FAILURES_LOG_PATH,
+)
+
+# psutil is optional, resident memory is read from /proc without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Seconds between checks of the worker deadlines and memory
+POLL_INTERVAL = 0.5
+
+# Workers restarted in a row after dying or hanging before starting their
+# track, above which the setup of the workers is considered broken
+SETUP_RETRIES = 3
+
+
+def worker_main(conn):
+    """
+    Worker loop extracting the features of the paths received on a pipe. The
+    models are loaded in the worker, so a crash never takes the parent down.
+
+    Args:
+        conn (Connection): Pipe to the parent process
+
+    Returns:
+        None
+    """
+
+    # Configure TensorFlow before the models are loaded
+    apply_profile(load_profile())
+    from extraction import extract_track
+
+    while True:
+        path = conn.recv()
+        if path is None:
+            break
+        try:
+            result = extract_track(path, lambda stage: conn.send(("stage", stage)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+            continue
+        conn.send(("done", result))
+    conn.close()
+
+
+def get_rss_mb(pid):
+    """
+    Resident memory of a process in MB, read from /proc or with psutil on
+    platforms without /proc
+
+    Args:
+        pid (int): Process id
+
+    Returns:
+        float : Resident memory in MB, None if it cannot be read
+    """
+
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, IndexError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / 2**20
+        except psutil.Error:
+            pass
+    return None
+
+
+def get_file_signature(path):
+    """
+    Describe the version of a file by its size and modification time
+
+    Args:
+        path (str): Path of the file
+
+    Returns:
+        str: Size and modification time, empty if the file is missing
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ""
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_quarantined():
+    """
+    Load the paths that crashed, hung or ran out of memory in previous runs.
+    Files that changed since they failed are tried again.
+
+    Returns:
+        set: Quarantined paths
+    """
+
+    if not os.path.exists(FAILURES_LOG_PATH):
+        return set()
+    signatures = {}
+    with open(FAILURES_LOG_PATH) as f:
+        for line in f.read().splitlines():
+            if line:
+                path, signature = line.split("\t")[:2]
+                signatures[path] = signature
+    return {
+        path
+        for path, signature in signatures.items()
+        if signature == get_file_signature(path)
+    }
+
+
+def quarantine(path, stage, reason):
+    """
+    Append a failed path to the failure log with the version of the file and
+    the stage where it failed
+
+    Args:
+        path (str): Path of the audio file
+        stage (str): Stage running when the failure happened
+        reason (str): Description of the failure
+
+    Returns:
+        None
+    """
+
+    reason = " ".join(str(reason).split())
+    with open(FAILURES_LOG_PATH, "a") as f:
+        f.write(f"{path}\t{get_file_signature(path)}\t{stage}\t{reason}\n")
+
+
+class Worker:
+    def __init__(self, context):
+        """
+        Extraction worker process with the task it is running.
+
+        Args:
+            context (multiprocessing context): Context used to start the process
+        """
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.path = None
+        self.stage = None
+        self.assigned = None
+        self.started = None
+
+    def assign(self, path):
+        """
+        Send a path to the worker. The track deadline starts with its first
+        stage, as a new worker first loads the models.
+
+        Args:
+            path (str): Path of the audio file
+
+        Returns:
+            None
+        """
+        self.path = path
+        self.stage = "queued"
+        self.assigned = time.monotonic()
+        self.started = None
+        self.conn.send(path)
+
+    def release(self):
+        """
+        Mark the worker as idle.
+
+        Returns:
+            str: Path the worker was running
+            str: Last stage of the path
+        """
+        path, stage = self.path, self.stage
+        self.path, self.stage = None, None
+        self.assigned, self.started = None, None
+        return path, stage
+
+    def kill(self):
+        """
+        Kill the worker process.
+
+        Returns:
+            None
+        """
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    def __init__(
+        self,
+        n_workers=None,
+        timeout=TRACK_TIMEOUT,
+        memory_limit_mb=WORKER_MEMORY_LIMIT_MB,
+        setup_timeout=WORKER_SETUP_TIMEOUT,
+    ):
+        """
+        Pool of extraction worker processes with per-track timeouts and memory
+        limits. Workers that crash, hang or use too much memory are killed and
+        restarted, and the offending path is quarantined. Tracks failing with
+        a Python exception are only reported, so they are tried again on the
+        next run.
+
+        Args:
+            n_workers (int): Number of worker processes, from the autotuned
+                profile by default
+            timeout (float): Maximum seconds per track
+            memory_limit_mb (float): Maximum resident memory per worker in MB
+            setup_timeout (float): Maximum seconds for a worker to load the
+                models and start its track
+        """
+        self.context = mp.get_context("spawn")
+        self.timeout = timeout
+        self.setup_timeout = setup_timeout
+        self.memory_limit_mb = memory_limit_mb
+        n_workers = n_workers or get_profile()["workers"]
+        self.workers = [Worker(self.context) for _ in range(n_workers)]
+        self.setup_failures = 0
+        if get_rss_mb(os.getpid()) is None:
+            print(
+                "Resident memory cannot be read without /proc or psutil, "
+                f"the {memory_limit_mb} MB worker memory limit is not enforced."
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop all worker processes.
+
+        Returns:
+            None
+        """
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.kill()
+
+    def _fail(self, worker, reason, restart):
+        """
+        Quarantine the path of a worker, restarting the worker if needed.
+
+        Args:
+            worker (Worker): Worker that failed
+            reason (str): Description of the failure
+            restart (bool): Kill and replace the worker process
+
+        Returns:
+            str: Path that failed
+        """
+        path, stage = worker.release()
+        quarantine(path, stage, reason)
+        if restart:
+            self._restart(worker)
+        return path
+
+    def _restart(self, worker):
+        """
+        Kill a worker process and replace it with a new one.
+
+        Args:
+            worker (Worker): Worker to replace
+
+        Returns:
+            Worker: The new worker
+        """
+        worker.kill()
+        new_worker = Worker(self.context)
+        self.workers[self.workers.index(worker)] = new_worker
+        return new_worker
+
+    def _retry_setup(self, worker, reason):
+        """
+        Restart a worker that failed before starting its track and give the
+        track to the new worker. The failure points to the setup, not the
+        file, so the track is not quarantined.
+
+        Args:
+            worker (Worker): Worker that failed
+            reason (str): Description of the failure
+
+        Returns:
+            None
+        """
+        self.setup_failures += 1
+        if self.setup_failures > SETUP_RETRIES:
+            raise RuntimeError(
+                f"Extraction workers {reason} {self.setup_failures} times in a "
+                "row before starting a track."
+            )
+        path, _ = worker.release()
+        self._restart(worker).assign(path)
+
+    def _check_limits(self):
+        """
+        Kill the workers that exceeded the timeout or the memory limit.
+
+        Returns:
+            list: Paths that failed
+        """
+        failed = []
+        now = time.monotonic()
+        for worker in list(self.workers):
+            if worker.path is None:
+                continue
+            if worker.started is None:
+                if now - worker.assigned > self.setup_timeout:
+                    self._retry_setup(worker, f"timed out after {self.setup_timeout}s")
+                continue
+            if now - worker.started > self.timeout:
+                reason = f"timeout after {self.timeout}s"
+                failed.append(self._fail(worker, reason, True))
+                continue
+            rss = get_rss_mb(worker.process.pid)
+            if rss is not None and rss > self.memory_limit_mb:
+                reason = f"memory limit of {self.memory_limit_mb} MB exceeded"
+                failed.append(self._fail(worker, reason, True))
+        return failed
+
+    def _receive(self, worker):
+        """
+        Handle one message from a worker.
+
+        Args:
+            worker (Worker): Worker with a message or a closed pipe
+
+        Returns:
+            tuple: (path, result) when a track finished or failed, else None
+        """
+        try:
+            kind, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            # The worker died, for example from a segfault in native code
+            worker.process.join()
+            exitcode = worker.process.exitcode
+            if worker.stage == "queued":
+                self._retry_setup(worker, f"exited with code {exitcode}")
+                return None
+            reason = f"worker crashed with exit code {exitcode}"
+            return self._fail(worker, reason, True), None
+
+        if kind == "stage":
+            if worker.started is None:
+                worker.started = time.monotonic()
+            worker.stage = payload
+            self.setup_failures = 0
+            return None
+        if kind == "error":
+            # Exceptions can be transient, such as a file still being copied
+            path, stage = worker.release()
+            print(f"Error processing {path} in stage {stage}: {payload}")
+            return path, None
+        path, _ = worker.release()
+        return path, payload
+
+    def imap(self, paths):
+        """
+        Extract the features of every path in the worker processes.
+
+        Args:
+            paths (iterable): Paths of the audio files
+
+        Yields:
+            str: Path of the audio file
+            dict: Extracted features, None if the path failed
+        """
+        paths = iter(paths)
+        exhausted = False
+        while True:
+            # Keep every idle worker busy
+            for worker in self.workers:
+                if worker.path is None and not exhausted:
+                    path = next(paths, None)
+                    if path is None:
+                        exhausted = True
+                    else:
+                        worker.assign(path)
+
+            busy = [worker for worker in self.workers if worker.path is not None]
+            if not busy:
+                return
+
+            ready = wait([worker.conn for worker in busy], timeout=POLL_INTERVAL)
+            for worker in busy:
+                if worker.conn in ready:
+                    finished = self._receive(worker)
+                    if finished is not None:
+                        yield finished
+            for path in self._check_limits():
+                yield path, None
+
@@ -0,0 +1,137 @@
+from collections import Counter
+import numpy as np
+from config import (
+    ANALYSIS_POLICY,
+    ANALYSIS_SECONDS,
+    ANALYSIS_WINDOWS,
+    TEMPO_AGREEMENT_BPM,
+)
+
+
+def get_segment_times(
+    duration,
+    policy=ANALYSIS_POLICY,
+    seconds=ANALYSIS_SECONDS,
+    windows=ANALYSIS_WINDOWS,
+):
+    """
+    Start and end times of the segments to analyse for an analysis policy
+
+    Args:
+        duration (float): Duration of the audio in seconds
+        policy (str): "full" track, "middle" excerpt or evenly spaced "windows"
+        seconds (float): Length of the excerpt or of each window in seconds
+        windows (int): Number of windows
+
+    Returns:
+        list : (start, end) times in seconds, the most central segment first
+    """
+
+    if policy == "full" or duration <= seconds:
+        return [(0, duration)]
+    elif policy == "middle":
+        centers = [duration / 2]
+    elif policy == "windows":
+        centers = [duration * (i + 1) / (windows + 1) for i in range(windows)]
+        centers.sort(key=lambda center: abs(center - duration / 2))
+    else:
+        raise ValueError("Invalid analysis policy.")
+
+    starts = [
+        min(max(center - seconds / 2, 0), duration - seconds) for center in centers
+    ]
+    return [(start, start + seconds) for start in starts]
+
+
+def get_segments(
+    audio,
+    sample_rate,
+    policy=ANALYSIS_POLICY,
+    seconds=ANALYSIS_SECONDS,
+    windows=ANALYSIS_WINDOWS,
+):
+    """
+    Split audio into the segments to analyse for an analysis policy
+
+    Args:
+        audio (np array): Mono or stereo audio
+        sample_rate (int): Sample rate of the audio
+        policy (str): "full" track, "middle" excerpt or evenly spaced "windows"
+        seconds (float): Length of the excerpt or of each window in seconds
+        windows (int): Number of windows
+
+    Returns:
+        list : Audio segments, the most central segment first
+    """
+
+    times = get_segment_times(len(audio) / sample_rate, policy, seconds, windows)
+    return [
+        audio[int(start * sample_rate) : int(end * sample_rate)] for start, end in times
+    ]
+
+
+def analyse_segments(segments, analyse, agree, combine):
+    """
+    Analyse audio segments in order, exiting early as soon as two segments agree
+
+    Args:
+        segments (list): Audio segments from `get_segments`, most central first
+        analyse (callable): Analysis of one audio segment
+        agree (callable): Whether two segment results agree
+        combine (callable): Combines a list of segment results into one
+
+    Returns:
+        object : Combined result of the agreeing segments, or of all segments
+    """
+
+    results = []
+    for segment in segments:
+        result = analyse(segment)
+        for previous in results:
+            if agree(previous, result):
+                return combine([previous, result])
+        results.append(result)
+    return combine(results)
+
+
+def most_common(results):
+    """
+    Returns the most common result, the earliest one on ties
+
+    Args:
+        results (list): Segment results
+
+    Returns:
+        object : Most common result
+    """
+
+    return Counter(results).most_common(1)[0][0]
+
+
+def tempo_agrees(tempo_a, tempo_b):
+    """
+    Returns whether two tempo estimates agree
+
+    Args:
+        tempo_a (float): Tempo in BPM
+        tempo_b (float): Tempo in BPM
+
+    Returns:
+        bool : True if the tempos are within TEMPO_AGREEMENT_BPM
+    """
+
+    return abs(tempo_a - tempo_b) <= TEMPO_AGREEMENT_BPM
+
+
+def median_tempo(tempos):
+    """
+    Returns the median of tempo estimates
+
+    Args:
+        tempos (list): Tempos in BPM
+
+    Returns:
+        float : Median tempo in BPM
+    """
+
+    return float(np.median(tempos))
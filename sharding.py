@@ -0,0 +1,404 @@
+import argparse
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from tqdm import tqdm
+from sandbox import SandboxPool, load_quarantined
+from discovery import discover_audio_files
+from fileio import (
+    FeatureWriter,
+    create_dir_if_not_exist,
+    get_feature_paths,
+    iter_store_rows,
+    store_lock,
+)
+from ingest import remove_derived_indexes
+from snapshot import build_snapshot
+from collection_stats import update_collection_stats
+from config import (
+    DATA_PATH,
+    SHARDS_DIR_PATH,
+    SHARDS_DB_PATH,
+    SHARD_COUNT,
+    SHARD_LEASE_SECONDS,
+    SHARD_HEARTBEAT_SECONDS,
+)
+
+
+def get_shard(path, n_shards):
+    """
+    Assign a path to a shard with a stable hash
+
+    Args:
+        path (str): Path of the audio file
+        n_shards (int): Number of shards
+
+    Returns:
+        int: Shard of the path
+    """
+
+    digest = hashlib.blake2b(path.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % n_shards
+
+
+def get_shard_dir(shard, attempt):
+    """
+    Return the directory of the shard-local feature store of one attempt
+
+    Args:
+        shard (int): Shard id
+        attempt (int): Lease attempt of the shard, unique per lease
+
+    Returns:
+        str: Directory of the shard-local store
+    """
+
+    return os.path.join(
+        SHARDS_DIR_PATH, f"shard_{shard:05d}", f"attempt_{attempt:03d}"
+    )
+
+
+def connect(db_path=SHARDS_DB_PATH):
+    """
+    Connect to the coordinator database
+
+    Args:
+        db_path (str): Path to the SQLite database
+
+    Returns:
+        sqlite3.Connection: Connection in autocommit mode
+    """
+
+    # The database is shared by the nodes, and WAL mode needs shared memory
+    # that network filesystems do not provide, so the rollback journal is used
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=DELETE")
+    return connection
+
+
+def create_shards(root=DATA_PATH, n_shards=SHARD_COUNT, db_path=SHARDS_DB_PATH):
+    """
+    Discover the collection once and create the work queue with the paths of
+    every hash shard
+
+    Args:
+        root (str): Root directory of the collection
+        n_shards (int): Number of shards
+        db_path (str): Path to the coordinator database
+
+    Returns:
+        int: Number of paths queued
+    """
+
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} exists, remove it to start a new run.")
+    create_dir_if_not_exist(os.path.dirname(db_path))
+
+    quarantined = load_quarantined()
+    paths = [path for path in discover_audio_files(root) if path not in quarantined]
+
+    connection = connect(db_path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE shards (id INTEGER PRIMARY KEY, status TEXT, worker TEXT, "
+            "lease_expires REAL, attempt INTEGER, store_dir TEXT, rows INTEGER)"
+        )
+        connection.execute("CREATE TABLE paths (shard INTEGER, path TEXT)")
+        connection.execute("CREATE INDEX paths_shard ON paths (shard)")
+        connection.executemany(
+            "INSERT INTO shards VALUES (?, 'pending', NULL, 0, 0, NULL, 0)",
+            [(shard,) for shard in range(n_shards)],
+        )
+        # Paths are inserted longest first, the order of the shard queue
+        connection.executemany(
+            "INSERT INTO paths VALUES (?, ?)",
+            [(get_shard(path, n_shards), path) for path in paths],
+        )
+    connection.close()
+    return len(paths)
+
+
+def lease_shard(connection, worker, lease_seconds=SHARD_LEASE_SECONDS):
+    """
+    Lease the next pending shard, or a shard whose worker stopped renewing
+    its lease
+
+    Args:
+        connection (sqlite3.Connection): Coordinator connection
+        worker (str): Worker id
+        lease_seconds (float): Seconds before an unrenewed lease expires
+
+    Returns:
+        int: Leased shard, None when no shard is left
+        int: Attempt of the lease
+    """
+
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            "SELECT id, attempt FROM shards WHERE status = 'pending' "
+            "OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None, None
+        shard, attempt = row[0], row[1] + 1
+        connection.execute(
+            "UPDATE shards SET status = 'leased', worker = ?, lease_expires = ?, "
+            "attempt = ? WHERE id = ?",
+            (worker, now + lease_seconds, attempt, shard),
+        )
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return shard, attempt
+
+
+def renew_lease(connection, shard, attempt, lease_seconds=SHARD_LEASE_SECONDS):
+    """
+    Extend a lease, failing if the shard was given to another worker
+
+    Args:
+        connection (sqlite3.Connection): Coordinator connection
+        shard (int): Leased shard
+        attempt (int): Attempt of the lease
+        lease_seconds (float): Seconds before the renewed lease expires
+
+    Returns:
+        bool: True if the lease is still held
+    """
+
+    cursor = connection.execute(
+        "UPDATE shards SET lease_expires = ? "
+        "WHERE id = ? AND attempt = ? AND status = 'leased'",
+        (time.time() + lease_seconds, shard, attempt),
+    )
+    return cursor.rowcount == 1
+
+
+def complete_shard(connection, shard, attempt, rows):
+    """
+    Mark a shard as done with the store of the attempt that finished it
+
+    Args:
+        connection (sqlite3.Connection): Coordinator connection
+        shard (int): Leased shard
+        attempt (int): Attempt of the lease
+        rows (int): Number of extracted tracks
+
+    Returns:
+        bool: True if the lease was still held and the shard is done
+    """
+
+    cursor = connection.execute(
+        "UPDATE shards SET status = 'done', store_dir = ?, rows = ? "
+        "WHERE id = ? AND attempt = ? AND status = 'leased'",
+        (get_shard_dir(shard, attempt), rows, shard, attempt),
+    )
+    return cursor.rowcount == 1
+
+
+class LeaseKeeper(threading.Thread):
+    def __init__(self, shard, attempt, interval=SHARD_HEARTBEAT_SECONDS):
+        """
+        Background thread renewing the lease of a shard while it is extracted.
+
+        Args:
+            shard (int): Leased shard
+            attempt (int): Attempt of the lease
+            interval (float): Seconds between renewals
+        """
+        super().__init__(daemon=True)
+        self.shard = shard
+        self.attempt = attempt
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        connection = connect()
+        while not self.stopped.wait(self.interval):
+            if not renew_lease(connection, self.shard, self.attempt):
+                self.lost.set()
+                break
+        connection.close()
+
+    def stop(self):
+        """
+        Stop renewing the lease.
+
+        Returns:
+            None
+        """
+        self.stopped.set()
+        self.join()
+
+
+def copy_previous_attempts(shard, attempt, writer):
+    """
+    Copy the rows committed by earlier attempts of a shard, so a shard taken
+    over from a lost worker resumes instead of starting over
+
+    Args:
+        shard (int): Shard id
+        attempt (int): Current attempt
+        writer (FeatureWriter): Writer of the current attempt's store
+
+    Returns:
+        set: Paths already extracted
+    """
+
+    done = set()
+    for previous in range(attempt - 1, 0, -1):
+        directory = get_shard_dir(shard, previous)
+        paths = get_feature_paths(directory).values()
+        if not all(os.path.exists(path) for path in paths):
+            continue
+        for path, features in iter_store_rows(directory):
+            if path not in done:
+                done.add(path)
+                writer.write(path, features)
+    return done
+
+
+def extract_shard(connection, shard, attempt):
+    """
+    Extract the paths of a leased shard into the attempt's shard-local store,
+    stopping early if the lease is lost
+
+    Args:
+        connection (sqlite3.Connection): Coordinator connection
+        shard (int): Leased shard
+        attempt (int): Attempt of the lease
+
+    Returns:
+        bool: True if the shard was completed by this worker
+    """
+
+    paths = [
+        path
+        for (path,) in connection.execute(
+            "SELECT path FROM paths WHERE shard = ? ORDER BY rowid", (shard,)
+        )
+    ]
+    keeper = LeaseKeeper(shard, attempt)
+    keeper.start()
+    try:
+        with FeatureWriter(get_shard_dir(shard, attempt), append=True) as writer:
+            done = copy_previous_attempts(shard, attempt, writer)
+            todo = [path for path in paths if path not in done]
+            with SandboxPool() as pool:
+                for path, features in tqdm(
+                    pool.imap(todo), total=len(todo), desc=f"Shard {shard}"
+                ):
+                    if keeper.lost.is_set():
+                        return False
+                    if features is not None:
+                        writer.write(path, features)
+    finally:
+        keeper.stop()
+    if keeper.lost.is_set():
+        return False
+    return complete_shard(connection, shard, attempt, writer.manifest["rows"])
+
+
+def run_worker(worker=None):
+    """
+    Lease and extract shards until none is left. Workers can stop at any
+    time; their shards are leased again once the lease expires, resuming
+    from the rows they committed.
+
+    Args:
+        worker (str): Worker id, the host name and process id by default
+
+    Returns:
+        int: Number of shards completed by this worker
+    """
+
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    connection = connect()
+    completed = 0
+    while True:
+        shard, attempt = lease_shard(connection, worker)
+        if shard is None:
+            break
+        completed += extract_shard(connection, shard, attempt)
+    connection.close()
+    return completed
+
+
+def get_status():
+    """
+    Count the shards in each state
+
+    Returns:
+        dict: Number of shards per status
+    """
+
+    connection = connect()
+    counts = dict(
+        connection.execute("SELECT status, COUNT(*) FROM shards GROUP BY status")
+    )
+    connection.close()
+    return counts
+
+
+def merge_shards():
+    """
+    Combine the shard-local stores of a finished run into the main feature
+    store, row by row so the five files stay aligned, then build the snapshot
+    and the collection statistics like `main.py`. The indexes built from the
+    previous store are deleted, as its rows are replaced.
+
+    Returns:
+        int: Number of merged tracks
+    """
+
+    connection = connect()
+    shards = connection.execute(
+        "SELECT id, status, store_dir FROM shards ORDER BY id"
+    ).fetchall()
+    connection.close()
+    unfinished = [shard for shard, status, _ in shards if status != "done"]
+    if unfinished:
+        raise RuntimeError(f"{len(unfinished)} shards are not done yet.")
+
+    rows = 0
+    with store_lock():
+        with FeatureWriter() as writer:
+            for _, _, store_dir in tqdm(shards, desc="Merging shards"):
+                for path, features in iter_store_rows(store_dir):
+                    writer.write(path, features)
+                    rows += 1
+        remove_derived_indexes()
+        build_snapshot()
+    update_collection_stats()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded feature extraction.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    init_parser = commands.add_parser("init", help="Create the shard work queue")
+    init_parser.add_argument("--root", default=DATA_PATH)
+    init_parser.add_argument("--shards", type=int, default=SHARD_COUNT)
+    work_parser = commands.add_parser("work", help="Extract shards until none is left")
+    work_parser.add_argument("--worker", default=None, help="Worker id")
+    commands.add_parser("status", help="Count the shards in each state")
+    commands.add_parser("merge", help="Merge the shard stores into the main store")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        print(f"Queued {create_shards(args.root, args.shards)} files.")
+    elif args.command == "work":
+        print(f"Completed {run_worker(args.worker)} shards.")
+    elif args.command == "status":
+        print(get_status())
+    elif args.command == "merge":
+        print(f"Merged {merge_shards()} tracks.")
@@ -0,0 +1,167 @@
+import os
+import pickle
+import pandas as pd
+from fileio import (
+    get_saved_all_features,
+    get_saved_file_paths,
+    get_genre_names,
+    replace_atomically,
+    is_older_than,
+)
+from store import get_shared_genre_activations
+from encoding import encode_keys, encode_genres
+from bitmap_index import load_genre_bitmap_index
+from config import (
+    SNAPSHOT_PATH,
+    ALL_FEATURES_PATH,
+    FILE_PATHS_PATH,
+    GENRE_DISCOGS_PATH,
+)
+
+# Features stored as strings that are encoded with shared dictionaries
+KEY_COLUMNS = ["key_temperley", "key_krumhansl", "key_edma"]
+GENRE_COLUMNS = ["genre"]
+
+
+def build_all_features(all_features=None, file_paths=None):
+    """
+    Build the all features DataFrame with keys and genres encoded as small
+    integer codes. Key and scale filters work on the key codes directly.
+
+    Args:
+        all_features (list): Feature dictionaries, None for the saved features
+        file_paths (list): File paths of the features, None for the saved paths
+
+    Returns:
+        pd.DataFrame: DataFrame with all features indexed by file path
+    """
+
+    if all_features is None:
+        all_features, file_paths = get_saved_all_features(), get_saved_file_paths()
+    all_features_df = pd.DataFrame(all_features, index=file_paths)
+    for column in KEY_COLUMNS:
+        all_features_df[column] = encode_keys(all_features_df[column])
+    for column in GENRE_COLUMNS:
+        all_features_df[column] = encode_genres(all_features_df[column])
+
+    return all_features_df
+
+
+def build_snapshot():
+    """
+    Build the query snapshot used by the playlist apps and save it to disk
+
+    Returns:
+        None
+    """
+
+    snapshot = {
+        "all_features": build_all_features(),
+        "genre_names": get_genre_names(),
+    }
+
+    # Also refresh the memory-mapped genre activations and bitmap index
+    load_genre_bitmap_index()
+
+    replace_atomically(
+        SNAPSHOT_PATH,
+        lambda f: pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+
+
+def append_snapshot(all_features, file_paths, n_rows):
+    """
+    Add new tracks to the saved snapshot without reloading the feature files
+
+    Args:
+        all_features (list): Feature dictionaries of the new tracks
+        file_paths (list): File paths of the new tracks
+        n_rows (int): Number of tracks in the snapshot before the append
+
+    Returns:
+        bool: True if the tracks were added, False if the snapshot is missing
+            or out of date and needs a rebuild
+    """
+
+    if not os.path.exists(SNAPSHOT_PATH):
+        return False
+    with open(SNAPSHOT_PATH, "rb") as f:
+        snapshot = pickle.load(f)
+    if len(snapshot["all_features"]) != n_rows:
+        return False
+
+    # Values outside the dictionaries extend the categories of their frame
+    old_df = snapshot["all_features"]
+    new_df = build_all_features(all_features, file_paths)
+    for column in KEY_COLUMNS + GENRE_COLUMNS:
+        categories = old_df[column].cat.categories.union(
+            new_df[column].cat.categories, sort=False
+        )
+        old_df[column] = old_df[column].cat.set_categories(categories)
+        new_df[column] = new_df[column].cat.set_categories(categories)
+    snapshot["all_features"] = pd.concat([old_df, new_df])
+    replace_atomically(
+        SNAPSHOT_PATH,
+        lambda f: pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+    return True
+
+
+def remove_snapshot_rows(keep):
+    """
+    Drop tracks from the saved snapshot without reloading the feature files
+
+    Args:
+        keep (np array): Boolean mask of the tracks to keep
+
+    Returns:
+        bool: True if the tracks were removed, False if the snapshot is missing
+            or out of date and needs a rebuild
+    """
+
+    if not os.path.exists(SNAPSHOT_PATH):
+        return False
+    with open(SNAPSHOT_PATH, "rb") as f:
+        snapshot = pickle.load(f)
+    if len(snapshot["all_features"]) != len(keep):
+        return False
+
+    snapshot["all_features"] = snapshot["all_features"][keep]
+    replace_atomically(
+        SNAPSHOT_PATH,
+        lambda f: pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+    return True
+
+
+def load_snapshot():
+    """
+    Load the query snapshot, building it first if the features have changed
+
+    Returns:
+        pd.DataFrame: DataFrame with all features indexed by file path
+        pd.DataFrame: Read-only DataFrame with genre activations
+    """
+
+    if is_older_than(
+        SNAPSHOT_PATH, [ALL_FEATURES_PATH, FILE_PATHS_PATH, GENRE_DISCOGS_PATH]
+    ):
+        build_snapshot()
+
+    with open(SNAPSHOT_PATH, "rb") as f:
+        snapshot = pickle.load(f)
+
+    all_features_df = snapshot["all_features"]
+
+    # Wrap the memory-mapped activations without copying them
+    genre_activations_df = pd.DataFrame(
+        get_shared_genre_activations(),
+        columns=snapshot["genre_names"],
+        index=all_features_df.index,
+        copy=False,
+    )
+    return all_features_df, genre_activations_df
+
+
+if __name__ == "__main__":
+    build_snapshot()
@@ -0,0 +1,198 @@
+import os
+import numpy as np
+from fileio import (
+    create_dir_if_not_exist,
+    replace_atomically,
+    append_npy,
+    is_older_than,
+    get_saved_embeddings,
+    get_saved_genre_activations,
+)
+from config import (
+    STORE_DIR_PATH,
+    DISCOGS_EMBEDDINGS_PATH,
+    MSD_EMBEDDINGS_PATH,
+    GENRE_DISCOGS_PATH,
+)
+
+create_dir_if_not_exist(STORE_DIR_PATH)
+
+
+def get_store_path(name):
+    """
+    Return the path of an array in the shared store
+
+    Args:
+        name (str): Name of the array
+
+    Returns:
+        str: Path to the .npy file
+    """
+
+    return os.path.join(STORE_DIR_PATH, f"{name}.npy")
+
+
+def export_array(name, array):
+    """
+    Write an array to the shared store, replacing any previous version
+    atomically so readers never see a partial file
+
+    Args:
+        name (str): Name of the array
+        array (np array): Array to store
+
+    Returns:
+        None
+    """
+
+    replace_atomically(get_store_path(name), lambda f: np.save(f, array))
+
+
+def load_array(name):
+    """
+    Memory-map an array from the shared store as read-only. Every session and
+    process mapping the same file shares the same physical pages.
+
+    Args:
+        name (str): Name of the array
+
+    Returns:
+        np.memmap: Read-only view of the array
+    """
+
+    return np.load(get_store_path(name), mmap_mode="r")
+
+
+def append_array(name, rows, n_rows):
+    """
+    Append rows to an array in the shared store without rebuilding it. Arrays
+    that are missing or do not hold the expected rows are left alone, so
+    they are rebuilt from the feature files the next time they are loaded.
+
+    Args:
+        name (str): Name of the array
+        rows (np array): Rows to append
+        n_rows (int): Number of rows the array must hold before the append
+
+    Returns:
+        bool: True if the rows were appended
+    """
+
+    path = get_store_path(name)
+    if not os.path.exists(path) or len(load_array(name)) != n_rows:
+        return False
+    append_npy(path, rows)
+    return True
+
+
+def remove_array_rows(name, keep):
+    """
+    Drop rows from an array in the shared store without rebuilding it from
+    the feature files
+
+    Args:
+        name (str): Name of the array
+        keep (np array): Boolean mask of the rows to keep
+
+    Returns:
+        bool: True if the rows were removed, False if the array is missing
+            or out of date and needs a rebuild
+    """
+
+    path = get_store_path(name)
+    if not os.path.exists(path) or len(load_array(name)) != len(keep):
+        return False
+    export_array(name, load_array(name)[keep])
+    return True
+
+
+def is_stale(name, source_paths):
+    """
+    Check if an array is missing or older than any of its source files
+
+    Args:
+        name (str): Name of the array
+        source_paths (list): Paths of the files the array is built from
+
+    Returns:
+        bool: True if the array needs to be rebuilt
+    """
+
+    return is_older_than(get_store_path(name), source_paths)
+
+
+def get_shared_array(name, source_paths, build_func):
+    """
+    Return a read-only memory-mapped array, building it first if it is stale
+
+    Args:
+        name (str): Name of the array
+        source_paths (list): Paths of the files the array is built from
+        build_func (callable): Function returning the array to store
+
+    Returns:
+        np.memmap: Read-only view of the array
+    """
+
+    if is_stale(name, source_paths):
+        export_array(name, build_func())
+    return load_array(name)
+
+
+def get_embeddings_path(embedding_name):
+    """
+    Return the pickle path of an embedding
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        str: Path to the pickled embeddings
+    """
+
+    if embedding_name == "discogs":
+        return DISCOGS_EMBEDDINGS_PATH
+    elif embedding_name == "msd":
+        return MSD_EMBEDDINGS_PATH
+    else:
+        raise ValueError("Invalid embedding name.")
+
+
+def get_shared_genre_activations():
+    """
+    Return the genre activations for each audio file from the shared store
+
+    Returns:
+        np.memmap: Genre activations of shape (N, 400)
+    """
+
+    return get_shared_array(
+        "genre_activations",
+        [GENRE_DISCOGS_PATH],
+        lambda: get_saved_genre_activations().astype(np.float32),
+    )
+
+
+def get_shared_embeddings(embedding_name):
+    """
+    Return the embeddings for each audio file from the shared store
+
+    Args:
+        embedding_name (str): Name of the embeddings, "discogs" or "msd"
+
+    Returns:
+        np.memmap: Embeddings of shape (N, D)
+    """
+
+    return get_shared_array(
+        f"{embedding_name}_embeddings",
+        [get_embeddings_path(embedding_name)],
+        lambda: get_saved_embeddings(embedding_name).astype(np.float32),
+    )
+
+
+if __name__ == "__main__":
+    # Build the shared store ahead of starting the apps
+    get_shared_genre_activations()
+    for name in ["discogs", "msd"]:
+        get_shared_embeddings(name)
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The modules are run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def store_dir(tmp_path, monkeypatch):
+    # The feature store, the shared store and the indexes use relative paths
+    os.makedirs(tmp_path / "features" / "store")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from archive import ArchiveReader, export_archive, import_archive
+from fileio import FeatureWriter, iter_store_rows
+
+
+def make_features(rng, i):
+    return {
+        "discogs_embeddings": rng.standard_normal(8).astype(np.float32),
+        "msd_embeddings": rng.standard_normal(4).astype(np.float32),
+        "genre_activations": rng.random(5).astype(np.float32),
+        "all_features": {
+            "bpm": float(100 + i),
+            "danceability": np.float32(i / 10),
+            "key": "C" if i % 2 else "A",
+        },
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    rng = np.random.default_rng(0)
+    directory = tmp_path / "store"
+    directory.mkdir()
+    with FeatureWriter(str(directory), fsync=False) as writer:
+        for i in range(10):
+            writer.write(f"track_{i}.mp3", make_features(rng, i))
+    return str(directory)
+
+
+def test_round_trip(store, tmp_path):
+    archive_path = str(tmp_path / "features.arc")
+    assert export_archive(archive_path, store, codec="zlib", chunk_rows=4) == 10
+
+    restored = tmp_path / "restored"
+    restored.mkdir()
+    assert import_archive(archive_path, str(restored)) == 10
+
+    original = list(iter_store_rows(store))
+    rows = list(iter_store_rows(str(restored)))
+    assert [path for path, _ in rows] == [path for path, _ in original]
+    for (_, features), (_, expected) in zip(rows, original):
+        for name in ["discogs_embeddings", "msd_embeddings", "genre_activations"]:
+            assert features[name].dtype == np.float32
+            np.testing.assert_allclose(features[name], expected[name], rtol=1e-3)
+        assert features["all_features"] == expected["all_features"]
+        assert isinstance(features["all_features"]["bpm"], float)
+
+
+def test_read_ranges(store, tmp_path):
+    archive_path = str(tmp_path / "features.arc")
+    export_archive(archive_path, store, codec="zlib", chunk_rows=4)
+    paths = [f"track_{i}.mp3" for i in range(10)]
+
+    with ArchiveReader(archive_path) as reader:
+        assert len(reader) == 10
+        for start, stop in [(0, None), (3, 9), (4, 8), (9, 10), (5, 5), (8, 20)]:
+            result = reader.read(["file_paths", "bpm"], start, stop)
+            expected = paths[start:stop]
+            assert result["file_paths"] == expected
+            assert list(result["bpm"]) == [100 + int(p[6:-4]) for p in expected]
+        with pytest.raises(KeyError):
+            reader.read(["missing"])
+
+
+def test_invalid_codec_and_file(store, tmp_path):
+    with pytest.raises(ValueError):
+        export_archive(str(tmp_path / "features.arc"), store, codec="gzip")
+    not_archive = tmp_path / "store.txt"
+    not_archive.write_bytes(b"0" * 64)
+    with pytest.raises(ValueError):
+        ArchiveReader(str(not_archive))
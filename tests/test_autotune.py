@@ -0,0 +1,12 @@
+from autotune import DEFAULT_PROFILE, get_candidates
+
+
+def test_candidates_start_with_defaults_and_fill_the_cores():
+    for n_cores in [1, 6, 16]:
+        candidates = get_candidates(n_cores, inter_op_threads=[1, 2])
+        assert candidates[0] == DEFAULT_PROFILE
+        for candidate in candidates[1:]:
+            used = candidate["workers"] * candidate["intra_op_threads"]
+            assert used <= n_cores < 2 * used
+        assert len(candidates) == len({tuple(c.items()) for c in candidates})
+    assert len(get_candidates(16, inter_op_threads=[1, 2])) == 11
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from bitmap_index import (
+    GenreBitmapIndex,
+    append_genre_bitmaps,
+    build_genre_bitmaps,
+    load_stored_genre_bitmaps,
+    save_genre_bitmaps,
+)
+
+
+def brute_force(activations, columns, low, high):
+    selected = activations[:, columns]
+    return (selected >= low).any(axis=1) & (selected <= high).any(axis=1)
+
+
+def make_index(activations, n_bins=20):
+    names = [f"genre_{i}" for i in range(activations.shape[1])]
+    bitmaps = build_genre_bitmaps(activations, n_bins)
+    return GenreBitmapIndex(bitmaps, activations, names), names
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold_type", [float, np.float64])
+def test_query_matches_brute_force(seed, threshold_type):
+    rng = np.random.default_rng(seed)
+    activations = rng.random((500, 6), dtype=np.float32)
+    # Plant activations exactly at the thresholds, on both sides of the bins
+    thresholds = np.array([0.35, 0.05, 0.1, 0.7, 0.45, 0.95, 0.0, 1.0])
+    planted = rng.integers(0, activations.size, size=200)
+    activations.flat[planted] = rng.choice(thresholds, size=200).astype(np.float32)
+    index, names = make_index(activations)
+
+    for _ in range(200):
+        columns = sorted(rng.choice(6, size=rng.integers(1, 4), replace=False))
+        low, high = map(threshold_type, sorted(rng.choice(thresholds, size=2)))
+        expected = brute_force(activations, columns, low, high)
+        result = index.query([names[column] for column in columns], low, high)
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_threshold_above_its_float32_value():
+    # float32(0.35) is below 0.35, the brute force filter keeps it
+    activations = np.array([[np.float32(0.35)], [0.2]], dtype=np.float32)
+    index, names = make_index(activations)
+    np.testing.assert_array_equal(index.query(names, 0.35, 1.0), [True, False])
+
+
+def test_appended_bitmaps_match_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr("store.STORE_DIR_PATH", str(tmp_path))
+    rng = np.random.default_rng(0)
+    activations = rng.random((21, 3), dtype=np.float32)
+
+    save_genre_bitmaps(build_genre_bitmaps(activations[:13]), 13)
+    assert append_genre_bitmaps(activations[13:], 13)
+    bitmaps, n_rows = load_stored_genre_bitmaps()
+    assert n_rows == 21
+    np.testing.assert_array_equal(bitmaps, build_genre_bitmaps(activations))
+
+
+def test_append_refuses_bitmaps_missing_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr("store.STORE_DIR_PATH", str(tmp_path))
+    activations = np.random.default_rng(0).random((20, 3), dtype=np.float32)
+
+    # 17 tracks pack into the same 3 bytes as the 20 tracks the caller expects
+    save_genre_bitmaps(build_genre_bitmaps(activations[:17]), 17)
+    assert not append_genre_bitmaps(activations[:2], 20)
+    assert load_stored_genre_bitmaps()[1] == 17
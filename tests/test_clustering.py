@@ -0,0 +1,95 @@
+import os
+import numpy as np
+import clustering
+import ingest
+from clustering import (
+    append_to_clusters,
+    build_clusters,
+    load_cluster_index,
+    minibatch_update,
+)
+from fileio import FeatureWriter
+from store import load_array
+from config import GENRE_DISCOGS_PATH
+
+N_BLOBS = 4
+
+# Initialises both builds with one track of every blob
+SEED = 73
+
+
+def make_tracks(start, n_tracks, seed):
+    # Tight blobs around orthogonal directions, so k-means finds the blobs
+    rng = np.random.default_rng(seed)
+    tracks = []
+    for i in range(start, start + n_tracks):
+        blob = i % N_BLOBS
+        embedding = 0.05 * rng.standard_normal(16).astype(np.float32)
+        embedding[blob] += 1
+        features = {
+            "discogs_embeddings": embedding,
+            "msd_embeddings": np.zeros(2, dtype=np.float32),
+            "genre_activations": np.eye(N_BLOBS, dtype=np.float32)[blob],
+            "all_features": {"bpm": 120.0},
+        }
+        tracks.append((f"track_{i}.mp3", features))
+    return tracks
+
+
+def write_store(tracks):
+    with FeatureWriter(fsync=False) as writer:
+        for path, features in tracks:
+            writer.write(path, features)
+
+
+def get_partition(assignments):
+    # Clusters as sets of tracks, independent of the cluster ids
+    return {
+        frozenset(np.flatnonzero(assignments == cluster))
+        for cluster in np.unique(assignments)
+    }
+
+
+def test_minibatch_update_keeps_running_mean():
+    rng = np.random.default_rng(0)
+    vectors = rng.random((50, 3)).astype(np.float32) + [10, 0, 0]
+    centroids = np.array([[1, 0, 0]], dtype=np.float32)
+    counts = np.zeros(1, dtype=np.int64)
+    for start in range(0, 50, 8):
+        minibatch_update(centroids, counts, vectors[start : start + 8])
+    assert counts[0] == 50
+    np.testing.assert_allclose(centroids[0], vectors.mean(axis=0), rtol=1e-5)
+
+
+def test_append_matches_full_rebuild(store_dir, monkeypatch):
+    monkeypatch.setattr(ingest, "update_collection_stats", lambda: None)
+    monkeypatch.setattr(clustering, "get_genre_names", lambda: list("abcd"))
+    tracks = make_tracks(0, 80, seed=1)
+    new_tracks = make_tracks(80, 20, seed=2)
+
+    write_store(tracks + new_tracks)
+    build_clusters("discogs", n_clusters=N_BLOBS, batch_size=16, seed=SEED)
+    rebuilt = np.array(load_array("discogs_clusters"))
+
+    write_store(tracks)
+    build_clusters("discogs", n_clusters=N_BLOBS, batch_size=16, seed=SEED)
+    updated = ingest.apply_changes(new_tracks)
+    assert updated["discogs_clusters"]
+
+    appended = np.array(load_array("discogs_clusters"))
+    assert len(appended) == 100
+    assert get_partition(appended) == get_partition(rebuilt)
+    assert load_cluster_index("discogs").sizes.tolist() == [25] * N_BLOBS
+    assert not append_to_clusters("discogs", 80)
+
+
+def test_clusters_are_stale_after_genre_changes(store_dir, monkeypatch):
+    monkeypatch.setattr(clustering, "get_genre_names", lambda: list("abcd"))
+    write_store(make_tracks(0, 40, seed=3))
+    build_clusters("discogs", n_clusters=N_BLOBS)
+    assert load_cluster_index("discogs") is not None
+
+    # The labels are computed from the genre activations
+    future = os.path.getmtime(GENRE_DISCOGS_PATH) + 60
+    os.utime(GENRE_DISCOGS_PATH, (future, future))
+    assert load_cluster_index("discogs") is None
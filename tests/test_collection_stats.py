@@ -0,0 +1,92 @@
+import pickle
+import numpy as np
+import pytest
+import collection_stats
+from collection_stats import CollectionStats, update_collection_stats
+
+GENRES = ["Rock---Indie", "Rock---Punk", "Electronic---House", "Jazz---Bop"]
+KEYS = ["C major", "A minor", "G major"]
+
+
+def make_tracks(n_tracks, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "genre": GENRES[rng.integers(len(GENRES))],
+            "key_temperley": KEYS[rng.integers(len(KEYS))],
+            "key_krumhansl": KEYS[rng.integers(len(KEYS))],
+            "key_edma": KEYS[rng.integers(len(KEYS))],
+            "tempo": rng.uniform(60, 300),
+            "loudness": rng.uniform(-70, 0),
+            "danceability_probability": rng.random(),
+            "instrumental_probability": rng.random(),
+            "arousal": rng.uniform(1, 9),
+            "valence": rng.uniform(1, 9),
+        }
+        for _ in range(n_tracks)
+    ]
+
+
+def assert_same_stats(stats, expected):
+    stats, expected = stats.to_dict(), expected.to_dict()
+    summaries, expected_summaries = stats.pop("summaries"), expected.pop("summaries")
+    assert stats == expected
+    for column, summary in summaries.items():
+        assert summary == pytest.approx(expected_summaries[column])
+
+
+def write_features(path, tracks, mode="wb"):
+    with open(path, mode) as f:
+        for track in tracks:
+            pickle.dump(track, f)
+
+
+@pytest.fixture
+def features_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "all_features.pkl")
+    monkeypatch.setattr(collection_stats, "ALL_FEATURES_PATH", path)
+    for name, filename in [
+        ("COLLECTION_STATS_PATH", "collection_stats.json"),
+        ("COLLECTION_STATS_STATE_PATH", "collection_stats.pkl"),
+        ("GENRE_COUNTS_PATH", "all_styles.tsv"),
+    ]:
+        monkeypatch.setattr(collection_stats, name, str(tmp_path / filename))
+    return path
+
+
+def no_pool(*args, **kwargs):
+    raise AssertionError("A single chunk must not start worker processes.")
+
+
+def test_merged_chunks_match_single_pass():
+    tracks = make_tracks(50, seed=0)
+    stats = CollectionStats()
+    for start in range(0, 50, 7):
+        stats.merge(CollectionStats().update(tracks[start : start + 7]))
+    assert_same_stats(stats, CollectionStats().update(tracks))
+    assert stats.merge(CollectionStats()).n_tracks == 50
+
+
+def test_incremental_updates_match_single_pass(features_path, monkeypatch):
+    tracks = make_tracks(30, seed=1)
+    write_features(features_path, tracks[:20])
+    update_collection_stats(workers=2, chunk_size=6)
+
+    # The tracks of an ingest fit in one chunk and are aggregated here
+    monkeypatch.setattr(collection_stats, "ProcessPoolExecutor", no_pool)
+    write_features(features_path, tracks[20:], mode="ab")
+    stats = update_collection_stats(workers=2, chunk_size=16)
+    assert_same_stats(stats, CollectionStats().update(tracks))
+    assert_same_stats(update_collection_stats(), CollectionStats().update(tracks))
+
+
+def test_rewritten_features_start_over(features_path, monkeypatch):
+    monkeypatch.setattr(collection_stats, "ProcessPoolExecutor", no_pool)
+    write_features(features_path, make_tracks(20, seed=2))
+    update_collection_stats(chunk_size=32)
+
+    # A store rewritten with the same number of tracks in another order
+    tracks = make_tracks(20, seed=3)
+    write_features(features_path, tracks)
+    stats = update_collection_stats(chunk_size=32)
+    assert_same_stats(stats, CollectionStats().update(tracks))
@@ -0,0 +1,66 @@
+import numpy as np
+import dedup
+from dedup import (
+    UnionFind,
+    collapse_duplicates,
+    find_duplicates,
+    get_buckets,
+    get_signatures,
+)
+
+
+def test_signatures_follow_the_angle():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((3, 32)).astype(np.float32)
+    vectors = np.vstack([vectors, 2.5 * vectors[:1], -vectors[:1]])
+    signatures = get_signatures(vectors, n_tables=4, n_bits=12)
+
+    assert signatures.shape == (5, 4)
+    # A scaled copy hashes like the original, the opposite vector flips every bit
+    np.testing.assert_array_equal(signatures[3], signatures[0])
+    np.testing.assert_array_equal(signatures[4], 2**12 - 1 - signatures[0])
+    assert np.all(signatures >= 0) and np.all(signatures < 2**12)
+
+
+def test_buckets_group_equal_signatures():
+    signatures = np.array([[5, 1], [3, 1], [5, 2], [7, 2], [3, 9]])
+    buckets = [list(bucket) for bucket in get_buckets(signatures)]
+    assert sorted(buckets) == [[0, 1], [0, 2], [1, 4], [2, 3]]
+
+
+def test_union_find_roots_at_smallest_row():
+    union_find = UnionFind()
+    union_find.union(7, 3)
+    union_find.union(3, 9)
+    union_find.union(12, 11)
+    union_find.union(11, 9)
+    assert {i: union_find.find(i) for i in [3, 7, 9, 11, 12]} == dict.fromkeys(
+        [3, 7, 9, 11, 12], 3
+    )
+    assert union_find.find(5) == 5
+    # Paths are compressed to point at the root
+    assert all(union_find.parents[i] == 3 for i in [7, 9, 11, 12])
+
+
+def test_find_duplicates_finds_planted_copies(monkeypatch):
+    rng = np.random.default_rng(1)
+    discogs = rng.standard_normal((200, 64)).astype(np.float32)
+    msd = rng.standard_normal((200, 16)).astype(np.float32)
+    # Near copies of some tracks, one of them duplicated twice
+    for copy, original in [(150, 10), (151, 10), (170, 42), (199, 3)]:
+        discogs[copy] = discogs[original] + 0.01 * rng.standard_normal(64)
+        msd[copy] = msd[original] + 0.01 * rng.standard_normal(16)
+    # Similar in one embedding only
+    discogs[180] = discogs[5]
+    embeddings = {"discogs": discogs, "msd": msd}
+    monkeypatch.setattr(dedup, "get_shared_embeddings", embeddings.get)
+
+    duplicates = find_duplicates(["discogs", "msd"], threshold=0.98)
+    assert duplicates == {150: 10, 151: 10, 170: 42, 199: 3}
+
+
+def test_collapse_duplicates_keeps_first_of_cluster():
+    duplicate_map = {"b": "a", "c": "a", "e": "d"}
+    tracks = ["c", "x", "a", "e", "b", "d", "y"]
+    assert collapse_duplicates(tracks, duplicate_map) == ["c", "x", "e", "y"]
+    assert collapse_duplicates(tracks, duplicate_map, exclude="b") == ["x", "e", "y"]
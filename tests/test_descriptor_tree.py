@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from descriptor_tree import TREE_COLUMNS, DescriptorIndex, DescriptorTree
+
+
+def brute_force(points, target, k=0, radius=np.inf, weights=None, mask=None):
+    weights = np.ones(points.shape[1]) if weights is None else weights
+    distances = np.sqrt(((points - target) ** 2) @ weights)
+    allowed = distances <= radius
+    if mask is not None:
+        allowed &= mask
+    indexes = np.flatnonzero(allowed)
+    indexes = indexes[np.argsort(distances[indexes], kind="stable")]
+    if k:
+        indexes = indexes[:k]
+    return indexes, distances[indexes]
+
+
+def test_query_matches_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.standard_normal((500, 4))
+    tree = DescriptorTree(points, leaf_size=8)
+    mask = rng.random(500) < 0.3
+    for _ in range(20):
+        target = rng.standard_normal(4) * 1.5
+        weights = rng.integers(0, 2, 4).astype(float)
+        weights[0] = 1
+        for kwargs in [
+            {"k": 10},
+            {"radius": 1.0},
+            {"k": 5, "radius": 0.8},
+            {"k": 7, "weights": weights},
+            {"k": 7, "mask": mask},
+            {"k": 0},
+        ]:
+            indexes, distances = tree.query(target, **kwargs)
+            expected, expected_distances = brute_force(points, target, **kwargs)
+            assert list(indexes) == list(expected)
+            np.testing.assert_allclose(distances, expected_distances)
+
+
+def test_query_small_and_empty_trees():
+    tree = DescriptorTree(np.zeros((0, 3)))
+    indexes, distances = tree.query(np.zeros(3), k=5)
+    assert len(indexes) == 0 and len(distances) == 0
+
+    points = np.array([[0.0, 0.0], [1.0, 0.0], [3.0, 0.0]])
+    indexes, _ = DescriptorTree(points).query(np.array([2.9, 0.0]), k=2)
+    assert list(indexes) == [2, 1]
+
+
+def test_index_ignores_descriptors_without_target():
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame(
+        rng.random((50, len(TREE_COLUMNS))),
+        columns=TREE_COLUMNS,
+        index=[f"track_{i}.mp3" for i in range(50)],
+    )
+    index = DescriptorIndex(df)
+    tempo = df["tempo"]
+    z = (tempo - tempo.mean()) / tempo.std(ddof=0)
+    target = {"tempo": float(tempo.iloc[0])}
+    expected = list((z - z.iloc[0]).abs().sort_values(kind="stable").index[:5])
+    assert index.query(target, k=5) == expected
+
+    tracks = list(df.index[10:20])
+    result = index.query(target, k=3, tracks=tracks)
+    assert len(result) == 3 and set(result) <= set(tracks)
@@ -0,0 +1,80 @@
+import itertools
+import pickle
+import embedding_cache
+from embedding_cache import EmbeddingCache, get_audio_range, get_content_hash
+
+AUDIO = bytes(range(256)) * 40
+
+
+def id3v2(tag_size, footer=False):
+    # Syncsafe size: 7 bits per byte
+    size = bytes((tag_size >> shift) & 0x7F for shift in [21, 14, 7, 0])
+    header = b"ID3\x04\x00" + (b"\x10" if footer else b"\x00") + size
+    return header + b"T" * tag_size + (b"3DI" + b"\x00" * 7 if footer else b"")
+
+
+def id3v1(title):
+    return (b"TAG" + title.encode()).ljust(128, b"\x00")
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+
+def test_retagging_keeps_the_key(tmp_path):
+    plain = write(tmp_path / "plain.mp3", AUDIO)
+    tagged = write(tmp_path / "tagged.mp3", id3v2(300) + AUDIO + id3v1("Song"))
+    retagged = write(
+        tmp_path / "retagged.mp3", id3v2(5000, footer=True) + AUDIO + id3v1("Other")
+    )
+
+    assert get_audio_range(tagged) == (310, 310 + len(AUDIO))
+    assert get_audio_range(retagged) == (5020, 5020 + len(AUDIO))
+    assert get_content_hash(plain) == get_content_hash(tagged)
+    assert get_content_hash(tagged) == get_content_hash(retagged)
+
+
+def test_changed_audio_changes_the_key(tmp_path):
+    original = write(tmp_path / "a.mp3", id3v2(300) + AUDIO)
+    changed_audio = AUDIO[:1000] + b"\xff" + AUDIO[1001:]
+    changed = write(tmp_path / "b.mp3", id3v2(300) + changed_audio)
+    truncated = write(tmp_path / "c.mp3", id3v2(300) + AUDIO[:-1])
+    keys = {get_content_hash(path) for path in [original, changed, truncated]}
+    assert len(keys) == 3
+
+
+def test_short_and_truncated_files(tmp_path):
+    assert get_audio_range(write(tmp_path / "empty.mp3", b"")) == (0, 0)
+    # A tag larger than the file leaves no audio
+    path = write(tmp_path / "cut.mp3", id3v2(300)[:50])
+    assert get_audio_range(path) == (50, 50)
+
+
+def test_eviction_stays_within_size(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: next(clock))
+    value = b"x" * 1000
+    entry_size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    max_mb = 5.5 * entry_size / 2**20
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_mb=max_mb)
+
+    for i in range(5):
+        cache.put(f"key_{i}", value)
+    # Using the first entry makes the second the least recently used
+    assert cache.get("key_0") == value
+    for i in range(5, 8):
+        cache.put(f"key_{i}", value)
+
+    (total,) = cache.connection.execute("SELECT SUM(size) FROM entries").fetchone()
+    assert total <= max_mb * 2**20
+    keys = [key for (key,) in cache.connection.execute("SELECT key FROM entries")]
+    assert sorted(keys) == ["key_0", "key_4", "key_5", "key_6", "key_7"]
+    assert cache.get("key_1") is None
+    cache.close()
+
+    # Entries persist between connections
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_mb=max_mb)
+    assert cache.get("key_7") == value
+    cache.close()
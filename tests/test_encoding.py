@@ -0,0 +1,75 @@
+import pickle
+import numpy as np
+import pandas as pd
+from encoding import (
+    GENRE_NAMES,
+    KEY_NAMES,
+    decode,
+    encode,
+    encode_genres,
+    encode_keys,
+    filter_codes,
+    key_lookup_table,
+)
+from snapshot import append_snapshot, build_all_features
+from config import SNAPSHOT_PATH
+
+
+def make_features(key, genre):
+    features = {"bpm": 120.0, "genre": genre}
+    features.update({column: key for column in ["key_temperley", "key_krumhansl"]})
+    features["key_edma"] = key
+    return features
+
+
+def test_keys_round_trip():
+    keys = ["C major", "A# minor", "Bb minor", None, "A# minor", "B minor"]
+    encoded = encode_keys(keys)
+    assert decode(encoded) == keys
+    assert list(encoded.codes) == [0, 24, 21, -1, 24, 23]
+    # Tonic index * 2 + scale index
+    assert list(encode_keys(KEY_NAMES).codes) == list(range(24))
+
+
+def test_genres_round_trip():
+    genres = [GENRE_NAMES[0], GENRE_NAMES[-1], "Unknown---Style", GENRE_NAMES[0]]
+    encoded = encode_genres(genres)
+    assert decode(encoded) == genres
+    assert list(encoded.codes) == [0, len(GENRE_NAMES) - 1, len(GENRE_NAMES), 0]
+
+
+def test_code_dtypes():
+    assert encode_keys(KEY_NAMES).codes.dtype == np.int8
+    assert encode_genres(GENRE_NAMES).codes.dtype == np.int16
+    # pandas keeps int8 codes below 127 categories
+    dictionary = [str(i) for i in range(126)]
+    assert encode(dictionary, dictionary).codes.dtype == np.int8
+    assert encode(dictionary + ["extra"], dictionary).codes.dtype == np.int16
+
+
+def test_filters_exclude_unknown_keys():
+    keys = pd.Series(encode_keys(["C major", "C minor", "A# minor", None, "D major"]))
+    table = key_lookup_table(["C", "D"], [])
+    assert list(filter_codes(keys, table)) == [True, True, False, False, True]
+    table = key_lookup_table([], ["minor"])
+    assert list(filter_codes(keys, table)) == [False, True, False, False, False]
+
+
+def test_append_snapshot_keeps_unknown_values(store_dir):
+    snapshot = {
+        "all_features": build_all_features(
+            [make_features("C major", GENRE_NAMES[0])], ["a.mp3"]
+        ),
+        "genre_names": GENRE_NAMES,
+    }
+    with open(SNAPSHOT_PATH, "wb") as f:
+        pickle.dump(snapshot, f)
+
+    new_features = [make_features("A# minor", "Unknown---Style")]
+    assert append_snapshot(new_features, ["b.mp3"], 1)
+    with open(SNAPSHOT_PATH, "rb") as f:
+        all_features = pickle.load(f)["all_features"]
+    assert isinstance(all_features["key_edma"].dtype, pd.CategoricalDtype)
+    assert decode(all_features["key_edma"]) == ["C major", "A# minor"]
+    assert decode(all_features["genre"]) == [GENRE_NAMES[0], "Unknown---Style"]
+    assert list(all_features["key_edma"].cat.codes) == [0, 24]
@@ -0,0 +1,102 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from fileio import (
+    FeatureWriter,
+    get_feature_paths,
+    get_manifest_path,
+    iter_store_rows,
+    load_pickled,
+)
+
+
+def make_features(i):
+    return {
+        "discogs_embeddings": np.full(4, i, dtype=np.float32),
+        "msd_embeddings": np.full(2, i, dtype=np.float32),
+        "genre_activations": np.full(3, i, dtype=np.float32),
+        "all_features": {"bpm": float(i)},
+    }
+
+
+def write_store(directory, n_rows):
+    with FeatureWriter(str(directory), batch_size=4, fsync=False) as writer:
+        for i in range(n_rows):
+            writer.write(f"track_{i}.mp3", make_features(i))
+    return get_feature_paths(str(directory))
+
+
+def test_append_keeps_committed_rows(tmp_path):
+    write_store(tmp_path, 5)
+    with FeatureWriter(str(tmp_path), append=True, fsync=False) as writer:
+        writer.write("track_5.mp3", make_features(5))
+
+    rows = list(iter_store_rows(str(tmp_path)))
+    assert [path for path, _ in rows] == [f"track_{i}.mp3" for i in range(6)]
+    assert rows[5][1]["all_features"]["bpm"] == 5.0
+
+
+def test_uncommitted_bytes_are_dropped(tmp_path):
+    paths = write_store(tmp_path, 3)
+    with open(paths["file_paths"], "ab") as f:
+        f.write(pickle.dumps("partial.mp3")[:-2])
+
+    with FeatureWriter(str(tmp_path), append=True, fsync=False):
+        pass
+    assert load_pickled(paths["file_paths"]) == [f"track_{i}.mp3" for i in range(3)]
+
+
+def test_recover_store_without_manifest(tmp_path):
+    paths = write_store(tmp_path, 6)
+    os.remove(get_manifest_path(paths["file_paths"]))
+
+    with FeatureWriter(str(tmp_path), append=True, fsync=False) as writer:
+        assert writer.manifest["rows"] == 6
+    assert len(list(iter_store_rows(str(tmp_path)))) == 6
+
+
+def test_recover_drops_one_interrupted_row(tmp_path):
+    paths = write_store(tmp_path, 6)
+    os.remove(get_manifest_path(paths["file_paths"]))
+    # A row appended to the first files only
+    for name in ["discogs_embeddings", "msd_embeddings"]:
+        with open(paths[name], "ab") as f:
+            pickle.dump(make_features(6)[name], f)
+
+    with FeatureWriter(str(tmp_path), append=True, fsync=False) as writer:
+        assert writer.manifest["rows"] == 6
+    assert len(load_pickled(paths["discogs_embeddings"])) == 6
+
+
+def test_recover_refuses_missing_file(tmp_path):
+    paths = write_store(tmp_path, 6)
+    os.remove(get_manifest_path(paths["file_paths"]))
+    os.remove(paths["discogs_embeddings"])
+    sizes = {
+        name: os.path.getsize(path)
+        for name, path in paths.items()
+        if os.path.exists(path)
+    }
+
+    with pytest.raises(FileNotFoundError):
+        FeatureWriter(str(tmp_path), append=True, fsync=False)
+    assert {name: os.path.getsize(paths[name]) for name in sizes} == sizes
+
+
+def test_recover_refuses_mismatched_rows(tmp_path):
+    paths = write_store(tmp_path, 6)
+    os.remove(get_manifest_path(paths["file_paths"]))
+    with open(paths["file_paths"], "ab") as f:
+        for i in range(6, 8):
+            pickle.dump(f"track_{i}.mp3", f)
+
+    with pytest.raises(ValueError):
+        FeatureWriter(str(tmp_path), append=True, fsync=False)
+    assert len(load_pickled(paths["file_paths"])) == 8
+
+
+def test_new_store_with_append(tmp_path):
+    with FeatureWriter(str(tmp_path), append=True, fsync=False) as writer:
+        writer.write("track_0.mp3", make_features(0))
+    assert len(list(iter_store_rows(str(tmp_path)))) == 1
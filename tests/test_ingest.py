@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+import ingest
+from fileio import FeatureWriter, get_saved_genre_activations
+from store import get_shared_genre_activations, get_store_path, load_array
+
+
+def make_features(i):
+    return {
+        "discogs_embeddings": np.full(4, i, dtype=np.float32),
+        "msd_embeddings": np.full(2, i, dtype=np.float32),
+        "genre_activations": np.full(3, i, dtype=np.float32),
+        "all_features": {"bpm": float(i)},
+    }
+
+
+def write_store(order):
+    with FeatureWriter(fsync=False) as writer:
+        for i in order:
+            writer.write(f"track_{i}.mp3", make_features(i))
+
+
+@pytest.fixture(autouse=True)
+def skip_collection_stats(monkeypatch):
+    monkeypatch.setattr(ingest, "update_collection_stats", lambda: None)
+
+
+def test_rewritten_store_is_not_updated_in_place(store_dir):
+    write_store(range(4))
+    get_shared_genre_activations()
+    past = os.path.getmtime(get_store_path("genre_activations")) - 60
+    os.utime(get_store_path("genre_activations"), (past, past))
+
+    # A full rewrite with the same number of rows in another order
+    write_store(reversed(range(4)))
+    updated = ingest.apply_changes([("track_4.mp3", make_features(4))])
+    assert not updated["genre_activations"]
+
+    expected = get_saved_genre_activations()
+    assert [row[0] for row in expected] == [3, 2, 1, 0, 4]
+    np.testing.assert_array_equal(get_shared_genre_activations(), expected)
+
+
+def test_ingest_updates_fresh_arrays(store_dir):
+    write_store(range(4))
+    get_shared_genre_activations()
+    updated = ingest.apply_changes([("track_4.mp3", make_features(4))])
+    assert updated["genre_activations"]
+    assert len(load_array("genre_activations")) == 5
+
+
+def test_remove_derived_indexes(store_dir):
+    write_store(range(4))
+    get_shared_genre_activations()
+    deleted = ingest.remove_derived_indexes()
+    assert get_store_path("genre_activations") in deleted
+    assert not os.path.exists(get_store_path("genre_activations"))
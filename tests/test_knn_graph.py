@@ -0,0 +1,96 @@
+import numpy as np
+from fileio import FeatureWriter, compact_store
+from knn_graph import (
+    append_to_knn_graph,
+    build_knn_graph,
+    get_normalized_embeddings,
+    load_knn_graph,
+    remove_from_knn_graph,
+    top_k_neighbours,
+)
+
+K = 5
+
+
+def make_tracks(start, n_tracks, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        (
+            f"track_{i}.mp3",
+            {
+                "discogs_embeddings": rng.standard_normal(16).astype(np.float32),
+                "msd_embeddings": np.zeros(2, dtype=np.float32),
+                "genre_activations": np.zeros(3, dtype=np.float32),
+                "all_features": {"bpm": 120.0},
+            },
+        )
+        for i in range(start, start + n_tracks)
+    ]
+
+
+def write_tracks(tracks, append=False):
+    with FeatureWriter(append=append, fsync=False) as writer:
+        for path, features in tracks:
+            writer.write(path, features)
+
+
+def assert_rebuilt_graph(graph):
+    vectors = get_normalized_embeddings("discogs")
+    indexes, similarities = top_k_neighbours(vectors, np.arange(len(vectors)), K)
+    np.testing.assert_array_equal(graph.indexes, indexes)
+    np.testing.assert_allclose(
+        np.asarray(graph.similarities, dtype=np.float32),
+        similarities.astype(np.float32),
+        atol=1e-3,
+    )
+
+
+def test_top_k_neighbours_matches_exact_search():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((100, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    rows = np.array([0, 37, 99])
+    indexes, similarities = top_k_neighbours(vectors, rows, K, tile=2, threads=2)
+
+    exact = vectors[rows] @ vectors.T
+    exact[np.arange(len(rows)), rows] = -np.inf
+    np.testing.assert_array_equal(indexes, np.argsort(-exact, axis=1)[:, :K])
+    np.testing.assert_allclose(
+        similarities, np.sort(exact, axis=1)[:, ::-1][:, :K], atol=1e-3
+    )
+
+
+def test_append_matches_rebuild(store_dir):
+    write_tracks(make_tracks(0, 60, seed=1))
+    build_knn_graph("discogs", k=K)
+
+    write_tracks(make_tracks(60, 15, seed=2), append=True)
+    assert append_to_knn_graph("discogs", 60, k=K, tile=16)
+    graph = load_knn_graph("discogs")
+    assert len(graph) == 75
+    assert_rebuilt_graph(graph)
+
+
+def test_remove_matches_rebuild(store_dir):
+    write_tracks(make_tracks(0, 60, seed=3))
+    build_knn_graph("discogs", k=K)
+
+    # Remove tracks that are neighbours of other tracks
+    graph = load_knn_graph("discogs")
+    removed = {int(graph.indexes[0, 0]), int(graph.indexes[1, 0]), 59}
+    referenced = np.isin(np.asarray(graph.indexes), list(removed)).any(axis=1)
+    assert referenced.sum() > len(removed)
+
+    keep = compact_store({f"track_{i}.mp3" for i in removed})
+    assert keep.sum() == 60 - len(removed)
+    assert remove_from_knn_graph("discogs", keep, k=K)
+    graph = load_knn_graph("discogs")
+    assert len(graph) == keep.sum()
+    assert_rebuilt_graph(graph)
+
+
+def test_outdated_graph_is_not_updated(store_dir):
+    write_tracks(make_tracks(0, 20, seed=4))
+    build_knn_graph("discogs", k=K)
+    assert not append_to_knn_graph("discogs", 19, k=K)
+    assert not remove_from_knn_graph("discogs", np.ones(21, dtype=bool), k=K)
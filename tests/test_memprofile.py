@@ -0,0 +1,23 @@
+import pytest
+import memprofile
+from memprofile import RssSampler, get_current_rss_mb
+
+
+def test_current_rss_is_measured():
+    assert get_current_rss_mb() > 0
+    with RssSampler(interval=0.01) as sampler:
+        assert sampler.peak > 0
+
+
+def test_unreadable_rss_fails_loudly(monkeypatch):
+    monkeypatch.setattr(memprofile, "get_rss_mb", lambda pid: None)
+    with pytest.raises(RuntimeError):
+        get_current_rss_mb()
+    with pytest.raises(RuntimeError):
+        RssSampler().__enter__()
+    # The check comes before the extraction is imported
+    monkeypatch.setattr(memprofile, "load_extraction", pytest.fail)
+    with pytest.raises(RuntimeError):
+        memprofile.soak(n_tracks=1)
+    with pytest.raises(RuntimeError):
+        memprofile.profile(n_tracks=1)
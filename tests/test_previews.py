@@ -0,0 +1,17 @@
+import sys
+import previews
+
+
+def test_previews_work_without_encoding(tmp_path, monkeypatch):
+    monkeypatch.setattr(previews, "PREVIEW_DIR_PATH", str(tmp_path))
+    # Essentia fails to import, as in an app installed without it
+    monkeypatch.setitem(sys.modules, "essentia", None)
+    monkeypatch.setitem(sys.modules, "essentia.standard", None)
+    audio_path = str(tmp_path / "track.mp3")
+    open(audio_path, "wb").close()
+
+    assert previews.get_preview(audio_path) == audio_path
+
+    preview_path = previews.get_preview_path(audio_path)
+    open(preview_path, "wb").close()
+    assert previews.get_preview(audio_path) == preview_path
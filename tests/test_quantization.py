@@ -0,0 +1,67 @@
+import os
+import time
+import numpy as np
+import quantization
+from quantization import (
+    PQIndex,
+    ProductQuantizer,
+    load_pq_index,
+    normalize_rows,
+)
+
+
+def make_index(n_tracks, dim=16, n_subvectors=4, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = normalize_rows(rng.standard_normal((n_tracks, dim)))
+    quantizer = ProductQuantizer(n_subvectors, n_centroids=16).fit(vectors)
+    return PQIndex(quantizer, quantizer.encode(vectors), vectors), vectors
+
+
+def exact_search(vectors, track_index, k):
+    similarities = vectors @ vectors[track_index]
+    similarities[track_index] = -np.inf
+    return list(np.argsort(similarities)[::-1][:k])
+
+
+def test_search_with_full_rerank_is_exact():
+    index, vectors = make_index(200)
+    for track_index in [0, 57, 199]:
+        result = index.search(track_index, 10, rerank=len(index))
+        assert result == exact_search(vectors, track_index, 10)
+
+
+def test_search_excludes_query_and_returns_k():
+    index, _ = make_index(200)
+    result = index.search(3, 20, rerank=50)
+    assert len(result) == 20
+    assert 3 not in result
+    assert len(set(result)) == 20
+    assert len(index.search(3, 0, rerank=50)) == 199
+
+
+def test_search_single_track():
+    index, _ = make_index(1, n_subvectors=2)
+    assert index.search(0, 10) == []
+    assert index.search(0, 0) == []
+
+
+def test_stale_index_is_not_loaded(tmp_path, monkeypatch):
+    embeddings_path = str(tmp_path / "discogs_embeddings.pkl")
+    vectors_path = str(tmp_path / "discogs_vectors.npy")
+    index_path = str(tmp_path / "discogs_pq.npz")
+    monkeypatch.setattr("fileio.DISCOGS_EMBEDDINGS_PATH", embeddings_path)
+    monkeypatch.setattr(quantization, "DISCOGS_VECTORS_PATH", vectors_path)
+    monkeypatch.setattr(quantization, "DISCOGS_PQ_INDEX_PATH", index_path)
+
+    index, vectors = make_index(20)
+    open(embeddings_path, "wb").close()
+    np.save(vectors_path, vectors)
+    np.savez(index_path, codebooks=index.quantizer.codebooks, codes=index.codes)
+    past = time.time() - 60
+    os.utime(embeddings_path, (past, past))
+    assert len(load_pq_index("discogs")) == 20
+
+    # The store is rewritten after the index was built
+    os.utime(embeddings_path)
+    assert load_pq_index("discogs") is None
+    assert len(quantization.load_stored_pq_index("discogs")) == 20
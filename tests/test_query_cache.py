@@ -0,0 +1,50 @@
+import numpy as np
+from query_cache import QueryCache
+
+
+def test_equal_queries_share_a_key():
+    cache = QueryCache()
+    key = cache.make_key(1, "filter", genres={"rock", "jazz"}, bpm=(60.0, 120.0))
+    same = cache.make_key(1, "filter", bpm=[60.0000001, 120], genres={"jazz", "rock"})
+    assert key == same
+    assert key == cache.make_key(1, "filter", genres={"rock", "jazz"}, bpm=(60, 120))
+    assert key != cache.make_key(2, "filter", genres={"rock", "jazz"}, bpm=(60, 120))
+    assert key != cache.make_key(1, "target", genres={"rock", "jazz"}, bpm=(60, 120))
+    assert cache.make_key(1, "a", order=["x", "y"]) != cache.make_key(
+        1, "a", order=["y", "x"]
+    )
+    assert cache.make_key(1, "a", k=np.int64(3)) == cache.make_key(1, "a", k=3)
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = QueryCache(max_entries=2)
+    keys = [cache.make_key(1, "q", i=i) for i in range(3)]
+    cache.put(keys[0], "a")
+    cache.put(keys[1], "b")
+    assert cache.get(keys[0]) == "a"
+    cache.put(keys[2], "c")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == "a"
+    assert cache.get(keys[2]) == "c"
+    assert cache.get_stats() == {"hits": 3, "misses": 1, "hit_rate": 0.75, "entries": 2}
+
+
+def test_newer_version_clears_and_older_results_are_dropped():
+    cache = QueryCache()
+    cache.put(cache.make_key(1, "q", i=0), "old")
+    new_key = cache.make_key(2, "q", i=0)
+    cache.put(new_key, "new")
+    assert cache.get(cache.make_key(1, "q", i=0)) is None
+
+    # A session that started before the ingestion finishes after it
+    cache.put(cache.make_key(1, "q", i=1), "late")
+    assert cache.get(new_key) == "new"
+    assert cache.get(cache.make_key(1, "q", i=1)) is None
+    assert cache.version == 2
+
+    # Stores without a manifest have no version
+    unversioned = QueryCache()
+    unversioned.put(unversioned.make_key(None, "q", i=0), "a")
+    unversioned.put(unversioned.make_key(0, "q", i=0), "b")
+    unversioned.put(unversioned.make_key(None, "q", i=1), "c")
+    assert unversioned.get_stats()["entries"] == 1
@@ -0,0 +1,109 @@
+import os
+import pytest
+import sandbox
+from sandbox import SandboxPool, Worker, load_quarantined, quarantine
+
+
+class FakeConn:
+    def __init__(self):
+        self.sent = []
+        self.messages = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def recv(self):
+        return self.messages.pop(0)
+
+
+class FakeProcess:
+    pid = -1
+
+
+def make_worker():
+    worker = Worker.__new__(Worker)
+    worker.conn, worker.process = FakeConn(), FakeProcess()
+    worker.path = worker.stage = worker.assigned = worker.started = None
+    return worker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(sandbox.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(sandbox, "FAILURES_LOG_PATH", str(tmp_path / "failures.tsv"))
+    monkeypatch.setattr(sandbox, "get_rss_mb", lambda pid: None)
+    pool = SandboxPool.__new__(SandboxPool)
+    pool.timeout, pool.setup_timeout, pool.memory_limit_mb = 10, 100, 1024
+    pool.setup_failures = 0
+    pool.workers = [make_worker()]
+
+    def restart(worker):
+        new_worker = make_worker()
+        pool.workers[pool.workers.index(worker)] = new_worker
+        return new_worker
+
+    monkeypatch.setattr(pool, "_restart", restart)
+    return pool
+
+
+def test_deadline_starts_with_first_stage(pool, clock):
+    worker = pool.workers[0]
+    worker.assign("a.mp3")
+    # Loading the models takes longer than a track may
+    clock[0] = 50
+    assert pool._check_limits() == []
+    worker.conn.messages.append(("stage", "load"))
+    assert pool._receive(worker) is None
+
+    clock[0] = 59
+    assert pool._check_limits() == []
+    clock[0] = 61
+    assert pool._check_limits() == ["a.mp3"]
+    with open(sandbox.FAILURES_LOG_PATH) as f:
+        assert f.read().split("\t")[2:] == ["load", "timeout after 10s\n"]
+
+
+def test_setup_timeout_retries_track(pool, clock):
+    pool.workers[0].assign("a.mp3")
+    clock[0] = 101
+    assert pool._check_limits() == []
+    assert pool.setup_failures == 1
+    assert pool.workers[0].path == "a.mp3"
+    assert pool.workers[0].conn.sent == ["a.mp3"]
+
+    for _ in range(sandbox.SETUP_RETRIES - 1):
+        clock[0] += 101
+        pool._check_limits()
+    clock[0] += 101
+    with pytest.raises(RuntimeError):
+        pool._check_limits()
+
+
+def test_exceptions_are_not_quarantined(pool, clock, tmp_path):
+    path = str(tmp_path / "a.mp3")
+    open(path, "wb").close()
+    worker = pool.workers[0]
+    worker.assign(path)
+    worker.conn.messages.extend([("stage", "load"), ("error", "OSError: busy")])
+    assert pool._receive(worker) is None
+    assert pool._receive(worker) == (path, None)
+    assert worker.path is None
+    assert not os.path.exists(sandbox.FAILURES_LOG_PATH)
+
+
+def test_changed_files_leave_quarantine(pool, tmp_path):
+    path = str(tmp_path / "a.mp3")
+    with open(path, "wb") as f:
+        f.write(b"partial")
+    quarantine(path, "load", "worker crashed\twith exit code -11")
+    assert load_quarantined() == {path}
+
+    with open(path, "wb") as f:
+        f.write(b"complete file")
+    assert load_quarantined() == set()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from segments import (
+    analyse_segments,
+    get_segment_times,
+    get_segments,
+    median_tempo,
+    most_common,
+    tempo_agrees,
+)
+
+DURATIONS = [0.5, 29.9, 30, 45.3, 60, 91.7, 240, 3600.01]
+
+
+@pytest.mark.parametrize("duration", DURATIONS)
+@pytest.mark.parametrize("policy", ["full", "middle", "windows"])
+def test_segments_stay_within_the_track(duration, policy):
+    times = get_segment_times(duration, policy, seconds=30, windows=3)
+    for start, end in times:
+        assert 0 <= start < end <= duration
+        length = duration if policy == "full" else min(duration, 30)
+        assert end - start == pytest.approx(length)
+
+    # Short tracks and the full policy analyse the whole track once
+    if policy == "full" or duration <= 30:
+        assert times == [(0, duration)]
+    elif policy == "middle":
+        (start, end), = times
+        assert (start + end) / 2 == pytest.approx(duration / 2)
+    else:
+        assert len(times) == 3
+        # Most central first, the windows together cover the track when it is
+        # shorter than the windows laid end to end
+        centers = [(start + end) / 2 for start, end in times]
+        distances = [abs(center - duration / 2) for center in centers]
+        assert distances == sorted(distances)
+        if duration <= 90:
+            assert min(start for start, _ in times) == 0
+            assert max(end for _, end in times) == pytest.approx(duration)
+            spans = sorted(times)
+            assert all(b[0] <= a[1] for a, b in zip(spans, spans[1:]))
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        get_segment_times(120, "random")
+
+
+@pytest.mark.parametrize("duration", DURATIONS)
+@pytest.mark.parametrize("policy", ["full", "middle", "windows"])
+def test_segments_slice_the_audio(duration, policy):
+    sample_rate = 11025
+    audio = np.arange(int(duration * sample_rate))
+    segments = get_segments(audio, sample_rate, policy, seconds=30, windows=3)
+    times = get_segment_times(len(audio) / sample_rate, policy, seconds=30, windows=3)
+    assert len(segments) == len(times)
+    for segment, (start, end) in zip(segments, times):
+        assert segment[0] == int(start * sample_rate)
+        assert len(segment) == pytest.approx((end - start) * sample_rate, abs=1)
+
+
+def test_early_exit_when_two_segments_agree():
+    analysed = []
+
+    def analyse(segment):
+        analysed.append(segment)
+        return {"a": 120.0, "b": 90.0, "c": 121.5, "d": 60.0}[segment]
+
+    assert analyse_segments("abcd", analyse, tempo_agrees, median_tempo) == 120.75
+    assert analysed == ["a", "b", "c"]
+
+
+def test_no_agreement_combines_all_segments():
+    keys = {"a": "C major", "b": "A minor", "c": "G major"}
+    assert analyse_segments("abc", keys.get, str.__eq__, most_common) == "C major"
+    tempos = {"a": 120.0, "b": 90.0, "c": 100.0}
+    assert analyse_segments("abc", tempos.get, tempo_agrees, median_tempo) == 100.0
+    assert analyse_segments("a", tempos.get, tempo_agrees, median_tempo) == 120.0
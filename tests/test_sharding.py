@@ -0,0 +1,25 @@
+import os
+import sharding
+
+
+def test_leases_on_rollback_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharding, "load_quarantined", lambda: set())
+    for i in range(6):
+        open(tmp_path / f"track_{i}.mp3", "wb").close()
+    db_path = str(tmp_path / "shards" / "coordinator.db")
+
+    assert sharding.create_shards(str(tmp_path), n_shards=2, db_path=db_path) == 6
+    connection = sharding.connect(db_path)
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert not os.path.exists(db_path + "-wal")
+
+    shard, attempt = sharding.lease_shard(connection, "a")
+    assert (shard, attempt) == (0, 1)
+    # An expired lease is taken over with a new attempt
+    assert sharding.lease_shard(connection, "b", lease_seconds=-1) == (1, 1)
+    assert sharding.lease_shard(connection, "c") == (1, 2)
+    assert not sharding.renew_lease(connection, 1, 1)
+    assert sharding.renew_lease(connection, 1, 2)
+    assert sharding.complete_shard(connection, 0, 1, rows=3)
+    assert sharding.lease_shard(connection, "d") == (None, None)
+    connection.close()
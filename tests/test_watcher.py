@@ -0,0 +1,29 @@
+import watcher
+
+
+class FakePool:
+    def __init__(self, failing):
+        self.failing = failing
+
+    def imap(self, paths):
+        for path in paths:
+            yield path, None if path in self.failing else {"path": path}
+
+
+def test_failed_modified_file_keeps_its_rows(tmp_path, monkeypatch):
+    good, bad = str(tmp_path / "good.mp3"), str(tmp_path / "bad.mp3")
+    deleted = str(tmp_path / "deleted.mp3")
+    for path in [good, bad]:
+        open(path, "wb").close()
+    applied = {}
+    monkeypatch.setattr(watcher, "get_stored_paths", lambda: {good, bad, deleted})
+    monkeypatch.setattr(
+        watcher,
+        "apply_changes",
+        lambda tracks, removed: applied.update(tracks=tracks, removed=removed),
+    )
+
+    added, removed = watcher.process_changes([good, bad, deleted], FakePool({bad}))
+    assert added == [good]
+    assert removed == {good, deleted}
+    assert applied["removed"] == {good, deleted}
@@ -0,0 +1,439 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from sandbox import SandboxPool
+from discovery import discover_audio_files
+from fileio import finish_compaction, get_saved_file_paths
+from ingest import analyse_files, apply_changes
+from config import (
+    DATA_PATH,
+    FILE_PATHS_PATH,
+    AUDIO_EXTENSIONS,
+    WATCH_DEBOUNCE,
+    WATCH_POLL_INTERVAL,
+    WATCH_BATCH_SIZE,
+    WATCH_WORKERS,
+)
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_audio_file(path, extensions=AUDIO_EXTENSIONS):
+    """
+    Check if a path has one of the audio file extensions
+
+    Args:
+        path (str): File path
+        extensions (list): Audio file extensions, such as ".mp3"
+
+    Returns:
+        bool: True for audio files
+    """
+
+    return os.path.splitext(path)[1].lower() in {ext.lower() for ext in extensions}
+
+
+class InotifyWatcher:
+    def __init__(self, root):
+        """
+        Watch a directory tree with Linux inotify through ctypes, adding
+        watches for new subdirectories as they appear.
+
+        Args:
+            root (str): Root directory of the collection
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        self.overflowed = False
+        try:
+            for directory, _, _ in os.walk(root):
+                self._add_watch(directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_watch(self, directory):
+        """
+        Watch one directory.
+
+        Args:
+            directory (str): Directory path
+
+        Returns:
+            None
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Cannot watch {directory}: {os.strerror(errno)}")
+        self.directories[wd] = directory
+
+    def _remove_watches(self, directory):
+        """
+        Stop watching a directory and its subdirectories.
+
+        Args:
+            directory (str): Directory path
+
+        Returns:
+            None
+        """
+        for wd, path in list(self.directories.items()):
+            if path == directory or path.startswith(directory + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def read_events(self, timeout):
+        """
+        Wait for changes and return the changed paths.
+
+        Args:
+            timeout (float): Maximum seconds to wait
+
+        Returns:
+            list: Changed file or directory paths
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, the caller has to rescan
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            if wd not in self.directories:
+                continue
+
+            path = os.path.join(self.directories[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been added before the watch existed
+                    for directory, _, _ in os.walk(path):
+                        try:
+                            self._add_watch(directory)
+                        except FileNotFoundError:
+                            pass
+                elif mask & IN_MOVED_FROM:
+                    # A moved directory is still watched under its new name
+                    self._remove_watches(path)
+                changed.append(path)
+            elif is_audio_file(path):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        """
+        Stop watching.
+
+        Returns:
+            None
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, root, interval=WATCH_POLL_INTERVAL):
+        """
+        Watch a directory tree by comparing the size and modification time of
+        its audio files between scans, where inotify is not available.
+
+        Args:
+            root (str): Root directory of the collection
+            interval (float): Seconds between scans
+        """
+        self.root = root
+        self.interval = interval
+        self.overflowed = False
+        self.files = self._scan()
+        self.last_scan = time.monotonic()
+
+    def _scan(self):
+        """
+        Stat every audio file under the root.
+
+        Returns:
+            dict: Paths mapped to (size, modification time)
+        """
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                if is_audio_file(path):
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def read_events(self, timeout):
+        """
+        Wait for the next scan and return the changed paths.
+
+        Args:
+            timeout (float): Maximum seconds to wait
+
+        Returns:
+            list: Changed file paths
+        """
+        wait = self.last_scan + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+
+        files = self._scan()
+        self.last_scan = time.monotonic()
+        changed = [
+            path
+            for path in files.keys() | self.files.keys()
+            if files.get(path) != self.files.get(path)
+        ]
+        self.files = files
+        return changed
+
+    def close(self):
+        """
+        Stop watching.
+
+        Returns:
+            None
+        """
+
+
+def create_watcher(root, polling=False, interval=WATCH_POLL_INTERVAL):
+    """
+    Create an inotify watcher, falling back to polling where inotify is not
+    available or the watch limit is reached
+
+    Args:
+        root (str): Root directory of the collection
+        polling (bool): Always poll
+        interval (float): Seconds between scans when polling
+
+    Returns:
+        InotifyWatcher or PollingWatcher: The watcher
+    """
+
+    if not polling:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"inotify unavailable ({e}), polling every {interval}s.")
+    return PollingWatcher(root, interval)
+
+
+class Debouncer:
+    def __init__(self, delay=WATCH_DEBOUNCE):
+        """
+        Collect changed paths until they have been quiet for a delay, so a
+        file is processed once after a burst of writes.
+
+        Args:
+            delay (float): Quiet seconds before a path is ready
+        """
+        self.delay = delay
+        self.pending = {}
+
+    def add(self, paths):
+        """
+        Record changes, restarting the delay of each path.
+
+        Args:
+            paths (list): Changed paths
+
+        Returns:
+            None
+        """
+        now = time.monotonic()
+        for path in paths:
+            self.pending[path] = now
+
+    def pop_ready(self, limit):
+        """
+        Remove and return the paths that have been quiet for the delay.
+
+        Args:
+            limit (int): Maximum number of paths
+
+        Returns:
+            list: Ready paths, oldest first
+        """
+        now = time.monotonic()
+        ready = sorted(
+            (changed, path)
+            for path, changed in self.pending.items()
+            if now - changed >= self.delay
+        )[:limit]
+        for _, path in ready:
+            del self.pending[path]
+        return [path for _, path in ready]
+
+
+def get_stored_paths():
+    """
+    Return the paths in the feature store
+
+    Returns:
+        set: Stored audio file paths
+    """
+
+    if not os.path.exists(FILE_PATHS_PATH):
+        return set()
+    return set(get_saved_file_paths())
+
+
+def process_changes(paths, pool):
+    """
+    Bring the feature store up to date with changed paths. Existing files are
+    analysed and added, replacing their old rows when they were modified, and
+    the rows of deleted files and directories are removed.
+
+    Args:
+        paths (list): Changed file or directory paths
+        pool (SandboxPool): Extraction workers
+
+    Returns:
+        list: Paths analysed and added
+        set: Paths removed
+    """
+
+    stored = get_stored_paths()
+    upserts, removed = [], set()
+    for path in paths:
+        if os.path.isdir(path):
+            upserts.extend(discover_audio_files(path))
+        elif os.path.isfile(path):
+            upserts.append(path)
+        else:
+            # A deleted file, or every stored file under a deleted directory
+            removed |= {
+                stored_path
+                for stored_path in stored
+                if stored_path == path or stored_path.startswith(path + os.sep)
+            }
+
+    upserts = list(dict.fromkeys(upserts))
+    tracks = analyse_files(upserts, pool) if upserts else []
+    # Modified files keep their old rows unless they were analysed again
+    removed |= stored.intersection(path for path, _ in tracks)
+    apply_changes(tracks, removed)
+    return [path for path, _ in tracks], removed
+
+
+def get_missed_changes(root):
+    """
+    Compare the collection on disk with the feature store, to catch up on
+    changes made while the watcher was not running or events were dropped
+
+    Args:
+        root (str): Root directory of the collection
+
+    Returns:
+        list: New audio files and stored paths no longer on disk
+    """
+
+    on_disk = set(discover_audio_files(root))
+    stored = get_stored_paths()
+    return sorted(on_disk - stored) + sorted(stored - on_disk)
+
+
+def watch(
+    root=DATA_PATH,
+    n_workers=WATCH_WORKERS,
+    debounce=WATCH_DEBOUNCE,
+    batch_size=WATCH_BATCH_SIZE,
+    polling=False,
+    catch_up=False,
+):
+    """
+    Keep the feature store and the playlist indexes up to date with the
+    collection, extracting created and modified files and removing deleted
+    ones as they happen
+
+    Args:
+        root (str): Root directory of the collection
+        n_workers (int): Number of extraction worker processes
+        debounce (float): Quiet seconds before a changed file is processed
+        batch_size (int): Maximum number of paths processed at once
+        polling (bool): Poll instead of using inotify
+        catch_up (bool): Process changes made while the watcher was not running
+
+    Returns:
+        None
+    """
+
+    root = os.path.normpath(root)
+    finish_compaction()
+    watcher = create_watcher(root, polling)
+    debouncer = Debouncer(debounce)
+    if catch_up:
+        debouncer.add(get_missed_changes(root))
+
+    with SandboxPool(n_workers) as pool:
+        try:
+            while True:
+                debouncer.add(watcher.read_events(timeout=min(debounce, 1)))
+                if watcher.overflowed:
+                    watcher.overflowed = False
+                    debouncer.add(get_missed_changes(root))
+
+                ready = debouncer.pop_ready(batch_size)
+                if ready:
+                    added, removed = process_changes(ready, pool)
+                    print(f"Added {len(added)} and removed {len(removed)} tracks.")
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Watch the collection and extract changed files continuously."
+    )
+    parser.add_argument("--root", default=DATA_PATH, help="Collection directory")
+    parser.add_argument("--workers", type=int, default=WATCH_WORKERS)
+    parser.add_argument("--polling", action="store_true", help="Poll instead of inotify")
+    parser.add_argument(
+        "--catch-up", action="store_true", help="Process changes made while stopped"
+    )
+    args = parser.parse_args()
+
+    try:
+        watch(args.root, args.workers, polling=args.polling, catch_up=args.catch_up)
+    except KeyboardInterrupt:
+        pass